@@ -0,0 +1,325 @@
+import http.server
+import random
+import re
+import threading
+import time
+import urllib.parse
+from xml.sax.saxutils import escape
+
+# A local stand-in for the EC2, RDS and STS query APIs the deletion engines use. Clients point at it through
+# session_pool.ENDPOINT_URL; the account is read from the access key and the region and service from the
+# signature's credential scope, so every account and region has its own resources.
+
+OLD_DATE = '2020-01-01T00:00:00.000Z'
+
+# Only mutating calls are throttled, as the real services mostly throttle those
+MUTATING_OPERATIONS = {'DeregisterImage', 'DeleteSnapshot', 'DeleteVolume', 'ReleaseAddress', 'DeleteDBSnapshot',
+                       'DeleteDBClusterSnapshot'}
+THROTTLE_ERRORS = {'ec2': ('RequestLimitExceeded', 503), 'rds': ('Throttling', 400), 'sts': ('Throttling', 400)}
+
+# RDS describe calls return at most 100 records per page
+RDS_PAGE_SIZE = 100
+
+CREDENTIAL_PATTERN = re.compile(r'Credential=([^/]+)/[^/]+/([^/]+)/([^/]+)/')
+
+
+class FakeError(Exception):
+
+    def __init__(self, code, status=400):
+        super().__init__(code)
+        self.code = code
+        self.status = status
+
+
+class RegionResources:
+    # The resources of one account and region
+
+    def __init__(self):
+        self.images = {}
+        self.snapshots = {}
+        self.volumes = {}
+        self.addresses = {}
+        self.rds_snapshots = {}
+        # Registered images using each snapshot, so a snapshot in use is refused without scanning every image
+        self.snapshot_refs = {}
+        self.allocations = {}
+
+    def add_address(self, public_ip, allocation_id, association_id=None):
+        self.addresses[public_ip] = (allocation_id, association_id)
+        self.allocations[allocation_id] = public_ip
+
+    def remove_address(self, public_ip):
+        allocation_id, association_id = self.addresses.pop(public_ip)
+        del self.allocations[allocation_id]
+
+    def add_image(self, image_id, snapshot_ids, creation_date=OLD_DATE):
+        self.images[image_id] = (creation_date, snapshot_ids)
+        for snapshot_id in snapshot_ids:
+            self.snapshots.setdefault(snapshot_id, 'completed')
+            self.snapshot_refs[snapshot_id] = self.snapshot_refs.get(snapshot_id, 0) + 1
+
+    def remove_image(self, image_id):
+        creation_date, snapshot_ids = self.images.pop(image_id)
+        for snapshot_id in snapshot_ids:
+            self.snapshot_refs[snapshot_id] -= 1
+
+
+def indexed_values(params, prefix):
+    # Values of a query list parameter, e.g. VolumeId.1, VolumeId.2
+    pattern = re.compile(rf'^{re.escape(prefix)}\.(\d+)$')
+    matches = sorted((int(match.group(1)), value) for name, value in params.items()
+                     for match in [pattern.match(name)] if match)
+    return [value for index, value in matches]
+
+
+def filter_values(params):
+    # {filter name: values} of the Filter.N.Name and Filter.N.Value.M parameters
+    filters = {}
+    for name, value in params.items():
+        match = re.match(r'^Filter\.(\d+)\.Name$', name)
+        if match:
+            filters[value] = indexed_values(params, f'Filter.{match.group(1)}.Value')
+    return filters
+
+
+def requested(params, list_prefix, filter_name):
+    # The IDs asked for by parameter or filter, or None for all
+    values = indexed_values(params, list_prefix) or filter_values(params).get(filter_name)
+    return None if values is None else set(values)
+
+
+def select(resources, ids):
+    # (ID, value) pairs of the requested resources, looked up by ID rather than scanning the region
+    if ids is None:
+        return list(resources.items())
+    return [(resource_id, resources[resource_id]) for resource_id in ids if resource_id in resources]
+
+
+class FakeAws:
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.calls = {}
+        self.throttled = 0
+        self._regions = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def region(self, account_number, region_name):
+        key = (account_number, region_name)
+        if key not in self._regions:
+            self._regions[key] = RegionResources()
+        return self._regions[key]
+
+    def reset(self):
+        with self._lock:
+            self._regions = {}
+            self.calls = {}
+            self.throttled = 0
+
+    def handle(self, service, account_number, region_name, params):
+        # Returns the HTTP status and XML body of one request
+        operation = params.get('Action', '')
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            throttled = operation in MUTATING_OPERATIONS and self._random.random() < self.throttle_rate
+            if throttled:
+                self.throttled += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        try:
+            if throttled:
+                raise FakeError(*THROTTLE_ERRORS[service])
+            handler = getattr(self, f'_{service}_{operation}', None)
+            if handler is None:
+                raise FakeError('InvalidAction')
+            with self._lock:
+                result = handler(self.region(account_number, region_name), params, account_number)
+        except FakeError as e:
+            return e.status, self._error(service, e.code)
+        if service == 'ec2':
+            return 200, f'<{operation}Response>{result}<requestId>bench</requestId></{operation}Response>'
+        return 200, f'<{operation}Response><{operation}Result>{result}</{operation}Result>' \
+                    f'<ResponseMetadata><RequestId>bench</RequestId></ResponseMetadata></{operation}Response>'
+
+    @staticmethod
+    def _error(service, code):
+        if service == 'ec2':
+            return f'<Response><Errors><Error><Code>{code}</Code><Message>{code}</Message></Error></Errors>' \
+                   f'<RequestID>bench</RequestID></Response>'
+        return f'<ErrorResponse><Error><Type>Sender</Type><Code>{code}</Code><Message>{code}</Message></Error>' \
+               f'<RequestId>bench</RequestId></ErrorResponse>'
+
+    @staticmethod
+    def _check_dry_run(params):
+        if params.get('DryRun') == 'true':
+            raise FakeError('DryRunOperation', 412)
+
+    # EC2
+
+    def _ec2_DescribeImages(self, resources, params, account_number):
+        ids = requested(params, 'ImageId', 'image-id')
+        items = ''.join(
+            f'<item><imageId>{image_id}</imageId><creationDate>{creation_date}</creationDate><blockDeviceMapping>'
+            + ''.join(f'<item><deviceName>/dev/sd{chr(97 + index)}</deviceName><ebs><snapshotId>{snapshot_id}'
+                      f'</snapshotId></ebs></item>' for index, snapshot_id in enumerate(snapshot_ids))
+            + '</blockDeviceMapping></item>'
+            for image_id, (creation_date, snapshot_ids) in select(resources.images, ids))
+        return f'<imagesSet>{items}</imagesSet>'
+
+    def _ec2_DescribeSnapshots(self, resources, params, account_number):
+        ids = requested(params, 'SnapshotId', 'snapshot-id')
+        items = ''.join(f'<item><snapshotId>{snapshot_id}</snapshotId><status>{state}</status>'
+                        f'<ownerId>{account_number}</ownerId></item>'
+                        for snapshot_id, state in select(resources.snapshots, ids))
+        return f'<snapshotSet>{items}</snapshotSet>'
+
+    def _ec2_DescribeVolumes(self, resources, params, account_number):
+        ids = requested(params, 'VolumeId', 'volume-id')
+        items = ''.join(f'<item><volumeId>{volume_id}</volumeId><status>{state}</status></item>'
+                        for volume_id, state in select(resources.volumes, ids))
+        return f'<volumeSet>{items}</volumeSet>'
+
+    def _ec2_DescribeAddresses(self, resources, params, account_number):
+        # Like EC2, naming an address that does not exist fails the whole call
+        if any(public_ip not in resources.addresses for public_ip in indexed_values(params, 'PublicIp')):
+            raise FakeError('InvalidAddress.NotFound')
+        ips = requested(params, 'PublicIp', 'public-ip')
+
+        allocation_ids = requested(params, 'AllocationId', 'allocation-id')
+        if allocation_ids is not None:
+            if any(allocation_id not in resources.allocations
+                   for allocation_id in indexed_values(params, 'AllocationId')):
+                raise FakeError('InvalidAllocationID.NotFound')
+            ips = {public_ip for allocation_id, public_ip in select(resources.allocations, allocation_ids)
+                   if ips is None or public_ip in ips}
+
+        items = ''.join(
+            f'<item><publicIp>{public_ip}</publicIp><allocationId>{allocation_id}</allocationId><domain>vpc</domain>'
+            + (f'<associationId>{association_id}</associationId>' if association_id else '') + '</item>'
+            for public_ip, (allocation_id, association_id) in select(resources.addresses, ips))
+        return f'<addressesSet>{items}</addressesSet>'
+
+    def _ec2_DeregisterImage(self, resources, params, account_number):
+        if params.get('ImageId') not in resources.images:
+            raise FakeError('InvalidAMIID.NotFound')
+        self._check_dry_run(params)
+        resources.remove_image(params['ImageId'])
+        return '<return>true</return>'
+
+    def _ec2_DeleteSnapshot(self, resources, params, account_number):
+        snapshot_id = params.get('SnapshotId')
+        if snapshot_id not in resources.snapshots:
+            raise FakeError('InvalidSnapshot.NotFound')
+        if resources.snapshot_refs.get(snapshot_id):
+            raise FakeError('InvalidSnapshot.InUse')
+        self._check_dry_run(params)
+        del resources.snapshots[snapshot_id]
+        return '<return>true</return>'
+
+    def _ec2_DeleteVolume(self, resources, params, account_number):
+        volume_id = params.get('VolumeId')
+        if volume_id not in resources.volumes:
+            raise FakeError('InvalidVolume.NotFound')
+        if resources.volumes[volume_id] != 'available':
+            raise FakeError('VolumeInUse')
+        self._check_dry_run(params)
+        del resources.volumes[volume_id]
+        return '<return>true</return>'
+
+    def _ec2_ReleaseAddress(self, resources, params, account_number):
+        if 'AllocationId' in params:
+            public_ip = resources.allocations.get(params['AllocationId'])
+            if public_ip is None:
+                raise FakeError('InvalidAllocationID.NotFound')
+        else:
+            public_ip = params.get('PublicIp')
+            if public_ip not in resources.addresses:
+                raise FakeError('InvalidAddress.NotFound')
+        if resources.addresses[public_ip][1]:
+            raise FakeError('InvalidIPAddress.InUse')
+        self._check_dry_run(params)
+        resources.remove_address(public_ip)
+        return '<return>true</return>'
+
+    # RDS
+
+    @staticmethod
+    def _rds_page(identifiers, params, member, identifier_name):
+        page_size = int(params.get('MaxRecords', RDS_PAGE_SIZE))
+        start = int(params.get('Marker', 0))
+        page = identifiers[start:start + page_size]
+        marker = f'<Marker>{start + page_size}</Marker>' if start + page_size < len(identifiers) else ''
+        items = ''.join(f'<{member}><{identifier_name}>{escape(identifier)}</{identifier_name}>'
+                        f'<SnapshotType>manual</SnapshotType><Status>available</Status></{member}>'
+                        for identifier in page)
+        return f'<{member}s>{items}</{member}s>{marker}'
+
+    def _rds_snapshot_ids(self, resources, params, kind, identifier_param):
+        identifiers = sorted(identifier for identifier, snapshot_kind in resources.rds_snapshots.items()
+                             if snapshot_kind == kind)
+        if identifier_param in params:
+            identifiers = [identifier for identifier in identifiers if identifier == params[identifier_param]]
+        return identifiers
+
+    def _rds_DescribeDBSnapshots(self, resources, params, account_number):
+        identifiers = self._rds_snapshot_ids(resources, params, 'instance', 'DBSnapshotIdentifier')
+        return self._rds_page(identifiers, params, 'DBSnapshot', 'DBSnapshotIdentifier')
+
+    def _rds_DescribeDBClusterSnapshots(self, resources, params, account_number):
+        identifiers = self._rds_snapshot_ids(resources, params, 'cluster', 'DBClusterSnapshotIdentifier')
+        return self._rds_page(identifiers, params, 'DBClusterSnapshot', 'DBClusterSnapshotIdentifier')
+
+    def _rds_DeleteDBSnapshot(self, resources, params, account_number):
+        identifier = params.get('DBSnapshotIdentifier')
+        if resources.rds_snapshots.get(identifier) != 'instance':
+            raise FakeError('DBSnapshotNotFound', 404)
+        del resources.rds_snapshots[identifier]
+        return f'<DBSnapshot><DBSnapshotIdentifier>{escape(identifier)}</DBSnapshotIdentifier></DBSnapshot>'
+
+    def _rds_DeleteDBClusterSnapshot(self, resources, params, account_number):
+        identifier = params.get('DBClusterSnapshotIdentifier')
+        if resources.rds_snapshots.get(identifier) != 'cluster':
+            raise FakeError('DBClusterSnapshotNotFoundFault', 404)
+        del resources.rds_snapshots[identifier]
+        return f'<DBClusterSnapshot><DBClusterSnapshotIdentifier>{escape(identifier)}' \
+               f'</DBClusterSnapshotIdentifier></DBClusterSnapshot>'
+
+    # STS
+
+    def _sts_GetCallerIdentity(self, resources, params, account_number):
+        return f'<Arn>arn:aws:iam::{account_number}:user/benchmark</Arn><UserId>BENCHMARK</UserId>' \
+               f'<Account>{account_number}</Account>'
+
+
+class FakeAwsHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, so clients reuse their connections as they do against AWS
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        params = dict(urllib.parse.parse_qsl(body, keep_blank_values=True))
+        match = CREDENTIAL_PATTERN.search(self.headers.get('Authorization', ''))
+        access_key, region_name, service = match.groups() if match else ('', 'us-east-1', 'ec2')
+        # Access keys are 'BENCH' and the account number
+        status, text = self.server.fake.handle(service, access_key[5:], region_name, params)
+        data = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_server(fake):
+    # Serve fake on a free local port in a daemon thread. Returns the server and its endpoint URL.
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeAwsHandler)
+    server.daemon_threads = True
+    server.fake = fake
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
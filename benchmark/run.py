@@ -0,0 +1,336 @@
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import benchmark.fake_aws as fa
+import modules.batch_input as bi
+import modules.journal as jn
+import modules.log_pipeline as lp
+import modules.metrics as mt
+import modules.process_clients as pc
+import modules.session_pool as sp
+
+# Peak memory is read from the OS; the resource module does not exist on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Same keys and names as main.resources_dict
+RESOURCES = {
+    '1': 'Old EC2 Image',
+    '2': 'EC2 Image Not Associated',
+    '3': 'EC2 Old Snapshots',
+    '4': 'Unattached Elastic IPs',
+    '5': 'Unattached EBS Volumes',
+    '6': 'RDS Old Snapshots'
+}
+
+# Engine and workers of each mode
+MODES = {
+    'threads-1': ('threads', 1),
+    'threads-8': ('threads', 8),
+    'async': ('async', 8)
+}
+
+REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'eu-west-1', 'eu-central-1', 'ap-southeast-1',
+           'ap-southeast-2']
+RUN_DATE_TIME = '20000101_000000'
+
+# Share of images that also use the previous image's snapshot, and of volumes and IPs still in use
+SHARED_SNAPSHOT_RATE = 0.1
+IN_USE_RATE = 0.02
+
+
+def generate(scale, resource_keys, client_count, account_count, region_count, missing_rate, seed):
+    # Build synthetic clients and scale resource IDs spread evenly over the clients, resource types, accounts and
+    # regions. A share of the IDs do not exist anywhere, as in real exports. Returns the clients, the resources to
+    # load into the fake service as (account, region, kind, arguments) and the ID list of each client and type.
+    rng = random.Random(seed)
+    counter = iter(range(1, 10 ** 9))
+    clients = {}
+    population = []
+    id_lists = {}
+
+    for client_index in range(client_count):
+        client_key = f'b{client_index + 1}'
+        profiles = []
+        for account_index in range(account_count):
+            account_number = f'{client_index + 1:06d}{account_index + 1:06d}'
+            profiles.append({'account_name': f'Benchmark {account_index + 1}',
+                             'profile_name': f'Benchmark{account_number}',
+                             'account_number': account_number,
+                             'region': REGIONS[:region_count],
+                             'tenant_id': 'benchmark',
+                             'app_id_uri': 'benchmark'})
+        clients[client_key] = {'name': f'Benchmark{client_index + 1}', 'login': 'aal', 'profiles': profiles}
+        scopes = [(profile['account_number'], region) for profile in profiles for region in profile['region']]
+
+        id_lists[client_key] = {}
+        for key in resource_keys:
+            ids = []
+            previous_snapshot = None
+            for index in range(scale // (client_count * len(resource_keys))):
+                number = next(counter)
+                scope = scopes[index % len(scopes)]
+                exists = rng.random() >= missing_rate
+                if key in ('1', '2'):
+                    resource_id = f'ami-{number:017x}'
+                    snapshot_ids = [f'snap-{next(counter):017x}']
+                    if previous_snapshot is not None and rng.random() < SHARED_SNAPSHOT_RATE:
+                        snapshot_ids.append(previous_snapshot)
+                    previous_snapshot = snapshot_ids[0] if exists else None
+                    arguments = (resource_id, snapshot_ids)
+                    kind = 'image'
+                elif key == '3':
+                    resource_id = f'snap-{number:017x}'
+                    arguments = (resource_id,)
+                    kind = 'snapshot'
+                elif key == '4':
+                    resource_id = f'10.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}'
+                    association_id = f'eipassoc-{number:017x}' if rng.random() < IN_USE_RATE else None
+                    arguments = (resource_id, f'eipalloc-{number:017x}', association_id)
+                    kind = 'address'
+                elif key == '5':
+                    resource_id = f'vol-{number:017x}'
+                    arguments = (resource_id, 'in-use' if rng.random() < IN_USE_RATE else 'available')
+                    kind = 'volume'
+                else:
+                    resource_id = f'benchmark-{"cluster-" if number % 2 else ""}snapshot-{number}'
+                    arguments = (resource_id, 'cluster' if number % 2 else 'instance')
+                    kind = 'rds'
+                ids.append(resource_id)
+                if exists:
+                    population.append(scope + (kind, arguments))
+            id_lists[client_key][key] = ids
+
+    return clients, population, id_lists
+
+
+def populate(fake, population):
+    fake.reset()
+    for account_number, region_name, kind, arguments in population:
+        resources = fake.region(account_number, region_name)
+        if kind == 'image':
+            resources.add_image(*arguments)
+        elif kind == 'snapshot':
+            resources.snapshots[arguments[0]] = 'completed'
+        elif kind == 'address':
+            resources.add_address(*arguments)
+        elif kind == 'volume':
+            resources.volumes[arguments[0]] = arguments[1]
+        else:
+            resources.rds_snapshots[arguments[0]] = arguments[1]
+    return
+
+
+def write_scenario(work_directory, clients, id_lists, scenario):
+    # Write the clients file, credentials, ID exports and batch file a scenario process runs from
+    with open(os.path.join(work_directory, 'clients.json'), 'w') as file:
+        json.dump(clients, file, indent=4)
+
+    # Access keys carry the account number, which is how the fake service tells accounts apart
+    with open(os.path.join(work_directory, 'credentials'), 'w') as file:
+        for client in clients.values():
+            for profile in client['profiles']:
+                file.write(f'[{profile["profile_name"]}]\naws_access_key_id = BENCH{profile["account_number"]}\n'
+                           f'aws_secret_access_key = benchmark\n')
+    open(os.path.join(work_directory, 'config'), 'w').close()
+
+    os.makedirs(os.path.join(work_directory, 'sources'), exist_ok=True)
+    sources = {}
+    for client_key, lists in id_lists.items():
+        sources[client_key] = {}
+        for key, ids in lists.items():
+            path = os.path.join('sources', f'{client_key} {key}.csv')
+            with open(os.path.join(work_directory, path), 'w') as file:
+                file.write(bi.ID_COLUMNS[key][0] + '\n' + '\n'.join(ids) + '\n')
+            sources[client_key][key] = path
+
+    with open(os.path.join(work_directory, 'batch.json'), 'w') as file:
+        json.dump({'clients': list(clients), 'resources': list(next(iter(id_lists.values()))), 'dry_run': False,
+                   'sources': sources}, file, indent=4)
+    with open(os.path.join(work_directory, 'scenario.json'), 'w') as file:
+        json.dump(scenario, file, indent=4)
+    return
+
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_scenario(work_directory):
+    # Run process_clients the way a batch run does, in its own process so peak memory covers one scenario only
+    with open(os.path.join(work_directory, 'scenario.json')) as file:
+        scenario = json.load(file)
+    os.chdir(work_directory)
+    sp.ENDPOINT_URL = scenario['endpoint_url']
+    # Logged as main.py does, without the console, whose output the parent reads
+    logger = logging.getLogger('2wchclean')
+    lp.start(logger, 'benchmark.jsonl', getattr(logging, scenario['log_level']), stream=None)
+
+    with open('clients.json') as file:
+        clients = json.load(file)
+    client_keys, resource_keys, dry_run, id_sources = bi.load_manifest('batch.json', clients, RESOURCES)
+    for key in client_keys:
+        os.makedirs(f'{clients[key]["name"]}_{RUN_DATE_TIME}', exist_ok=True)
+    three_months = (datetime.now() - timedelta(days=90)).strftime('%Y-%m-%d')
+    journal = jn.Journal(RUN_DATE_TIME)
+
+    start = time.perf_counter()
+    result = pc.process_clients(clients, client_keys, resource_keys, RESOURCES, dry_run, RUN_DATE_TIME,
+                                three_months, logger, scenario['workers'], scenario['engine'],
+                                scenario['max_in_flight'], journal, False, id_sources)
+    wall_time = time.perf_counter() - start
+    journal.close()
+
+    calls = mt.summary()['calls']
+    deletes = sum(result[2:])
+    return {'wall_time': round(wall_time, 3),
+            'api_calls': sum(call['calls'] for call in calls),
+            'throttles': sum(call['throttles'] for call in calls),
+            'peak_memory_mb': peak_memory_mb(),
+            'deletes': deletes,
+            'deletes_per_second': round(deletes / wall_time, 1) if wall_time else None}
+
+
+def run_mode(fake, endpoint_url, scale, mode, generated, args):
+    clients, population, id_lists = generated
+    engine, workers = MODES[mode]
+    work_directory = tempfile.mkdtemp(prefix=f'benchmark_{scale}_{mode}_')
+    populate(fake, population)
+    write_scenario(work_directory, clients, id_lists,
+                   {'endpoint_url': endpoint_url, 'engine': engine, 'workers': workers,
+                    'max_in_flight': args.max_in_flight, 'log_level': args.log_level})
+
+    # The scenario only sees the benchmark's credentials and profiles
+    env = {name: value for name, value in os.environ.items() if not name.startswith('AWS_')}
+    env['AWS_SHARED_CREDENTIALS_FILE'] = os.path.join(work_directory, 'credentials')
+    env['AWS_CONFIG_FILE'] = os.path.join(work_directory, 'config')
+    process = subprocess.run([sys.executable, '-m', 'benchmark.run', '--scenario', work_directory],
+                             cwd=REPOSITORY_DIRECTORY, env=env, capture_output=True, text=True)
+
+    if process.returncode != 0:
+        result = {'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'failed'}
+    else:
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        result['service_calls'] = sum(fake.calls.values())
+        result['throttled'] = fake.throttled
+    if args.keep:
+        result['work_directory'] = work_directory
+    else:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    return {'scale': scale, 'mode': mode, **result}
+
+
+def change(value, baseline_value):
+    if value is None or not baseline_value:
+        return ''
+    return f'{(value - baseline_value) / baseline_value * 100:+.0f}%'
+
+
+def report(results, baseline):
+    baseline_results = {(result['scale'], result['mode']): result for result in baseline.get('results', [])}
+    print(f'\n{"scale":>8}  {"mode":<10}{"wall s":>9}{"API calls":>11}{"throttled":>11}{"peak MB":>9}'
+          f'{"deletes":>9}{"deletes/s":>11}' + ('   vs baseline (wall, calls)' if baseline else ''))
+    for result in results:
+        if 'error' in result:
+            print(f'{result["scale"]:>8}  {result["mode"]:<10}  {result["error"]}')
+            continue
+        line = f'{result["scale"]:>8}  {result["mode"]:<10}{result["wall_time"]:>9.2f}{result["api_calls"]:>11}' \
+               f'{result["throttled"]:>11}{result["peak_memory_mb"] or "n/a":>9}{result["deletes"]:>9}' \
+               f'{result["deletes_per_second"] or 0:>11.1f}'
+        previous = baseline_results.get((result['scale'], result['mode']))
+        if previous is not None and 'error' not in previous:
+            line += f'   {change(result["wall_time"], previous["wall_time"]):>6}, ' \
+                    f'{change(result["api_calls"], previous["api_calls"]):>6}'
+        print(line)
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark process_clients and the deletion engines against a '
+                                                 'local stand-in for EC2, RDS and STS.')
+    parser.add_argument('--scales', default='1000,10000,100000',
+                        help='Comma-separated numbers of resource IDs per run (default: 1000,10000,100000).')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help=f'Comma-separated modes to run, out of {", ".join(MODES)} (default: all).')
+    parser.add_argument('--resources', default='1,3,4,5,6',
+                        help='Comma-separated resource keys to generate IDs for (default: 1,3,4,5,6).')
+    parser.add_argument('--clients', type=int, default=1, help='Number of synthetic clients (default: 1).')
+    parser.add_argument('--accounts', type=int, default=2, help='Accounts per client (default: 2).')
+    parser.add_argument('--regions', type=int, default=4, choices=range(1, len(REGIONS) + 1), metavar='N',
+                        help=f'Regions per account, 1 to {len(REGIONS)} (default: 4).')
+    parser.add_argument('--latency', type=float, default=20.0,
+                        help='Latency of every fake API call in milliseconds (default: 20).')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='Share of delete calls answered with a throttling error (default: 0).')
+    parser.add_argument('--missing-rate', type=float, default=0.05,
+                        help='Share of IDs that do not exist in any account or region (default: 0.05).')
+    parser.add_argument('--max-in-flight', type=int, default=200,
+                        help='Maximum API requests in flight with the async engine (default: 200).')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING'],
+                        help='Level of the scenario log file. main.py logs at DEBUG (default: INFO).')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data (default: 0).')
+    parser.add_argument('--output', metavar='FILE', help='Write the results to FILE as JSON, e.g. as a baseline.')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare wall time and API calls with a saved run.')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory of every scenario.')
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario is not None:
+        print(json.dumps(run_scenario(args.scenario)))
+        return
+
+    modes = [mode for mode in args.modes.split(',') if mode]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        parser.error(f'unknown modes: {", ".join(unknown)}')
+    if 'async' in modes and importlib.util.find_spec('aiobotocore') is None:
+        print('aiobotocore is not installed; skipping the async mode.')
+        modes.remove('async')
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    fake = fa.FakeAws(args.latency / 1000, args.throttle_rate, args.seed)
+    server, endpoint_url = fa.start_server(fake)
+    resource_keys = [key for key in args.resources.split(',') if key]
+    results = []
+    try:
+        for scale in [int(scale) for scale in args.scales.split(',') if scale]:
+            generated = generate(scale, resource_keys, args.clients, args.accounts, args.regions, args.missing_rate,
+                                 args.seed)
+            for mode in modes:
+                print(f'Running {mode} with {scale} IDs...', flush=True)
+                results.append(run_mode(fake, endpoint_url, scale, mode, generated, args))
+    finally:
+        server.shutdown()
+
+    report(results, baseline)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump({'settings': {name: value for name, value in vars(args).items()
+                                    if name not in ('scenario', 'output', 'baseline', 'keep')},
+                       'results': results}, file, indent=2)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,104 @@
 import modules.process_clients as pc
+import modules.journal as jn
+import modules.batch_input as bi
+import modules.deletion_plan as dp
+import modules.circuit_breaker as cb
+import modules.inventory_cache as ivc
+import modules.metrics as mt
+import modules.log_pipeline as lp
+import modules.worker_farm as wf
+import modules.work_queue as wq
 from src.banner import banner
 from datetime import datetime, timedelta
 import os
 import sys
 import logging
 import json
-import easygui as eg
-
-run_date_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-
+import argparse
+
+# Batch runs never open a dialog, so they run on machines without easygui or tkinter
+try:
+    import easygui as eg
+except ImportError:
+    eg = None
+
+parser = argparse.ArgumentParser(description='2nd Watch Cloud Health resource deletion program.')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of regions and accounts to process concurrently (default: 1).')
+parser.add_argument('--engine', choices=['threads', 'async'], default='threads',
+                    help='Deletion engine. "async" runs every region as coroutines and requires aiobotocore '
+                         '(default: threads).')
+parser.add_argument('--max-in-flight', type=int, default=200,
+                    help='Maximum number of API requests in flight at once with the async engine (default: 200).')
+parser.add_argument('--resume', metavar='RUN_ID',
+                    help='Resume an interrupted run from its journal. RUN_ID is the date and time the client '
+                         'directories of that run are appended with, e.g. 20240131_142500.')
+parser.add_argument('--batch', metavar='BATCH_FILE',
+                    help='Run without dialogs. BATCH_FILE is a JSON file naming the clients, resource types, '
+                         'dry_run setting and the CSV, XLSX or JSON exports to read resource IDs from. '
+                         'With --resume, the interrupted run\'s selections are used instead.')
+parser.add_argument('--call-budget', type=float, metavar='CALLS',
+                    help='Maximum AWS API calls per resource ID for each resource type. Resource types over the '
+                         'budget are reported, and a batch run exits with status 2.')
+parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING'], default='DEBUG',
+                    help='Lowest level written to the log file. Messages below it are never formatted '
+                         '(default: DEBUG).')
+parser.add_argument('--console-sample', type=int, default=lp.SAMPLE_RATE, metavar='N',
+                    help='Show one in N per-resource-ID lines on the console. Every line is still written to the '
+                         f'log file (default: {lp.SAMPLE_RATE}).')
+parser.add_argument('--farm', type=int, default=0, metavar='N',
+                    help='Queue every client, account, region and resource type as a work unit and run them in N '
+                         'worker processes. The threaded engine runs inside each unit.')
+parser.add_argument('--worker', metavar='QUEUE_FILE',
+                    help='Join a --farm run as a worker, e.g. from another machine sharing this directory. '
+                         'QUEUE_FILE is the run\'s farm/run_<RUN_ID>.sqlite file.')
+parser.add_argument('--verify', action='store_true',
+                    help='After each region, poll in bulk until every resource deleted in it is gone, and record '
+                         'the ones still present in a stragglers file.')
+parser.add_argument('--apply', metavar='PLAN_FILE',
+                    help='Delete the resources in a plan file without dialogs. Every dry run writes one to '
+                         'plans/plan_<RUN_ID>.json. Only the planned resources are checked again before deletion.')
+parser.add_argument('--inventory-ttl', type=int, default=ivc.TTL, metavar='SECONDS',
+                    help='Reuse the region inventories of earlier runs taken within SECONDS, from '
+                         f'{ivc.CACHE_PATH}, instead of listing the regions again. 0 turns the cache off '
+                         f'(default: {ivc.TTL}).')
+parser.add_argument('--region-deadline', type=int, default=cb.DEADLINE, metavar='SECONDS',
+                    help='Seconds each region gets for its inventory, and again for each window of deletions, '
+                         'before the rest of its calls are skipped and its IDs left for a later run. 0 means no '
+                         f'deadline (default: {cb.DEADLINE}).')
+args = parser.parse_args()
+
+# Read by the region inventories and breakers, and handed to the workers of a farm run in the queue's settings
+ivc.TTL = max(args.inventory_ttl, 0)
+cb.DEADLINE = max(args.region_deadline, 0)
+
+# A resumed run keeps the run ID of the interrupted run, so it continues in the same directories and log file
+run_date_time = args.resume or datetime.now().strftime("%Y%m%d_%H%M%S")
+log_path = f'log/2wchclean_{run_date_time}.jsonl'
+
+# A worker belongs to the run that queued its units and logs to a file of its own
+if args.worker is not None:
+    run_date_time = wq.WorkQueue(args.worker).settings()['run_date_time']
+    log_path = f'log/2wchclean_{run_date_time}_{wf.worker_name()}.jsonl'
+
+# Records are written by a background thread: JSON lines to the log file, which a resumed run appends to, and a
+# sampled view to the console
 logger = logging.getLogger('2wchclean')
-logging.basicConfig(level=logging.DEBUG,
-                    filename=f'log/2wchclean_{run_date_time}.log',
-                    filemode='a')
-console = logging.StreamHandler(sys.stdout)
-console.setLevel(logging.INFO)
-logger.addHandler(console)
+lp.start(logger, log_path, getattr(logging, args.log_level), args.console_sample)
 
 with open('src/clients.json') as cl:
     cl_txt = cl.read()
 clients_dict = json.loads(cl_txt)
 
+resources_dict = {
+    '1': 'Old EC2 Image',
+    '2': 'EC2 Image Not Associated',
+    '3': 'EC2 Old Snapshots',
+    '4': 'Unattached Elastic IPs',
+    '5': 'Unattached EBS Volumes',
+    '6': 'RDS Old Snapshots'
+}
+
 
 # Subtract 90 days from a given date
 def convert_date(date_string):
@@ -53,7 +131,111 @@ def create_directories(choices):
     return
 
 
-def main(clients):
+def create_summary(end_msg, accounts_not_logged_in, clients_not_logged_in, ips, images, snapshots, volumes,
+                   rds_snaps):
+    return f'{end_msg}' \
+           f'\n\nSummary:' \
+           f'\nIPs released: {ips}' \
+           f'\nImages deregistered: {images}' \
+           f'\nEBS snapshots deleted: {snapshots}' \
+           f'\nVolumes deleted: {volumes}' \
+           f'\nRDS snapshots deleted: {rds_snaps}' \
+           f'\n\nAccounts not logged into: {accounts_not_logged_in}' \
+           f'\n\nClients not logged into: {clients_not_logged_in}' \
+           f'\n\nClient directories for this run are appended with {run_date_time}.' \
+           f'\n\nThe log file can be found in the <log> directory.'
+
+
+def report_metrics(call_budget):
+    # Write the run's API call metrics. Returns False when a resource type used more calls per ID than the budget.
+    json_path, prometheus_path = mt.write_reports(run_date_time)
+    logger.info(f'\nAPI call metrics written to {json_path} and {prometheus_path}.')
+    if call_budget is None:
+        return True
+
+    over_budget = mt.check_budget(call_budget)
+    for resource_name, calls, id_count in over_budget:
+        logger.info(f'{resource_name}: {calls} API calls for {id_count} IDs is over the budget of {call_budget} '
+                    f'calls per ID.')
+    return not over_budget
+
+
+def run_clients(client_keys, resource_keys, dry_run, three_months, max_workers, engine, max_in_flight, journal,
+                resume, id_sources, farm_workers, verify, plan=None):
+    # Run the selected clients in this process, or with --farm as queued work units in worker processes
+    if farm_workers:
+        results = wf.process_clients(clients_dict, client_keys, resource_keys, resources_dict, dry_run, run_date_time,
+                                     three_months, logger, farm_workers, resume, id_sources, verify, plan)
+    else:
+        results = pc.process_clients(clients_dict, client_keys, resource_keys, resources_dict, dry_run, run_date_time,
+                                     three_months, logger, max_workers, engine, max_in_flight, journal, resume,
+                                     id_sources, verify, plan)
+
+    # A dry run's findings become a plan that a later run deletes without searching for everything again
+    if dry_run:
+        dp.write_plan(clients_dict, client_keys, resource_keys, resources_dict, run_date_time, logger)
+    return results
+
+
+def run_worker(queue_file):
+    # Run units of a --farm run until none are left; the coordinator merges their results into its summary
+    wf.run_worker(queue_file, clients_dict, resources_dict, logger)
+    json_path, prometheus_path = mt.write_reports(f'{run_date_time}_{wf.worker_name()}')
+    logger.info(f'\nAPI call metrics written to {json_path} and {prometheus_path}.')
+    return
+
+
+def select_run(client_choices, resource_choices):
+    # TODO: remove warning message once SSO is integrated.
+
+    selected_clients = eg.multchoicebox('Select one or multiple clients by left-clicking.'
+                                        '\n\nClick the <Cancel> button to exit.'
+                                        '\n\nWARNING:'
+                                        '\nDo not run for Sysco or Pathward at this time.',
+                                        'Client Selection', client_choices, preselect=None)
+    if selected_clients is None:
+        logger.info(f'\nExiting application.')
+        sys.exit(0)
+
+    client_keys, client_names = parse_selection(selected_clients)
+    # logger.info(f'Client keys: {client_keys}')
+    logger.info(f'You are running the program for: {client_names}')
+
+    # Create directories for selected clients
+    logger.info('Creating directories for client(s)...')
+    create_directories(client_names)
+
+    selected_resources = eg.multchoicebox('Select one or multiple resources by left-clicking.'
+                                          '\n\nClick the <Cancel> button to exit.',
+                                          'Resource Selection', resource_choices, preselect=None)
+    if selected_resources is None:
+        logger.info(f'\nExiting application.')
+        sys.exit(0)
+
+    resource_keys, resource_names = parse_selection(selected_resources)
+    # logger.info(f'Resource keys: {resource_keys}')
+    logger.info(f'\nYou are deleting the following resources: {resource_names}')
+
+    # Returns True for Dry Run and False for Delete Stuff
+    dry_run = eg.ccbox('! ! !   IMPORTANT   ! ! !'
+                       '\n\nIf you are TESTING, click the <Dry Run> button.'
+                       '\n\nIf you intend to actually delete resources, click the <Delete Stuff> button.'
+                       '\n\nYour selection will show in the next window. If you click the wrong button by mistake, '
+                       'you will be able to exit the program and try again.',
+                       title='Dry Run/Delete Stuff', choices=['Dry Run', 'Delete Stuff'], cancel_choice='Dry Run')
+    if dry_run is None:
+        logger.info(f'\nExiting application.')
+        sys.exit(0)
+
+    return client_keys, client_names, resource_keys, resource_names, dry_run
+
+
+def main(clients, max_workers=1, engine='threads', max_in_flight=200, resume=False, call_budget=None,
+         farm_workers=0, verify=False):
+    if eg is None:
+        logger.info('\nThe dialogs require easygui. Install it, or run without dialogs with --batch.')
+        sys.exit(1)
+
     print(banner)
     logger.info('\nWelcome to the 2nd Watch Cloud Health resource deletion program.\n')
     # Welcome message box
@@ -73,62 +255,29 @@ def main(clients):
     for key, value in clients.items():
         client_choices.append(f'{key} {value["name"]}')
 
-    resources_dict = {
-        '1': 'Old EC2 Image',
-        '2': 'EC2 Image Not Associated',
-        '3': 'EC2 Old Snapshots',
-        '4': 'Unattached Elastic IPs',
-        '5': 'Unattached EBS Volumes',
-        '6': 'RDS Old Snapshots'
-    }
-
     resource_choices = []
     for key, value in resources_dict.items():
         resource_choices.append(f'{key} {value}')
     # logger.info(resource_choices)
 
-    while 1:
-
-        # TODO: remove warning message once SSO is integrated.
-
-        selected_clients = eg.multchoicebox('Select one or multiple clients by left-clicking.'
-                                            '\n\nClick the <Cancel> button to exit.'
-                                            '\n\nWARNING:'
-                                            '\nDo not run for Sysco or Pathward at this time.',
-                                            'Client Selection', client_choices, preselect=None)
-        if selected_clients is None:
-            logger.info(f'\nExiting application.')
-            sys.exit(0)
+    journal = jn.Journal(run_date_time)
 
-        client_keys, client_names = parse_selection(selected_clients)
-        # logger.info(f'Client keys: {client_keys}')
-        logger.info(f'You are running the program for: {client_names}')
-
-        # Create directories for selected clients
-        logger.info('Creating directories for client(s)...')
-        create_directories(client_names)
-
-        selected_resources = eg.multchoicebox('Select one or multiple resources by left-clicking.'
-                                              '\n\nClick the <Cancel> button to exit.',
-                                              'Resource Selection', resource_choices, preselect=None)
-        if selected_resources is None:
-            logger.info(f'\nExiting application.')
-            sys.exit(0)
+    while 1:
 
-        resource_keys, resource_names = parse_selection(selected_resources)
-        # logger.info(f'Resource keys: {resource_keys}')
-        logger.info(f'\nYou are deleting the following resources: {resource_names}')
-
-        # Returns True for Dry Run and False for Delete Stuff
-        dry_run = eg.ccbox('! ! !   IMPORTANT   ! ! !'
-                           '\n\nIf you are TESTING, click the <Dry Run> button.'
-                           '\n\nIf you intend to actually delete resources, click the <Delete Stuff> button.'
-                           '\n\nYour selection will show in the next window. If you click the wrong button by mistake, '
-                           'you will be able to exit the program and try again.',
-                           title='Dry Run/Delete Stuff', choices=['Dry Run', 'Delete Stuff'], cancel_choice='Dry Run')
-        if dry_run is None:
-            logger.info(f'\nExiting application.')
-            sys.exit(0)
+        if resume:
+            run_info = journal.run_info()
+            if run_info is None:
+                logger.info(f'\nNo journal found for run {run_date_time}. Exiting application.')
+                sys.exit(1)
+
+            client_keys, resource_keys, dry_run = run_info
+            client_names = [clients[key]['name'] for key in client_keys]
+            resource_names = [resources_dict[key] for key in resource_keys]
+            logger.info(f'Resuming run {run_date_time} for: {client_names}'
+                        f'\n\nYou are deleting the following resources: {resource_names}')
+        else:
+            client_keys, client_names, resource_keys, resource_names, dry_run = select_run(client_choices,
+                                                                                         resource_choices)
 
         if dry_run:
             ready_msg = 'You have selected to perform a DRY RUN. No resources will be deleted.'
@@ -150,10 +299,16 @@ def main(clients):
             logger.info(f'\nExiting application.')
             sys.exit(0)
 
+        # Record the selections first, so the run can be resumed with --resume if it is interrupted
+        if not resume:
+            journal.start_run(client_keys, resource_keys, dry_run)
+
         process_result, clients_not_logged_in, ips, images, \
-            snapshots, volumes, rds_snaps, = pc.process_clients(clients_dict, client_keys, resource_keys,
-                                                                resources_dict, dry_run, run_date_time,
-                                                                three_months, logger)
+            snapshots, volumes, rds_snaps, = run_clients(client_keys, resource_keys, dry_run, three_months,
+                                                         max_workers, engine, max_in_flight, journal, resume, None,
+                                                         farm_workers, verify)
+        journal.close()
+        report_metrics(call_budget)
 
         if process_result == 1:
 
@@ -168,33 +323,100 @@ def main(clients):
         else:
 
             # At least one login was successful; displays any logins that did not succeed
-            logger.info(f'\n{end_msg}'
-                        f'\n\nSummary:'
-                        f'\nIPs released: {ips}'
-                        f'\nImages deregistered: {images}'
-                        f'\nEBS snapshots deleted: {snapshots}'
-                        f'\nVolumes deleted: {volumes}'
-                        f'\nRDS snapshots deleted: {rds_snaps}'
-                        f'\n\nAccounts not logged into: {process_result}'
-                        f'\n\nClients not logged into: {clients_not_logged_in}'
-                        f'\n\nClient directories for this run are appended with {run_date_time}.'
-                        f'\n\nThe log file can be found in the <log> directory.')
-
-            eg.msgbox(f'{end_msg}'
-                      f'\n\nSummary:'
-                      f'\nIPs released: {ips}'
-                      f'\nImages deregistered: {images}'
-                      f'\nEBS snapshots deleted: {snapshots}'
-                      f'\nVolumes deleted: {volumes}'
-                      f'\nRDS snapshots deleted: {rds_snaps}'
-                      f'\n\nAccounts not logged into: {process_result}'
-                      f'\n\nClients not logged into: {clients_not_logged_in}'
-                      f'\n\nClient directories for this run are appended with {run_date_time}.'
-                      f'\n\nThe log file can be found in the <log> directory.'
+            summary_msg = create_summary(end_msg, process_result, clients_not_logged_in, ips, images, snapshots,
+                                         volumes, rds_snaps)
+            logger.info(f'\n{summary_msg}')
+
+            eg.msgbox(f'{summary_msg}'
                       f'\n\nClick the <Exit> button to exit the program.',
                       'Resource Deletion Result', ok_button='Exit')
 
         return
 
 
-main(clients_dict)
+def run_batch(clients, batch_path, max_workers=1, engine='threads', max_in_flight=200, resume=False,
+              call_budget=None, farm_workers=0, verify=False, plan_path=None):
+    # Same run as main() without any dialogs, so large backlogs can be scheduled unattended
+    print(banner)
+    logger.info('\nStarting the 2nd Watch Cloud Health resource deletion program in batch mode.\n')
+
+    # Get today's date and transform to three-month date
+    today = datetime.now().strftime('%Y-%m-%d')
+    three_months = convert_date(today)
+
+    journal = jn.Journal(run_date_time)
+    id_sources = None
+    plan = None
+
+    # A plan names its own clients and resource types, and applying it always deletes
+    if plan_path is not None:
+        try:
+            plan = dp.load_plan(plan_path, clients, resources_dict)
+        except (OSError, ValueError, KeyError) as e:
+            logger.info(f'\nUnable to read plan file {plan_path}: {e}'
+                        f'\nExiting application.')
+            sys.exit(1)
+        logger.info(f'Applying plan {plan_path} of {len(plan["rows"])} resources, written by the dry run '
+                    f'{plan["run"]} at {plan["created"]}.')
+
+    if resume:
+        run_info = journal.run_info()
+        if run_info is None:
+            logger.info(f'\nNo journal found for run {run_date_time}. Exiting application.')
+            sys.exit(1)
+        client_keys, resource_keys, dry_run = run_info
+    elif plan is not None:
+        client_keys, resource_keys, dry_run = plan['clients'], plan['resources'], False
+    else:
+        try:
+            client_keys, resource_keys, dry_run, id_sources = bi.load_manifest(batch_path, clients, resources_dict)
+        except (OSError, ValueError) as e:
+            logger.info(f'\nUnable to read batch file {batch_path}: {e}'
+                        f'\nExiting application.')
+            sys.exit(1)
+
+    client_names = [clients[key]['name'] for key in client_keys]
+    resource_names = [resources_dict[key] for key in resource_keys]
+    logger.info(f'You are running the program for: {client_names}'
+                f'\n\nYou are deleting the following resources: {resource_names}')
+
+    if not resume:
+        logger.info('Creating directories for client(s)...')
+        create_directories(client_names)
+        journal.start_run(client_keys, resource_keys, dry_run)
+
+    if dry_run:
+        logger.info('\nThis is a DRY RUN. No resources will be deleted.')
+        end_msg = 'This was a DRY RUN. No resources were deleted.'
+    else:
+        logger.info('\n! ! ! This run will DELETE RESOURCES. ! ! !')
+        end_msg = 'The resource deletion process is complete.'
+
+    process_result, clients_not_logged_in, ips, images, \
+        snapshots, volumes, rds_snaps, = run_clients(client_keys, resource_keys, dry_run, three_months, max_workers,
+                                                     engine, max_in_flight, journal, resume, id_sources,
+                                                     farm_workers, verify, plan)
+    journal.close()
+    within_budget = report_metrics(call_budget)
+
+    if process_result == 1:
+        logger.info('\nNo successful logins recorded. No resources were deleted.')
+        sys.exit(1)
+
+    summary_msg = create_summary(end_msg, process_result, clients_not_logged_in, ips, images, snapshots, volumes,
+                                 rds_snaps)
+    logger.info(f'\n{summary_msg}')
+
+    if not within_budget:
+        sys.exit(2)
+    return
+
+
+if args.worker is not None:
+    run_worker(args.worker)
+elif args.batch is not None or args.apply is not None:
+    run_batch(clients_dict, args.batch, max(args.workers, 1), args.engine, max(args.max_in_flight, 1),
+              args.resume is not None, args.call_budget, max(args.farm, 0), args.verify, args.apply)
+else:
+    main(clients_dict, max(args.workers, 1), args.engine, max(args.max_in_flight, 1), args.resume is not None,
+         args.call_budget, max(args.farm, 0), args.verify)
@@ -0,0 +1,455 @@
+import asyncio
+import random
+import botocore.exceptions
+import modules.chunks as chunks
+import modules.circuit_breaker as cb
+import modules.delete_ec2_snapshots as des
+import modules.delete_images as di
+import modules.delete_rds_snapshots as drs
+import modules.delete_volumes as dv
+import modules.errors as er
+import modules.inventory as inv
+import modules.ip_catalog as ic
+import modules.log_pipeline as lp
+import modules.metrics as mt
+import modules.permission_probe as pp
+import modules.rds_catalog as rc
+import modules.rate_limiter as rl
+import modules.release_ips as ri
+import modules.verify_deletions as vf
+
+# aiobotocore is only needed for the async engine, so the threaded engine runs without it
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:
+    AioConfig = None
+    get_session = None
+
+# Connections each client keeps open. Mutating calls are also bounded by their scope's rate limiter, and every call
+# by the run-wide limit.
+POOL_CONNECTIONS = 40
+
+# The describe, noun, sorting, delete operation, ID parameter and dry run report of the EBS resource keys
+EBS_RESOURCES = {
+    '3': (des.DESCRIBE, 'snapshots', des.sort_snapshots, 'delete_snapshot', 'SnapshotId', des.record_dry_run),
+    '5': (dv.DESCRIBE, 'volumes', dv.sort_volumes, 'delete_volume', 'VolumeId', dv.record_dry_run)
+}
+
+
+async def acquire(limiter):
+    # RateLimiter.acquire, sleeping on the event loop instead of blocking it
+    while True:
+        wait = limiter.try_acquire()
+        if not wait:
+            return
+        await asyncio.sleep(wait)
+
+
+async def call(client, operation, limiter, run_semaphore, **kwargs):
+    # RateLimiter.call for one awaited mutating call, also under the run-wide limit. The scope's limiter is the one
+    # the threaded engine uses, so throttles and successes adapt its rate and in-flight limit in the same way.
+    for attempt in range(rl.MAX_ATTEMPTS):
+        error = limiter.check(operation)
+        if error is not None:
+            raise error
+        await acquire(limiter)
+        throttled = False
+        try:
+            async with run_semaphore:
+                return await getattr(client, operation)(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            throttled = er.classify(e) == er.THROTTLED
+            if not throttled or attempt == rl.MAX_ATTEMPTS - 1:
+                raise
+        finally:
+            limiter.release(throttled)
+        await asyncio.sleep(random.uniform(0, min(rl.BACKOFF_CAP, rl.BACKOFF_BASE * 2 ** attempt)))
+
+
+async def try_delete(client, operation, resource_id, limiter, run_semaphore, logger, **kwargs):
+    logger.info('   Trying %s of %s...', operation, resource_id, extra=lp.DETAIL)
+    deleted = False
+    try:
+        response = await call(client, operation, limiter, run_semaphore, **kwargs)
+        logger.debug('      %s', response)
+        deleted = True
+    except er.AWS_ERRORS as e:
+        category = er.classify(e)
+        # Calls skipped by an open circuit are reported once for the region instead
+        if category != er.CIRCUIT_OPEN:
+            logger.info('      %s: %s', category, e, extra=lp.DETAIL)
+
+    return deleted
+
+
+async def probe(client, operation, resource_ids, account_number, region_name, limiter, run_semaphore, logger, params):
+    # permission_probe.probe, awaiting the DryRun calls. params(resource_id) returns the arguments of one resource's
+    # call.
+    failures = {}
+    verdict = pp.cached_probe(account_number, region_name, operation)
+    if verdict is not None or not resource_ids:
+        return verdict or (pp.UNPROBED, None), failures
+
+    for resource_id in resource_ids[:pp.MAX_PROBES]:
+        try:
+            await call(client, operation, limiter, run_semaphore, DryRun=True, **params(resource_id))
+            error = None
+        except er.AWS_ERRORS as e:
+            error = e
+        verdict = pp.probe_verdict(account_number, region_name, operation, resource_id, error, failures, logger)
+        if verdict is not None:
+            return verdict, failures
+
+    return pp.NO_VERDICT, failures
+
+
+async def describe_chunk(client, describe, chunk, run_semaphore):
+    # chunks.describe_chunk, awaiting the pages
+    operation, result_key, id_key, filter_name, kwargs = describe
+    resources = []
+    async with run_semaphore:
+        async for page in client.get_paginator(operation).paginate(Filters=[{'Name': filter_name, 'Values': chunk}],
+                                                                   **kwargs):
+            resources.extend(page[result_key])
+    return resources
+
+
+async def search(client, describe, resource_ids, noun, run_semaphore, logger):
+    # chunks.search, with every chunk described concurrently
+    logger.info(f'   Searching for {len(resource_ids)} {noun}...')
+    unsearched = set()
+
+    async def search_chunk(chunk):
+        try:
+            return await describe_chunk(client, describe, chunk, run_semaphore)
+        except er.AWS_ERRORS as e:
+            chunks.search_failed(chunk, noun, e, logger)
+            unsearched.update(chunk)
+            return []
+
+    results = await asyncio.gather(*(search_chunk(chunk) for chunk in chunks.chunk_ids(resource_ids)))
+    return [resource for result in results for resource in result], unsearched
+
+
+async def snapshot_pages(rds, run_semaphore):
+    # rds_catalog.snapshot_pages, awaiting the pages
+    async with run_semaphore:
+        for kind, operation, result_key, id_key, filter_name in rc.DESCRIBES:
+            async for page in rds.get_paginator(operation).paginate(SnapshotType='manual'):
+                yield kind, page[result_key]
+
+
+async def build_rds_catalog(rds, run_semaphore):
+    catalog = {}
+    async for kind, snapshots in snapshot_pages(rds, run_semaphore):
+        rc.add_to_catalog(catalog, kind, snapshots)
+    return catalog
+
+
+async def list_addresses(ec2, run_semaphore):
+    async with run_semaphore:
+        response = await ec2.describe_addresses()
+    return response['Addresses']
+
+
+def record_results(ledger, resource_ids, results):
+    # Mark the outcome of each resource's deletion. Returns the number deleted.
+    deleted_ids = [resource_id for resource_id, deleted in zip(resource_ids, results) if deleted]
+    ledger.mark_deleted(deleted_ids)
+    ledger.mark_errors([resource_id for resource_id, deleted in zip(resource_ids, results) if not deleted])
+    return len(deleted_ids)
+
+
+async def delete_images(ec2, limiters, run_semaphore, account_number, region_name, resource_name, dry_run,
+                        three_months, resource_ids, ledger, logger):
+    ec2_limiter = limiters[0]
+    images, unsearched = await search(ec2, di.DESCRIBE, resource_ids, 'images', run_semaphore, logger)
+    images_to_deregister, images_to_confirm, image_snapshots, missing = di.sort_images(images, resource_ids,
+                                                                                       unsearched, three_months,
+                                                                                       logger)
+    ledger.mark_not_found(missing)
+    di.record_snapshots(ledger, account_number, region_name, images_to_deregister, image_snapshots)
+    snapshot_refs = di.snapshot_references(image_snapshots, images_to_deregister + images_to_confirm)
+
+    if dry_run:
+        verdict, failures = await probe(ec2, 'deregister_image', images_to_deregister, account_number, region_name,
+                                        ec2_limiter, run_semaphore, logger, lambda image_id: {'ImageId': image_id})
+        would_deregister = di.record_dry_run(ledger, account_number, region_name, resource_name, images_to_deregister,
+                                             images_to_confirm, missing, image_snapshots, verdict, failures, logger)
+        ready = [snapshot_id for image_id in would_deregister
+                 for snapshot_id in di.release_snapshots(snapshot_refs, image_snapshots[image_id])]
+        verdict, failures = await probe(ec2, 'delete_snapshot', ready, account_number, region_name, ec2_limiter,
+                                        run_semaphore, logger, lambda snapshot_id: {'SnapshotId': snapshot_id})
+        return len(would_deregister), di.record_snapshot_dry_run(ledger, account_number, region_name, resource_name,
+                                                                 ready, verdict, logger)
+
+    snapshots_deleted = 0
+
+    async def deregister(image_id):
+        nonlocal snapshots_deleted
+        if not await try_delete(ec2, 'deregister_image', image_id, ec2_limiter, run_semaphore, logger,
+                                ImageId=image_id, DryRun=False):
+            return False
+        results = await asyncio.gather(*(try_delete(ec2, 'delete_snapshot', snapshot_id, ec2_limiter,
+                                                    run_semaphore, logger, SnapshotId=snapshot_id, DryRun=False)
+                                         for snapshot_id in di.release_snapshots(snapshot_refs,
+                                                                                 image_snapshots[image_id])))
+        snapshots_deleted += sum(results)
+        return True
+
+    results = await asyncio.gather(*(deregister(image_id) for image_id in images_to_deregister))
+    return record_results(ledger, images_to_deregister, results), snapshots_deleted
+
+
+async def delete_ebs_resources(key, ec2, limiters, run_semaphore, account_number, region_name, resource_name,
+                               dry_run, resource_ids, ledger, logger):
+    # EBS snapshots and volumes
+    describe, noun, sort, operation, id_param, record_dry_run = EBS_RESOURCES[key]
+    ec2_limiter = limiters[0]
+    resources, unsearched = await search(ec2, describe, resource_ids, noun, run_semaphore, logger)
+    found, missing, in_use = sort(resources, resource_ids, unsearched, logger)
+    ledger.mark_not_found(missing)
+    to_delete = [resource_id for resource_id in resource_ids if resource_id in found]
+
+    if dry_run:
+        verdict, failures = await probe(ec2, operation, to_delete, account_number, region_name, ec2_limiter,
+                                        run_semaphore, logger, lambda resource_id: {id_param: resource_id})
+        return len(record_dry_run(ledger, account_number, region_name, resource_name, to_delete, in_use, missing,
+                                  verdict, failures, logger)), 0
+
+    results = await asyncio.gather(*(try_delete(ec2, operation, resource_id, ec2_limiter, run_semaphore, logger,
+                                                DryRun=False, **{id_param: resource_id})
+                                     for resource_id in to_delete))
+    return record_results(ledger, to_delete, results), 0
+
+
+async def release_ips(ec2, limiters, run_semaphore, account_number, region_name, resource_name, dry_run,
+                      resource_ids, ledger, logger, catalog=None):
+    ec2_limiter = limiters[0]
+    if catalog is None:
+        try:
+            catalog = ic.catalog_addresses(await list_addresses(ec2, run_semaphore))
+        except er.AWS_ERRORS as e:
+            logger.debug(e)
+            logger.info(f'   Unable to list Elastic IPs in {region_name}. Skipping IP release.')
+            return None
+    found, missing, associated = ri.get_ips(resource_ids, catalog, logger)
+    ledger.mark_not_found(missing)
+    ips_to_release = [ip for ip in resource_ids if ip in found]
+
+    if dry_run:
+        verdict, failures = await probe(ec2, 'release_address', ips_to_release, account_number, region_name,
+                                        ec2_limiter, run_semaphore, logger, lambda ip: found[ip])
+        return len(ri.record_dry_run(ledger, account_number, region_name, resource_name, ips_to_release, associated,
+                                     missing, found, verdict, failures, logger)), 0
+
+    results = await asyncio.gather(*(try_delete(ec2, 'release_address', ip, ec2_limiter, run_semaphore, logger,
+                                                DryRun=False, **found[ip])
+                                     for ip in ips_to_release))
+    return record_results(ledger, ips_to_release, results), 0
+
+
+async def delete_rds_snapshots(rds, limiters, run_semaphore, account_number, region_name, resource_name, dry_run,
+                               resource_ids, ledger, logger, catalog=None):
+    rds_limiter = limiters[1]
+    if catalog is None:
+        try:
+            catalog = await build_rds_catalog(rds, run_semaphore)
+        except er.AWS_ERRORS as e:
+            logger.debug(e)
+            logger.info(f'   Unable to list RDS snapshots in {region_name}. Skipping snapshot deletion.')
+            return None
+    rds_snapshots, aurora_snapshots, missing = drs.get_snapshots(resource_ids, catalog, logger)
+    ledger.mark_not_found(missing)
+
+    # RDS has no DryRun parameter, so nothing counts as deleted
+    if dry_run:
+        drs.record_dry_run(ledger, account_number, region_name, resource_name, rds_snapshots + aurora_snapshots,
+                           missing, catalog, logger)
+        return 0, 0
+
+    results = await asyncio.gather(*(try_delete(rds, 'delete_db_snapshot', snapshot_id, rds_limiter, run_semaphore,
+                                                logger, DBSnapshotIdentifier=snapshot_id)
+                                     for snapshot_id in rds_snapshots),
+                                   *(try_delete(rds, 'delete_db_cluster_snapshot', snapshot_id, rds_limiter,
+                                                run_semaphore, logger, DBClusterSnapshotIdentifier=snapshot_id)
+                                     for snapshot_id in aurora_snapshots))
+    return record_results(ledger, rds_snapshots + aurora_snapshots, results), 0
+
+
+async def delete_resource_type(key, resource_name, ec2, rds, limiters, run_semaphore, account_number, region_name,
+                               dry_run, three_months, region_ids, ledger, logger, catalog=None):
+    # Each resource type runs as its own task with its own context, so the label only covers its calls
+    mt.set_resource(resource_name)
+
+    if not ledger.exists:
+        logger.info(f'File not found: {ledger.resource_ids_path}. Skipping {resource_name} in {region_name}.')
+        return 0, 0
+    if ledger.done:
+        logger.info(f'\n{resource_name} in {region_name} was completed before the run was resumed. Skipping.')
+        return 0, 0
+
+    resource_ids = ledger.pending(region_ids)
+    logger.info(f'\n{resource_name} in {region_name}: locating {len(resource_ids)} IDs...')
+    args = (limiters, run_semaphore, account_number, region_name, resource_name, dry_run)
+    if key in ('1', '2'):
+        counts = await delete_images(ec2, *args, three_months, resource_ids, ledger, logger)
+    elif key in EBS_RESOURCES:
+        counts = await delete_ebs_resources(key, ec2, *args, resource_ids, ledger, logger)
+    elif key == '4':
+        counts = await release_ips(ec2, *args, resource_ids, ledger, logger, catalog)
+    else:
+        counts = await delete_rds_snapshots(rds, *args, resource_ids, ledger, logger, catalog)
+
+    if counts is None:
+        # As in the threaded engine, the IDs stay unresolved and the region unfinished for a later run
+        return 0, 0
+    remaining = ledger.flush()
+    logger.info(f'\n{resource_name} in {region_name}: {counts[0]} {"would be deleted" if dry_run else "deleted"}, '
+                f'{remaining} remaining.')
+    return counts
+
+
+async def describe_states(ec2, rds, key, resource_ids, run_semaphore):
+    # verify_deletions.describe_states, with the chunks described concurrently. Errors go to the caller.
+    if key in vf.EC2_DESCRIBES:
+        results = await asyncio.gather(*(describe_chunk(ec2, vf.EC2_DESCRIBES[key], chunk, run_semaphore)
+                                         for chunk in chunks.chunk_ids(resource_ids)))
+        return vf.ec2_states(vf.EC2_DESCRIBES[key], [resource for result in results for resource in result])
+    if key == '4':
+        return vf.address_states(await list_addresses(ec2, run_semaphore), resource_ids)
+    present = {}
+    resource_ids = set(resource_ids)
+    async for kind, snapshots in snapshot_pages(rds, run_semaphore):
+        vf.add_snapshot_states(present, kind, snapshots, resource_ids)
+    return present
+
+
+async def verify_deletions(ec2, rds, deleted, resources_dict, run_semaphore, logger, timeout=vf.TIMEOUT):
+    # verify_deletions.verify_deletions, with every resource type described concurrently
+    remaining = {key: list(resource_ids) for key, resource_ids in deleted.items() if resource_ids}
+    stragglers = {}
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    attempt = 0
+
+    async def poll(key):
+        # Each poll is its own task, so the label only covers its calls
+        mt.set_resource(resources_dict[key])
+        try:
+            return await describe_states(ec2, rds, key, remaining[key], run_semaphore)
+        except er.AWS_ERRORS as e:
+            logger.debug(e)
+            return None
+
+    while remaining:
+        keys = list(remaining)
+        for key, present in zip(keys, await asyncio.gather(*(poll(key) for key in keys))):
+            vf.record_poll(stragglers, remaining, key, present)
+
+        delay = vf.backoff_delay(attempt)
+        if not remaining or loop.time() + delay > deadline:
+            break
+        await asyncio.sleep(delay)
+        attempt += 1
+
+    return stragglers
+
+
+async def delete_region(unit, resource_keys, resources_dict, dry_run, three_months, ledgers, run_semaphore,
+                        endpoint_url, logger, verify=False):
+    profile, region_name, session, region_ids = unit
+    account_number = profile['account_number']
+    logger.info(f'\n** Starting resource deletion for {profile["account_name"]} in {region_name}. **')
+    cb.start_deadline(account_number, region_name)
+
+    # Reuse the credentials of the boto3 session the inventory was taken with
+    credentials = session.get_credentials().get_frozen_credentials()
+    client_kwargs = {
+        'region_name': region_name,
+        'aws_access_key_id': credentials.access_key,
+        'aws_secret_access_key': credentials.secret_key,
+        'aws_session_token': credentials.token,
+        'endpoint_url': endpoint_url,
+        'config': AioConfig(max_pool_connections=POOL_CONNECTIONS)
+    }
+    # Shared with the threaded engine's workers for the scope, if any
+    limiters = (rl.get_rate_limiter(account_number, region_name, 'ec2'),
+                rl.get_rate_limiter(account_number, region_name, 'rds'))
+    counts = {'4': 0, 'images': 0, 'snapshots': 0, '5': 0, '6': 0}
+
+    aio_session = get_session()
+    async with aio_session.create_client('ec2', **client_kwargs) as ec2, \
+            aio_session.create_client('rds', **client_kwargs) as rds:
+        cb.guard(mt.instrument(ec2, account_number), account_number)
+        cb.guard(mt.instrument(rds, account_number), account_number)
+        # The RDS snapshot and IP catalogs the region inventory built, if any
+        catalogs = {'4': ic.cached_catalog(account_number, region_name),
+                    '6': rc.cached_catalog(account_number, region_name)}
+        tasks = []
+        scopes = {}
+        for key in resource_keys:
+            ids_in_region = region_ids.get(key)
+            if ids_in_region is not None and not ids_in_region:
+                continue
+            # Resource types whose service keeps failing in the region, or whose region ran out of time, are left
+            # unresolved for a later or resumed run
+            reason = cb.skip_reason(account_number, region_name, 'rds' if key == '6' else 'ec2')
+            if reason is not None:
+                logger.info(f'\nSkipping {resources_dict[key]} in {region_name}: {reason}.')
+                continue
+            scopes[key] = ledgers[key].for_scope(account_number, region_name)
+            tasks.append((key, delete_resource_type(key, resources_dict[key], ec2, rds, limiters, run_semaphore,
+                                                    account_number, region_name, dry_run, three_months,
+                                                    ids_in_region, scopes[key], logger, catalogs.get(key))))
+        results = await asyncio.gather(*(task for key, task in tasks))
+
+        # Confirm in bulk that every resource deleted in the region is gone. Dry runs delete nothing.
+        stragglers = {}
+        if verify and not dry_run:
+            deleted = {key: scope.deleted_ids for key, scope in scopes.items()}
+            stragglers = await verify_deletions(ec2, rds, deleted, resources_dict, run_semaphore, logger)
+
+    for key, key_stragglers in stragglers.items():
+        vf.report_stragglers(scopes[key], account_number, region_name, resources_dict[key], scopes[key].deleted_ids,
+                             key_stragglers, logger)
+
+    image_snapshots = 0
+    for (key, task), (count, snapshot_count) in zip(tasks, results):
+        if key in ('1', '2'):
+            counts['images'] += count
+            counts['snapshots'] += snapshot_count
+            image_snapshots += snapshot_count
+        elif key == '3':
+            counts['snapshots'] += count
+        else:
+            counts[key] += count
+
+    # Later runs that reuse the region's cached inventories do not look for what was just deleted
+    inv.forget_deleted(account_number, region_name, {key: scope.deleted_ids for key, scope in scopes.items()},
+                       image_snapshots)
+
+    cb.report(account_number, region_name, logger)
+    lp.region_summary(logger, profile['account_name'], region_name, counts['4'], counts['images'],
+                      counts['snapshots'], counts['5'], counts['6'])
+    return counts['4'], counts['images'], counts['snapshots'], counts['5'], counts['6']
+
+
+async def delete_regions(units, resource_keys, resources_dict, dry_run, three_months, ledgers, max_in_flight,
+                         endpoint_url, logger, verify=False):
+    run_semaphore = asyncio.Semaphore(max_in_flight)
+    return await asyncio.gather(*(delete_region(unit, resource_keys, resources_dict, dry_run, three_months, ledgers,
+                                                run_semaphore, endpoint_url, logger, verify)
+                                  for unit in units))
+
+
+def run(units, resource_keys, resources_dict, dry_run, three_months, ledgers, logger, max_in_flight=200,
+        endpoint_url=None, verify=False):
+    # Run the describe and delete phases of every (profile, region, session, region_ids) unit on one event loop.
+    # ledgers maps each resource key to the client's IdLedger, which each region sees through its scope.
+    # Returns the per-region counter tuples in the same order as delete_resources.
+    if get_session is None:
+        raise RuntimeError('The async engine requires aiobotocore. Install it with "pip install aiobotocore".')
+    return asyncio.run(delete_regions(units, resource_keys, resources_dict, dry_run, three_months, ledgers,
+                                      max_in_flight, endpoint_url, logger, verify))
@@ -1,13 +1,67 @@
 import aws_sso_lib
+import botocore.exceptions
+import boto3
+import modules.session_pool as sp
+from aws_sso_lib.exceptions import AuthenticationNeededError
 import subprocess
 import os
 
+# Profiles already verified in this run, so each is only checked once however many times it is logged in to
+_verified_profiles = set()
 
-def aws_login(login_type, profile, client_name, logger, start_url=None, sso_region=None):
+
+def verify_identity(logger, profile_name=None, region_name=None, new_session=None):
+    # Confirm in-process with STS that the credentials of the named profile, or of the session new_session builds,
+    # are present and unexpired. The session is built inside the check, so a profile missing from the AWS config
+    # counts as not logged in.
+    try:
+        if new_session is None:
+            session = boto3.Session(profile_name=profile_name, region_name=region_name)
+        else:
+            session = new_session()
+        identity = session.client('sts', endpoint_url=sp.ENDPOINT_URL).get_caller_identity()
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, AuthenticationNeededError) as e:
+        logger.debug(e)
+        return False
+    logger.debug(f'Verified identity {identity["Arn"]}.')
+    return True
+
+
+def sso_session(profile, start_url, sso_region, role_name):
+    # A session that never prompts for login; role credentials go to the pooled cache, so they are reused later
+    return aws_sso_lib.get_boto3_session(start_url, sso_region, int(profile['account_number']), role_name,
+                                         region=sso_region, login=False,
+                                         credential_cache=sp.get_credential_cache())
+
+
+def verify_login(login_type, profile, logger, start_url=None, sso_region=None, role_name=None):
+    # True when the profile's cached credentials are still valid. Never prompts for a login, so it is safe in
+    # headless workers.
+    if login_type == 'aal':
+        profile_key = profile['profile_name']
+        verified = profile_key in _verified_profiles or verify_identity(logger, profile_key, profile['region'][0])
+    else:
+        profile_key = (start_url, profile['account_number'], role_name)
+        verified = profile_key in _verified_profiles or verify_identity(
+            logger, new_session=lambda: sso_session(profile, start_url, sso_region, role_name))
+    if verified:
+        _verified_profiles.add(profile_key)
+    return verified
+
+
+def aws_login(login_type, profile, client_name, logger, start_url=None, sso_region=None, role_name=None):
     is_logged_in = False
 
     if login_type == 'aal':
         profile_name = profile['profile_name']
+        if profile_name in _verified_profiles:
+            return True
+
+        # Credentials from an earlier aws-azure-login that have not expired yet are used as they are
+        if verify_identity(logger, profile_name, profile['region'][0]):
+            logger.info(f'\nYou are already logged in to {profile_name}.')
+            _verified_profiles.add(profile_name)
+            return True
 
         # Set certain aws-azure-login environmental variables - still needed
         os.environ['AZURE_TENANT_ID'] = profile['tenant_id']
@@ -27,26 +81,31 @@ def aws_login(login_type, profile, client_name, logger, start_url=None, sso_regi
         logger.debug(errors)
         login.wait()
 
-        # Verify login status with an STS API call
-        login_verify = subprocess.Popen(['aws', 'sts', 'get-caller-identity'], shell=True,
-                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        output, errors = login_verify.communicate()
-        logger.debug(output)
-        logger.debug(errors)
-        login_verify.wait()
-
-        if 'UserId' in output:
+        # Verify login status with an STS API call, on a new session so the new credentials file is read
+        if verify_identity(logger, profile_name, profile['region'][0]):
             logger.info(f'You are logged in to {profile_name}.')
+            _verified_profiles.add(profile_name)
             is_logged_in = True
 
     else:
-        # TODO: some sort of login check to skip this if already logged in
+        profile_key = (start_url, profile['account_number'], role_name)
+        if profile_key in _verified_profiles:
+            return True
+
+        # An unexpired SSO token from an earlier login is used without opening the browser
+        if verify_identity(logger, new_session=lambda: sso_session(profile, start_url, sso_region, role_name)):
+            logger.info(f'\nYou are already logged in to {client_name}.')
+            _verified_profiles.add(profile_key)
+            return True
+
         logger.info(f'\nLogging in to {client_name}. Enter your credentials in the browser window.')
 
         login_response = aws_sso_lib.login(start_url, sso_region)
 
-        if login_response['accessToken']:
+        if login_response['accessToken'] and \
+                verify_identity(logger, new_session=lambda: sso_session(profile, start_url, sso_region, role_name)):
             logger.info(f'You are logged in to {client_name}.')
+            _verified_profiles.add(profile_key)
             is_logged_in = True
 
     return is_logged_in
@@ -0,0 +1,140 @@
+import csv
+import itertools
+import json
+import os
+import modules.id_router as rt
+
+# openpyxl is only needed for XLSX sources, so CSV and JSON batches run without it
+try:
+    from openpyxl import load_workbook
+except ImportError:
+    load_workbook = None
+
+# Column headings of each resource type's IDs in the CloudHealth report exports
+ID_COLUMNS = {
+    '1': ('image id', 'ami id', 'imageid', 'resource id'),
+    '2': ('image id', 'ami id', 'imageid', 'resource id'),
+    '3': ('snapshot id', 'snapshotid', 'resource id'),
+    '4': ('public ip', 'elastic ip', 'ip address', 'publicip', 'resource id'),
+    '5': ('volume id', 'volumeid', 'resource id'),
+    '6': ('snapshot id', 'db snapshot identifier', 'snapshot identifier', 'dbsnapshotidentifier', 'resource id')
+}
+
+
+def resolve_key(value, names, kind):
+    # Accept either the key or the name of a client or resource type
+    if value in names:
+        return value
+    for key, name in names.items():
+        if str(value).lower() == name.lower():
+            return key
+    raise ValueError(f'Unknown {kind} "{value}" in batch file.')
+
+
+def load_manifest(path, clients, resources_dict):
+    # Returns the client keys, resource keys, dry run setting and the ID source of each client and resource type.
+    # A client's source is one export holding every selected resource type, or a file per resource type.
+    with open(path, 'r') as file:
+        manifest = json.load(file)
+
+    client_names = {key: value['name'] for key, value in clients.items()}
+    client_keys = [resolve_key(client, client_names, 'client') for client in manifest.get('clients', [])]
+    resource_keys = [resolve_key(resource, resources_dict, 'resource') for resource in manifest.get('resources', [])]
+    if not client_keys or not resource_keys:
+        raise ValueError('The batch file must list at least one client and one resource type.')
+
+    # Deleting has to be asked for explicitly
+    dry_run = manifest.get('dry_run', True) is not False
+
+    # Source paths are relative to the batch file
+    base_directory = os.path.dirname(os.path.abspath(path))
+    id_sources = {}
+    for client, sources in manifest.get('sources', {}).items():
+        client_key = resolve_key(client, client_names, 'client')
+        if isinstance(sources, str):
+            sources = {resource_key: sources for resource_key in resource_keys}
+            shared = True
+        else:
+            sources = {resolve_key(resource, resources_dict, 'resource'): source
+                       for resource, source in sources.items()}
+            shared = False
+        id_sources.setdefault(client_key, {}).update({resource_key: (os.path.join(base_directory, source), shared)
+                                                      for resource_key, source in sources.items()})
+
+    return client_keys, resource_keys, dry_run, id_sources
+
+
+def read_rows(path):
+    # Yield the rows of a CSV, XLSX or JSON source one at a time
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.xlsx':
+        if load_workbook is None:
+            raise RuntimeError('XLSX sources require openpyxl. Install it with "pip install openpyxl".')
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                yield ['' if value is None else str(value) for value in row]
+        finally:
+            workbook.close()
+    elif extension == '.json':
+        with open(path, 'r') as file:
+            data = json.load(file)
+        if isinstance(data, dict):
+            data = data.get('data', data.get('rows', []))
+        if data and isinstance(data[0], dict):
+            headings = list(data[0])
+            yield headings
+            for row in data:
+                yield [str(row.get(heading, '')) for heading in headings]
+        else:
+            for value in data:
+                yield [str(value)]
+    else:
+        with open(path, 'r', newline='', encoding='utf-8-sig') as file:
+            yield from csv.reader(file)
+
+
+def read_ids(path, key, shared, logger):
+    # Yield the IDs of one resource type from a source. The ID column is found by its heading; a source
+    # dedicated to one resource type falls back to its first column, heading row or not.
+    rows = read_rows(path)
+    first_row = next(rows, None)
+    if first_row is None:
+        return
+
+    headings = [heading.strip().lower().replace('_', ' ') for heading in first_row]
+    column = next((headings.index(name) for name in ID_COLUMNS[key] if name in headings), None)
+    if column is None:
+        if shared:
+            logger.info(f'No {ID_COLUMNS[key][0]} column found in {path}.')
+            return
+        column = 0
+        rows = itertools.chain([first_row], rows)
+
+    for row in rows:
+        if len(row) > column and row[column].strip():
+            yield row[column].strip()
+
+
+def write_resource_ids(client_name, resource_keys, resources_dict, run_date_time, sources, logger):
+    # Stream each resource type's IDs from its source through the ID router into the working ID files, in place
+    # of the entry dialogs. Returns the number of IDs written per resource key.
+    router = rt.IdRouter(resource_keys)
+
+    def routed_ids():
+        for key in resource_keys:
+            if key not in sources:
+                logger.info(f'{resources_dict[key]} has no ID source for {client_name}.')
+                continue
+            path, shared = sources[key]
+            logger.info(f'Reading {resources_dict[key]} IDs from {path}...')
+            for resource_id in read_ids(path, key, shared, logger):
+                yield from router.route(key, resource_id)
+
+    counts = rt.write_ids(routed_ids(), client_name, resources_dict, run_date_time)
+    router.log_summary(client_name, resources_dict, logger)
+    router.write_rejected(f'{client_name}_{run_date_time}/{client_name} rejected IDs.txt', resources_dict)
+    for key, count in counts.items():
+        logger.info(f'"{client_name} {resources_dict[key]}.txt" written successfully with {count} IDs.')
+
+    return counts
@@ -0,0 +1,42 @@
+import modules.errors as er
+
+# Maximum number of values EC2 accepts in a single describe filter
+FILTER_CHUNK_SIZE = 200
+
+
+def chunk_ids(ids, size=FILTER_CHUNK_SIZE):
+    # Yield successive fixed-size chunks of resource IDs
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def describe_chunk(client, describe, chunk):
+    # The resources of one chunk of IDs. describe is the (operation, result key, ID key, filter, arguments) of the
+    # resource type's describe call. Errors go to the caller.
+    operation, result_key, id_key, filter_name, kwargs = describe
+    return [resource for page in client.get_paginator(operation).paginate(Filters=[{'Name': filter_name,
+                                                                                     'Values': chunk}], **kwargs)
+            for resource in page[result_key]]
+
+
+def search(client, describe, ids, noun, logger):
+    # Describe IDs a chunk at a time. Returns the described resources and the IDs of the chunks that could not be
+    # described.
+    logger.info(f'   Searching for {len(ids)} {noun}...')
+    resources = []
+    unsearched = set()
+    for chunk in chunk_ids(ids):
+        try:
+            resources.extend(describe_chunk(client, describe, chunk))
+        except er.AWS_ERRORS as e:
+            search_failed(chunk, noun, e, logger)
+            unsearched.update(chunk)
+    return resources, unsearched
+
+
+def search_failed(chunk, noun, e, logger):
+    # A failed search says nothing about whether the resources exist, so they are left for a later run
+    logger.debug(e)
+    logger.info(f'      Unable to search {noun} {chunk[0]} through {chunk[-1]}: {er.classify(e)}.')
+    return
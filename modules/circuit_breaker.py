@@ -0,0 +1,169 @@
+import threading
+import time
+import botocore.awsrequest
+import botocore.exceptions
+import modules.errors as er
+
+# Denials or timeouts in a row after which the calls of an account, region and service are skipped
+FAILURE_THRESHOLD = 5
+
+# Seconds an open circuit skips calls before one call is let through to test the scope again
+OPEN_SECONDS = 60.0
+
+# Failures that say the whole scope is unusable, rather than something about one resource
+TRIP_CATEGORIES = {er.DENIED, er.TRANSIENT}
+
+# Seconds each region gets for its inventory and again for each window of deletions before the rest of its calls
+# are skipped; 0 means no deadline. Set from --region-deadline.
+DEADLINE = 3600
+
+DEADLINE_PASSED = 'deadline passed'
+
+
+class CircuitBreaker:
+    # Guards the calls of one account, region and service. FAILURE_THRESHOLD denials or timeouts in a row open the
+    # circuit, and every call of the scope then fails at once without being made. After OPEN_SECONDS one call is
+    # let through: the circuit closes again if it succeeds and stays open if it fails. Throttles, missing
+    # resources and resources in use say nothing about the scope and count as successes.
+
+    def __init__(self, scope, threshold=FAILURE_THRESHOLD, open_seconds=OPEN_SECONDS):
+        self.scope = scope
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.reason = None
+        self.trips = 0
+        self.skipped = 0
+
+        self._failures = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _reason(self):
+        deadline = _deadlines.get(self.scope[:2])
+        if deadline is not None and time.monotonic() > deadline:
+            return DEADLINE_PASSED
+        if self._opened is not None and (self._trial or time.monotonic() - self._opened < self.open_seconds):
+            return self.reason
+        return None
+
+    def blocked(self):
+        # Why calls of the scope are skipped right now, or None when they can be made
+        with self._lock:
+            return self._reason()
+
+    def allow(self):
+        # Like blocked(), for a call about to be made: once the circuit has been open for OPEN_SECONDS, the one
+        # call allowed through is the trial
+        with self._lock:
+            reason = self._reason()
+            if reason is not None:
+                self.skipped += 1
+            elif self._opened is not None:
+                self._trial = True
+            return reason
+
+    def check(self, operation_name):
+        # The error to fail a call with, without making it or taking the trial, when the scope is blocked
+        with self._lock:
+            reason = self._reason()
+            if reason is None:
+                return None
+            self.skipped += 1
+        return self.open_error(reason, operation_name)
+
+    def record(self, category):
+        # Count the outcome of a call that was made; category is None for a success
+        with self._lock:
+            self._trial = False
+            if category not in TRIP_CATEGORIES:
+                self._failures = 0
+                self._opened = None
+                return
+            self._failures += 1
+            if self._opened is not None or self._failures >= self.threshold:
+                if self._opened is None:
+                    self.trips += 1
+                self._opened = time.monotonic()
+                self.reason = f'{self._failures} {category} calls in a row'
+        return
+
+    def open_error(self, reason, operation_name):
+        # The error a skipped call fails with. It is a ClientError, so every handler of failed calls handles it.
+        return botocore.exceptions.ClientError(self.open_response(reason), operation_name)
+
+    def open_response(self, reason):
+        service, account_number, region_name = self.scope[2], self.scope[0], self.scope[1]
+        return {'Error': {'Code': er.CIRCUIT_OPEN_ERROR_CODE,
+                          'Message': f'Calls to {service} in {account_number} {region_name} are skipped: {reason}.'},
+                'ResponseMetadata': {'HTTPStatusCode': 503}}
+
+
+_breakers = {}
+_deadlines = {}
+_breakers_guard = threading.Lock()
+
+
+def get_breaker(account_number, region_name, service):
+    # One breaker per account, region and service, shared by every worker and client of the scope
+    with _breakers_guard:
+        key = (account_number, region_name, service)
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(key)
+        return _breakers[key]
+
+
+def start_deadline(account_number, region_name):
+    # Give the region DEADLINE seconds from now
+    with _breakers_guard:
+        if DEADLINE > 0:
+            _deadlines[(account_number, region_name)] = time.monotonic() + DEADLINE
+    return
+
+
+def skip_reason(account_number, region_name, service):
+    return get_breaker(account_number, region_name, service).blocked()
+
+
+def guard(client, account_number):
+    # Attach the breaker of the client's scope to a botocore or aiobotocore client. Calls of an open scope get an
+    # error response without a request being sent, and the outcome of every call that is sent is counted.
+    breaker = get_breaker(account_number, client.meta.region_name, client.meta.service_model.service_name)
+
+    def before_call(event_name, context, **kwargs):
+        reason = breaker.allow()
+        if reason is None:
+            return None
+        # Not an API call, so the metrics leave it out
+        context.pop('metrics', None)
+        context['circuit_open'] = True
+        return botocore.awsrequest.AWSResponse(None, 503, {}, None), breaker.open_response(reason)
+
+    def after_call(event_name, parsed, context, **kwargs):
+        if context.get('circuit_open'):
+            return
+        error = parsed.get('Error', {})
+        breaker.record(er.classify_code(error['Code'], parsed.get('ResponseMetadata', {}).get('HTTPStatusCode'))
+                       if error.get('Code') else None)
+
+    def after_call_error(event_name, exception, context, **kwargs):
+        breaker.record(er.classify(exception))
+
+    # Registered after the metric hooks, so each call's metrics are started before it can be skipped
+    client.meta.events.register_first('before-call.*.*', before_call)
+    client.meta.events.register('after-call.*.*', after_call)
+    client.meta.events.register('after-call-error.*.*', after_call_error)
+    return client
+
+
+def report(account_number, region_name, logger):
+    # Log how the scopes of a region that skipped calls fared
+    with _breakers_guard:
+        breakers = [breaker for key, breaker in _breakers.items() if key[:2] == (account_number, region_name)]
+    for breaker in breakers:
+        reason = breaker.blocked()
+        if breaker.trips or breaker.skipped or reason is not None:
+            still_blocked = f' Still skipping: {reason}.' if reason is not None else ''
+            logger.info(f'   Calls to {breaker.scope[2]} in {region_name}: {breaker.trips} circuit trips, '
+                        f'{breaker.skipped} calls skipped.{still_blocked}')
+    return
@@ -1,99 +1,112 @@
-import botocore.exceptions
-import os
-import shutil
+import modules.chunks as chunks
+import modules.errors as er
+import modules.ledger as lg
+import modules.log_pipeline as lp
+import modules.permission_probe as pp
+import modules.rate_limiter as rl
 
 
-def get_snapshot(ec2_client, snapshot_id, logger):
-    error_msg = f'      The snapshot {snapshot_id} does not exist in this region or account.'
-    logger.info(f'   Searching for {snapshot_id}...')
-    snapshot_exists = False
+# (operation, result key, ID key, filter, arguments) of the describe of snapshot IDs
+DESCRIBE = ('describe_snapshots', 'Snapshots', 'SnapshotId', 'snapshot-id', {'OwnerIds': ['self']})
 
-    try:
-        response = ec2_client.describe_snapshots(SnapshotIds=[snapshot_id])
-        if response['Snapshots']:
-            logger.info('      Snapshot found.')
-            snapshot_exists = True
+
+def get_snapshots(ec2_client, snapshot_ids, logger):
+    # Resolve snapshot IDs in chunks. Returns sets of completed, missing and in-use (not yet completed) snapshot IDs.
+    snapshots, unsearched = chunks.search(ec2_client, DESCRIBE, snapshot_ids, 'snapshots', logger)
+    return sort_snapshots(snapshots, snapshot_ids, unsearched, logger)
+
+
+def sort_snapshots(snapshots, snapshot_ids, unsearched, logger):
+    # Sort the described snapshots of snapshot_ids into completed and in-use snapshots. IDs that were not searched
+    # are neither found nor missing.
+    found = set()
+    in_use = set()
+    for snapshot in snapshots:
+        if snapshot['State'] == 'completed':
+            found.add(snapshot['SnapshotId'])
         else:
-            logger.info(error_msg)
-    except botocore.exceptions.ClientError as e:
-        logger.debug(e)
-        logger.info(error_msg)
+            in_use.add(snapshot['SnapshotId'])
+            logger.info('      The snapshot %s is %s and will be skipped.', snapshot['SnapshotId'], snapshot['State'],
+                        extra=lp.DETAIL)
+
+    missing = set(snapshot_ids) - found - in_use - unsearched
+    logger.info(f'      {len(found)} snapshots found, {len(in_use)} in use, '
+                f'{len(missing)} do not exist in this region or account.')
+    logger.debug('      Snapshots not found: %s', sorted(missing))
 
-    return snapshot_exists
+    return found, missing, in_use
 
 
-def delete_snapshot(ec2_client, snapshot_id, dry_run, logger):
-    logger.info(f'   Trying deletion of {snapshot_id}...')
+def delete_snapshot(ec2_client, snapshot_id, dry_run, logger, limiter=None):
+    logger.info('   Trying deletion of %s...', snapshot_id, extra=lp.DETAIL)
     deleted = False
     try:
-        response = ec2_client.delete_snapshot(SnapshotId=snapshot_id, DryRun=dry_run)
-        logger.info(f'      {response}')
+        response = rl.call(limiter, ec2_client.delete_snapshot, SnapshotId=snapshot_id, DryRun=dry_run)
+        logger.debug('      %s', response)
         deleted = True
-    except botocore.exceptions.ClientError as e:
-        logger.info(f'      {e}')
-        if 'DryRunOperation' in str(e):
+    except er.AWS_ERRORS as e:
+        category = er.classify(e)
+        # Calls skipped by an open circuit are reported once for the region instead
+        if category != er.CIRCUIT_OPEN:
+            logger.info('      %s: %s', category, e, extra=lp.DETAIL)
+        if category == er.DRY_RUN:
             deleted = True
 
     return deleted
 
 
-def delete_snapshots(ec2_client, client_name, region_name, resource_name, dry_run, run_date_time, logger):
-    resource_ids_file_name = f'{client_name} {resource_name}.txt'
-    deleted_ids_file_name = f'{client_name} {resource_name} deleted.txt'
-    error_ids_file_name = f'{client_name} {resource_name} errors.txt'
-    snapshots_deleted = 0
+def record_dry_run(ledger, account_number, region_name, resource_name, snapshots_to_delete, in_use, missing, verdict,
+                   failures, logger):
+    # Report the dry run of a region's snapshots from the probe of delete_snapshot. Returns the snapshots that would
+    # be deleted.
+    outcomes = pp.plan(snapshots_to_delete, verdict, failures)
+    outcomes.update(pp.skipped(in_use, pp.NOT_COMPLETED))
+    outcomes.update(pp.skipped(missing, pp.NOT_FOUND))
+    return pp.record(ledger, account_number, region_name, resource_name, outcomes, logger,
+                     {snapshot_id: (pp.COMPLETED, []) for snapshot_id in snapshots_to_delete})
 
-    # Copy the resource ids file if a copy doesn't already exist
-    file_copy_path = f'{client_name}_{run_date_time}/Copy of {resource_ids_file_name}'
-    if not os.path.isfile(file_copy_path):
-        shutil.copy(f'{client_name}_{run_date_time}/{resource_ids_file_name}', file_copy_path)
-        logger.info('Initial copy of resource ID file was successful.')
 
-    # Read snapshots from file
-    try:
-        with open(f'{client_name}_{run_date_time}/{resource_ids_file_name}', 'r') as file:
-            snapshots_list = [line.strip() for line in file]
-            logger.info(f'Locating {len(snapshots_list)} snapshots...')
-    except FileNotFoundError:
-        logger.info(f'File not found: {resource_ids_file_name}. Skipping snapshot deletion in {region_name}.')
-        return snapshots_deleted
+def delete_snapshots(ec2_client, client_name, region_name, resource_name, dry_run, run_date_time, logger,
+                     region_ids=None, limiter=None, ledger=None, account_number=None):
+    snapshots_deleted = 0
 
-    original_snapshots_list_length = len(snapshots_list)
-    snapshots_to_delete = []
+    if ledger is None:
+        ledger = lg.IdLedger(client_name, resource_name, run_date_time, logger)
+    if not ledger.exists:
+        logger.info(f'File not found: {client_name} {resource_name}.txt. Skipping snapshot deletion in {region_name}.')
+        return snapshots_deleted
 
-    # Search for each snapshot. If it exists, delete the snapshot
-    for snap in snapshots_list:
-        if get_snapshot(ec2_client, snap, logger):
-            snapshots_to_delete.append(snap)
-    if snapshots_to_delete:
+    # Only search for unresolved snapshots, limited to those the region inventory located in this region
+    snapshots_list = ledger.pending(region_ids)
+    logger.info(f'Locating {len(snapshots_list)} snapshots...')
+
+    # Search for all snapshots in bulk. If a snapshot exists, delete the snapshot
+    found, missing, in_use = get_snapshots(ec2_client, snapshots_list, logger)
+    ledger.mark_not_found(missing)
+    snapshots_to_delete = [snap for snap in snapshots_list if snap in found]
+    if dry_run:
+        # One DryRun call for the region stands in for a call per snapshot
+        verdict, failures = pp.probe(account_number, region_name, 'delete_snapshot',
+                                     lambda snapshot_id: rl.call(limiter, ec2_client.delete_snapshot,
+                                                                 SnapshotId=snapshot_id, DryRun=True),
+                                     snapshots_to_delete, logger)
+        snapshots_deleted = len(record_dry_run(ledger, account_number, region_name, resource_name,
+                                               snapshots_to_delete, in_use, missing, verdict, failures, logger))
+    elif snapshots_to_delete:
         logger.info(f'\nDeleting {len(snapshots_to_delete)} snapshots...')
-        del_file = open(f'{client_name}_{run_date_time}/{deleted_ids_file_name}', 'a')
-        err_file = open(f'{client_name}_{run_date_time}/{error_ids_file_name}', 'a')
-        errors_list = [line.strip() for line in err_file]
-        for snap_to_delete in snapshots_to_delete:
-            if snap_to_delete not in errors_list:
-                if delete_snapshot(ec2_client, snap_to_delete, dry_run, logger):
-                    snapshots_deleted += 1
-                    del_file.write(snap_to_delete + '\n')
-                    snapshots_list.remove(snap_to_delete)
-                else:
-                    err_file.write(snap_to_delete + '\n')
-        del_file.close()
-        err_file.close()
+        results = rl.map_calls(limiter, lambda snap_to_delete: delete_snapshot(ec2_client, snap_to_delete, dry_run,
+                                                                               logger, limiter), snapshots_to_delete)
+        deleted_snapshots = [snap_to_delete for snap_to_delete, deleted in results if deleted]
+        snapshots_deleted = len(deleted_snapshots)
+        ledger.mark_deleted(deleted_snapshots)
+        ledger.mark_errors([snap_to_delete for snap_to_delete, deleted in results if not deleted])
+
+    # Rewrite the working file without the deleted snapshots; it is removed once it is empty
+    remaining_snapshots = ledger.flush()
 
     logger.info(f'\nNumber of snapshots deleted: {snapshots_deleted}')
-    logger.info(f'Number of remaining snapshots: {len(snapshots_list)}')
-
-    # Rewrite snapshots file if snapshots were deleted
-    if 0 < len(snapshots_list) < original_snapshots_list_length:
-        logger.info('Rewriting working snapshots file...')
-        os.remove(f'{client_name}_{run_date_time}/{resource_ids_file_name}')
-        file = open(f'{client_name}_{run_date_time}/{resource_ids_file_name}', 'w')
-        for snap in snapshots_list:
-            file.write(snap + '\n')
-        file.close()
-    elif not snapshots_list:
-        os.remove(f'{client_name}_{run_date_time}/{resource_ids_file_name}')
+    logger.info(f'Number of remaining snapshots: {remaining_snapshots}')
+    if not remaining_snapshots:
         logger.info('All snapshots deleted. Snapshots file removed.')
 
     return snapshots_deleted
@@ -1,181 +1,218 @@
-import botocore.exceptions
 import os
-import shutil
+import threading
+import modules.chunks as chunks
+import modules.errors as er
+import modules.id_files as idf
+import modules.ledger as lg
+import modules.log_pipeline as lp
+import modules.permission_probe as pp
+import modules.rate_limiter as rl
+
+
+# (operation, result key, ID key, filter, arguments) of the describe of image IDs
+DESCRIBE = ('describe_images', 'Images', 'ImageId', 'image-id', {'Owners': ['self']})
+
+
+def get_images(ec2_client, image_ids, three_months_date, logger):
+    # Describe image IDs in chunks. Returns images to deregister, images that need confirmation,
+    # the image to EBS snapshot map and the image IDs not found in this region or account.
+    images, unsearched = chunks.search(ec2_client, DESCRIBE, image_ids, 'images', logger)
+    return sort_images(images, image_ids, unsearched, three_months_date, logger)
+
+
+def sort_images(images, image_ids, unsearched, three_months_date, logger):
+    # Sort the described images of image_ids by age, collecting each image's EBS snapshot IDs. IDs that were not
+    # searched are neither found nor missing.
+    old_images = set()
+    new_images = set()
+    image_snapshots = {}
+
+    for image in images:
+        image_id = image['ImageId']
+        image_snapshots[image_id] = [block_device['Ebs']['SnapshotId']
+                                     for block_device in image.get('BlockDeviceMappings', [])
+                                     if 'SnapshotId' in block_device.get('Ebs', {})]
+
+        # Check if image is less than three months old
+        if image['CreationDate'][:10] > three_months_date:
+            new_images.add(image_id)
+        else:
+            old_images.add(image_id)
 
+    images_to_deregister = [image_id for image_id in image_ids if image_id in old_images]
+    images_to_confirm = [image_id for image_id in image_ids if image_id in new_images]
+    missing = set(image_ids) - old_images - new_images - unsearched
 
-def get_image_snapshots(ec2_client, client_name, image_id, image_snaps_file_name,
-                        run_date_time, three_months_date, logger):
-    error_msg = f'      The image id {image_id} does not exist in this region or account.'
-    logger.info(f'   Searching for {image_id}...')
-    try:
-        response = ec2_client.describe_images(ImageIds=[image_id])
-        snapshot_ids = []
-        snaps_to_confirm = []
-        confirm_image = False
-        if response['Images']:
-            image_date = response['Images']['CreationDate'][:10]
-            logger.info('      Image found. Getting snapshots...')
-
-            # Check if image is less than three months old
-            if image_date > three_months_date:
-                logger.info('         Image is less than three months old and needs confirmation.')
-                confirm_image = True
-
-            for block_device in response['Images'][0]['BlockDeviceMappings']:
-                if 'Ebs' in block_device:
-                    snapshot_id = block_device['Ebs']['SnapshotId']
-                    snapshot_ids.append(snapshot_id)
-            if snapshot_ids:
-                with open(f'{client_name}_{run_date_time}/{image_snaps_file_name}', 'a') as file:
-                    for snapshot_id in snapshot_ids:
-                        file.write(snapshot_id + '\n')
-            return snapshot_ids, confirm_image
-        else:
-            logger.info(error_msg)
-    except botocore.exceptions.ClientError as e:
-        logger.debug(e)
-        logger.info(error_msg)
+    logger.info(f'      {len(images_to_deregister)} images found, {len(images_to_confirm)} less than three months '
+                f'old, {len(missing)} do not exist in this region or account.')
+    for image_id in images_to_confirm:
+        logger.info('         %s is less than three months old and needs confirmation.', image_id)
+    logger.debug('      Images not found: %s', sorted(missing))
+    for image_id in images_to_deregister:
+        logger.info('         %d snapshots for %s: %s', len(image_snapshots[image_id]), image_id,
+                    image_snapshots[image_id], extra=lp.DETAIL)
 
+    return images_to_deregister, images_to_confirm, image_snapshots, missing
 
-def deregister_image(ec2_client, image_id, dry_run, logger):
-    logger.info(f'   Trying deregistration of {image_id}...')
+
+def snapshot_references(image_snapshots, image_ids):
+    # Reference count of each snapshot over the given images. Images that are kept hold their references, so a
+    # snapshot shared with them is never deleted.
+    snapshot_refs = {}
+    for image_id in image_ids:
+        for snapshot_id in image_snapshots[image_id]:
+            snapshot_refs[snapshot_id] = snapshot_refs.get(snapshot_id, 0) + 1
+    return snapshot_refs
+
+
+def release_snapshots(snapshot_refs, snapshot_ids):
+    # Drop a deregistered image's references. Returns its snapshots that no other image uses any more; a snapshot
+    # shared by several images is only returned after the last of them.
+    ready = []
+    for snapshot_id in snapshot_ids:
+        snapshot_refs[snapshot_id] -= 1
+        if snapshot_refs[snapshot_id] == 0:
+            ready.append(snapshot_id)
+    return ready
+
+
+def record_snapshots(ledger, account_number, region_name, images_to_deregister, image_snapshots):
+    # Append the snapshots of the images to deregister to the region's snaps file next to the working file, for
+    # reference. The account is part of its name, so accounts sharing a region never overwrite each other's.
+    snapshot_ids = list(dict.fromkeys(snapshot_id for image_id in images_to_deregister
+                                      for snapshot_id in image_snapshots[image_id]))
+    directory, file_name = os.path.split(ledger.resource_ids_path)
+    idf.append_ids(f'{directory}/{account_number} {region_name} {file_name[:-len(".txt")]} snaps.txt', snapshot_ids)
+    return
+
+
+def record_dry_run(ledger, account_number, region_name, resource_name, images_to_deregister, images_to_confirm,
+                   missing, image_snapshots, verdict, failures, logger):
+    # Report the dry run of a region's images from the probe of deregister_image. Returns the images that would be
+    # deregistered.
+    outcomes = pp.plan(images_to_deregister, verdict, failures)
+    outcomes.update(pp.skipped(images_to_confirm, pp.TOO_NEW))
+    outcomes.update(pp.skipped(missing, pp.NOT_FOUND))
+    return pp.record(ledger, account_number, region_name, resource_name, outcomes, logger,
+                     {image_id: (pp.REGISTERED, image_snapshots[image_id]) for image_id in images_to_deregister})
+
+
+def record_snapshot_dry_run(ledger, account_number, region_name, resource_name, snapshot_ids, verdict, logger):
+    # The snapshots are not in the working file, so they are only reported, in a report of their own. Each is still
+    # used by its image, which no dry run deregisters, so the probed snapshots failing on their own state says
+    # nothing about them. Returns the number of snapshots that would be deleted.
+    snapshot_outcomes = pp.plan(snapshot_ids, verdict, {})
+    if snapshot_outcomes:
+        pp.report(ledger, account_number, region_name, f'{resource_name} snapshots', snapshot_outcomes, logger,
+                  suffix='snapshots dry run')
+    return sum(outcome == pp.WOULD_DELETE for outcome, reason in snapshot_outcomes.values())
+
+
+def deregister_image(ec2_client, image_id, dry_run, logger, limiter=None):
+    logger.info('   Trying deregistration of %s...', image_id, extra=lp.DETAIL)
     deregistered = False
     try:
-        response = ec2_client.deregister_image(ImageId=image_id, DryRun=dry_run)
-        logger.info(f'      {response}')
+        response = rl.call(limiter, ec2_client.deregister_image, ImageId=image_id, DryRun=dry_run)
+        logger.debug('      %s', response)
         deregistered = True
-    except botocore.exceptions.ClientError as e:
-        logger.info(f'      {e}')
-        if 'DryRunOperation' in str(e):
+    except er.AWS_ERRORS as e:
+        category = er.classify(e)
+        # Calls skipped by an open circuit are reported once for the region instead
+        if category != er.CIRCUIT_OPEN:
+            logger.info('      %s: %s', category, e, extra=lp.DETAIL)
+        if category == er.DRY_RUN:
             deregistered = True
 
     return deregistered
 
 
-def delete_snapshot(ec2_client, snapshot_id, dry_run, logger):
-    logger.info(f'   Trying deletion of {snapshot_id}...')
+def delete_snapshot(ec2_client, snapshot_id, dry_run, logger, limiter=None):
+    logger.info('   Trying deletion of %s...', snapshot_id, extra=lp.DETAIL)
     deleted = False
     try:
-        response = ec2_client.delete_snapshot(SnapshotId=snapshot_id, DryRun=dry_run)
-        logger.info(f'      {response}')
+        response = rl.call(limiter, ec2_client.delete_snapshot, SnapshotId=snapshot_id, DryRun=dry_run)
+        logger.debug('      %s', response)
         deleted = True
-    except botocore.exceptions.ClientError as e:
-        logger.info(f'      {e}')
-        if 'DryRunOperation' in str(e):
+    except er.AWS_ERRORS as e:
+        category = er.classify(e)
+        # Calls skipped by an open circuit are reported once for the region instead
+        if category != er.CIRCUIT_OPEN:
+            logger.info('      %s: %s', category, e, extra=lp.DETAIL)
+        if category == er.DRY_RUN:
             deleted = True
 
     return deleted
 
 
-def delete_images(ec2_client, client_name, region_name, resource_name, dry_run, run_date_time, three_months, logger):
-    resource_ids_file_name = f'{client_name} {resource_name}.txt'
-    deleted_ids_file_name = f'{client_name} {resource_name} deleted.txt'
-    error_ids_file_name = f'{client_name} {resource_name} errors.txt'
-    image_snaps_file_name = f'{client_name} {resource_name} snaps.txt'
+def delete_images(ec2_client, client_name, region_name, resource_name, dry_run, run_date_time, three_months, logger,
+                  region_ids=None, limiter=None, ledger=None, account_number=None):
     images_deregistered = 0
     snapshots_deleted = 0
 
-    # Delete image snapshot file if it exists, to avoid trying to delete snapshots in every region/account
-    try:
-        os.remove(f'{client_name}_{run_date_time}/{image_snaps_file_name}')
-    except FileNotFoundError:
-        logger.debug('\nImage snapshot file not found, skipping file deletion.')
-
-    # Read image IDs from file
-    try:
-        # Copy the resource ids file if a copy doesn't already exist
-        file_copy_path = f'{client_name}_{run_date_time}/INPUT {resource_ids_file_name}'
-        if not os.path.isfile(file_copy_path):
-            shutil.copy(f'{client_name}_{run_date_time}/{resource_ids_file_name}', file_copy_path)
-            logger.info('Initial copy of resource ID file was successful.')
-        # Read the resource file into a list
-        with open(f'{client_name}_{run_date_time}/{resource_ids_file_name}', 'r') as file:
-            image_ids = [line.strip() for line in file]
-            logger.info(f'Locating {len(image_ids)} images...')
-    except FileNotFoundError:
-        logger.info(f'File not found: {resource_ids_file_name}. Skipping image deregistration in {region_name}.')
+    if ledger is None:
+        ledger = lg.IdLedger(client_name, resource_name, run_date_time, logger, copy_prefix='INPUT')
+    if not ledger.exists:
+        logger.info(f'File not found: {client_name} {resource_name}.txt. '
+                    f'Skipping image deregistration in {region_name}.')
         return images_deregistered, snapshots_deleted
 
-    original_image_ids_length = len(image_ids)
-    images_to_deregister = []
-    images_to_confirm = []
-
-    # TODO: new logic
-    # for each image id:
-    #     send id to api function
-    #         return found boolean, confirm boolean & snapshot ids list
-    #     if not found:
-    #         add to not_processed list
-    #     else:
-    #         if confirm:
-    #             add to confirm list
-    #             add snaps to confirm_snaps list
-    #         else:
-    #             add to delete list
-    #             add snaps to delete_snaps list
-    #
-
-    # Search for each image ID. If it exists, add its EBS snapshot IDs to a list, and deregister the image
-    for image_id in image_ids:
-        image_snaps, confirm_image = get_image_snapshots(ec2_client, client_name, image_id, image_snaps_file_name,
-                                          run_date_time, three_months, logger)
-        if confirm_image:
-            images_to_confirm.append(image_id)
-        elif image_snaps and not confirm_image:
-            images_to_deregister.append(image_id)
-            logger.info(f'         {len(image_snaps)} snapshots for {image_id}: {image_snaps}')
-    if images_to_deregister:
-        logger.info(f'\nDeregistering {len(images_to_deregister)} images...')
-        del_file = open(f'{client_name}_{run_date_time}/{deleted_ids_file_name}', 'a')
-        err_file = open(f'{client_name}_{run_date_time}/{error_ids_file_name}', 'a')
-        errors_list = [line.strip() for line in err_file]
-        for image_id in images_to_deregister:
-            if image_id not in errors_list:
-                if deregister_image(ec2_client, image_id, dry_run, logger):
-                    images_deregistered += 1
-                    del_file.write(image_id + '\n')
-                    image_ids.remove(image_id)
-                else:
-                    err_file.write(image_id + '\n')
-        del_file.close()
-        err_file.close()
+    # Only search for unresolved images, limited to those the region inventory located in this region
+    image_ids = ledger.pending(region_ids)
+    logger.info(f'Locating {len(image_ids)} images...')
+
+    # Search for all image IDs in bulk, collecting each image's EBS snapshot IDs in the same pass
+    images_to_deregister, images_to_confirm, image_snapshots, missing = get_images(ec2_client, image_ids,
+                                                                                   three_months, logger)
+    ledger.mark_not_found(missing)
+
+    record_snapshots(ledger, account_number, region_name, images_to_deregister, image_snapshots)
+
+    snapshot_refs = snapshot_references(image_snapshots, images_to_deregister + images_to_confirm)
+    refs_lock = threading.Lock()
+
+    def deregister_and_delete_snapshots(image_id):
+        # Delete an image's snapshots as soon as it is deregistered. Returns whether the image was deregistered and
+        # the snapshot count.
+        if not deregister_image(ec2_client, image_id, dry_run, logger, limiter):
+            return False, 0
+        with refs_lock:
+            ready = release_snapshots(snapshot_refs, image_snapshots[image_id])
+        return True, sum(delete_snapshot(ec2_client, snapshot_id, dry_run, logger, limiter) for snapshot_id in ready)
+
+    if dry_run:
+        # One DryRun call per action for the region stands in for a call per image and snapshot. Snapshots are
+        # released by the images that would be deregistered, as in a run.
+        verdict, failures = pp.probe(account_number, region_name, 'deregister_image',
+                                     lambda image_id: rl.call(limiter, ec2_client.deregister_image, ImageId=image_id,
+                                                              DryRun=True), images_to_deregister, logger)
+        would_deregister = record_dry_run(ledger, account_number, region_name, resource_name, images_to_deregister,
+                                          images_to_confirm, missing, image_snapshots, verdict, failures, logger)
+        images_deregistered = len(would_deregister)
+        ready = [snapshot_id for image_id in would_deregister
+                 for snapshot_id in release_snapshots(snapshot_refs, image_snapshots[image_id])]
+        verdict, failures = pp.probe(account_number, region_name, 'delete_snapshot',
+                                     lambda snapshot_id: rl.call(limiter, ec2_client.delete_snapshot,
+                                                                 SnapshotId=snapshot_id, DryRun=True), ready, logger)
+        snapshots_deleted = record_snapshot_dry_run(ledger, account_number, region_name, resource_name, ready,
+                                                    verdict, logger)
+    elif images_to_deregister:
+        logger.info(f'\nDeregistering {len(images_to_deregister)} images and deleting their snapshots...')
+        results = rl.map_calls(limiter, deregister_and_delete_snapshots, images_to_deregister)
+        images_deregistered_list = [image_id for image_id, (deregistered, snapshot_count) in results if deregistered]
+        images_deregistered = len(images_deregistered_list)
+        snapshots_deleted = sum(snapshot_count for image_id, (deregistered, snapshot_count) in results)
+        ledger.mark_deleted(images_deregistered_list)
+        ledger.mark_errors([image_id for image_id, (deregistered, snapshot_count) in results if not deregistered])
+    else:
+        logger.info('\nNo images to deregister.')
+
+    # Rewrite the working file without the deregistered images; it is removed once it is empty
+    remaining_images = ledger.flush()
 
     logger.info(f'\nNumber of images deregistered: {images_deregistered}')
-    logger.info(f'Number of remaining images: {len(image_ids)}')
-
-    # Rewrite old images file if images were deregistered
-    if 0 < len(image_ids) < original_image_ids_length:
-        logger.info('Rewriting working images file...')
-        os.remove(f'{client_name}_{run_date_time}/{resource_ids_file_name}')
-        file = open(f'{client_name}_{run_date_time}/{resource_ids_file_name}', 'w')
-        for image_id in image_ids:
-            file.write(image_id + '\n')
-        file.close()
-    elif not image_ids:
-        os.remove(f'{client_name}_{run_date_time}/{resource_ids_file_name}')
+    logger.info(f'Number of snapshots deleted: {snapshots_deleted}')
+    logger.info(f'Number of remaining images: {remaining_images}')
+    if not remaining_images:
         logger.info('All images deregistered. Images file removed.')
 
-    # Read snapshot IDs from file
-    try:
-        with open(f'{client_name}_{run_date_time}/{image_snaps_file_name}', 'r') as file:
-            all_snapshot_ids = [line.strip() for line in file]
-        shutil.copy(f'{client_name}_{run_date_time}/{image_snaps_file_name}',
-                    f'{client_name}_{run_date_time}/{region_name} {image_snaps_file_name}')
-    except FileNotFoundError:
-        logger.info(f'\nAuto-generated file not found: {image_snaps_file_name}. No snapshots to delete.')
-        return images_deregistered, snapshots_deleted
-
-    # If there are snapshot IDs, delete the snapshots
-    if all_snapshot_ids:
-        logger.info(f'\nDeleting {len(all_snapshot_ids)} associated snapshots...')
-
-        for snapshot_id in all_snapshot_ids:
-            deleted = delete_snapshot(ec2_client, snapshot_id, dry_run, logger)
-            if deleted:
-                snapshots_deleted += 1
-    else:
-        logger.info('\nEmpty snapshot list. No snapshots to delete.')
-
-    logger.info(f'\nNumber of snapshots deleted: {snapshots_deleted}')
-
     return images_deregistered, snapshots_deleted
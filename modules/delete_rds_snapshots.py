@@ -1,171 +1,133 @@
-import botocore.exceptions
-import os
-import shutil
-
-
-def get_db_snapshot(rds_client, snapshot_id, logger):
-    error_msg = f'      {snapshot_id} is not an RDS snapshot in this region or account.'
-    logger.info(f'   Searching for {snapshot_id}...')
-    db_snapshot_exists = False
-
-    try:
-        response = rds_client.describe_db_snapshots(DBSnapshotIdentifier=snapshot_id)
-        if response['DBSnapshots']:
-            logger.info('      RDS snapshot found.')
-            db_snapshot_exists = True
+import modules.errors as er
+import modules.ledger as lg
+import modules.log_pipeline as lp
+import modules.permission_probe as pp
+import modules.rds_catalog as rc
+import modules.rate_limiter as rl
+
+
+def get_snapshots(snapshot_ids, catalog, logger):
+    # Resolve snapshot identifiers from the region's catalog of manual snapshots without any API calls. Returns the
+    # DB snapshots, the cluster (Aurora) snapshots and the missing identifiers.
+    rds_snapshots = []
+    aurora_snapshots = []
+    missing = []
+
+    for snap in snapshot_ids:
+        snapshot_kind = catalog.get(snap)
+        if snapshot_kind == rc.INSTANCE:
+            rds_snapshots.append(snap)
+        elif snapshot_kind == rc.CLUSTER:
+            aurora_snapshots.append(snap)
         else:
-            logger.info(error_msg)
-    except botocore.exceptions.ClientError as e:
-        logger.debug(e)
-        logger.info(error_msg)
+            missing.append(snap)
+    logger.info(f'   {len(rds_snapshots)} RDS snapshots and {len(aurora_snapshots)} Aurora snapshots found, '
+                f'{len(missing)} do not exist in this region or account.')
 
-    return db_snapshot_exists
+    return rds_snapshots, aurora_snapshots, missing
 
 
-def get_cluster_snapshot(rds_client, snapshot_id, logger):
-    error_msg = f'      {snapshot_id} is not an Aurora snapshot in this region or account.'
-    logger.info(f'   Searching for {snapshot_id}...')
-    cluster_snapshot_exists = False
-
-    try:
-        response = rds_client.describe_db_cluster_snapshots(DBClusterSnapshotIdentifier=snapshot_id)
-        if response['DBClusterSnapshots']:
-            logger.info('      Aurora snapshot found.')
-            cluster_snapshot_exists = True
-        else:
-            logger.info(error_msg)
-    except botocore.exceptions.ClientError as e:
-        logger.debug(e)
-        logger.info(error_msg)
-
-    return cluster_snapshot_exists
+def record_dry_run(ledger, account_number, region_name, resource_name, snapshots_to_delete, missing, catalog, logger):
+    # RDS has no DryRun parameter, so the report of a region's snapshots is worked out from the catalog alone
+    outcomes = pp.plan(snapshots_to_delete, (pp.UNPROBED, 'RDS has no DryRun'), {})
+    outcomes.update(pp.skipped(missing, pp.NOT_FOUND))
+    return pp.record(ledger, account_number, region_name, resource_name, outcomes, logger,
+                     {snap: (catalog[snap], []) for snap in snapshots_to_delete})
 
 
-def delete_db_snapshot(rds_client, snapshot_id, dry_run, logger):
-    logger.info(f'   Trying deletion of {snapshot_id}...')
+def delete_db_snapshot(rds_client, snapshot_id, dry_run, logger, limiter=None):
+    logger.info('   Trying deletion of %s...', snapshot_id, extra=lp.DETAIL)
     deleted = False
     if dry_run:
         logger.info('      Dry Run is set to True. There is no DryRun parameter for this API call. This message means '
-                    'some other logic failed and the API call was prevented here instead.')
+                    'some other logic failed and the API call was prevented here instead.', extra=lp.DETAIL)
     else:
         try:
-            response = rds_client.delete_db_snapshot(DBSnapshotIdentifier=snapshot_id)
-            logger.info(f'      {response}')
+            response = rl.call(limiter, rds_client.delete_db_snapshot, DBSnapshotIdentifier=snapshot_id)
+            logger.debug('      %s', response)
             deleted = True
-        except botocore.exceptions.ClientError as e:
-            logger.info(f'      {e}')
+        except er.AWS_ERRORS as e:
+            category = er.classify(e)
+            if category != er.CIRCUIT_OPEN:
+                logger.info('      %s: %s', category, e, extra=lp.DETAIL)
 
     return deleted
 
 
-def delete_cluster_snapshot(rds_client, snapshot_id, dry_run, logger):
-    logger.info(f'   Trying deletion of {snapshot_id}...')
+def delete_cluster_snapshot(rds_client, snapshot_id, dry_run, logger, limiter=None):
+    logger.info('   Trying deletion of %s...', snapshot_id, extra=lp.DETAIL)
     deleted = False
     if dry_run:
         logger.info('      Dry Run is set to True. There is no DryRun parameter for this API call. This message means '
-                    'some other logic failed and the API call was prevented here instead.')
+                    'some other logic failed and the API call was prevented here instead.', extra=lp.DETAIL)
     else:
         try:
-            response = rds_client.delete_cluster_snapshot(DBClusterSnapshotIdentifier=snapshot_id)
-            logger.info(f'      {response}')
+            response = rl.call(limiter, rds_client.delete_db_cluster_snapshot,
+                               DBClusterSnapshotIdentifier=snapshot_id)
+            logger.debug('      %s', response)
             deleted = True
-        except botocore.exceptions.ClientError as e:
-            logger.info(f'      {e}')
+        except er.AWS_ERRORS as e:
+            category = er.classify(e)
+            if category != er.CIRCUIT_OPEN:
+                logger.info('      %s: %s', category, e, extra=lp.DETAIL)
 
     return deleted
 
 
-def delete_snapshots(rds_client, client_name, region_name, resource_name, dry_run, run_date_time, logger):
-    resource_ids_file_name = f'{client_name} {resource_name}.txt'
-    deleted_ids_file_name = f'{client_name} {resource_name} deleted.txt'
-    error_ids_file_name = f'{client_name} {resource_name} errors.txt'
+def delete_snapshots(rds_client, client_name, region_name, resource_name, dry_run, run_date_time, logger,
+                     region_ids=None, limiter=None, ledger=None, catalog=None, account_number=None):
     snapshots_deleted = 0
 
-    # Copy the resource ids file if a copy doesn't already exist
-    file_copy_path = f'{client_name}_{run_date_time}/Copy of {resource_ids_file_name}'
-    if not os.path.isfile(file_copy_path):
-        shutil.copy(f'{client_name}_{run_date_time}/{resource_ids_file_name}', file_copy_path)
-        logger.info('Initial copy of resource ID file was successful.')
-
-    # Read snapshots from file
-    try:
-        with open(f'{client_name}_{run_date_time}/{resource_ids_file_name}', 'r') as file:
-            snapshots_list = [line.strip() for line in file]
-            logger.info(f'Locating {len(snapshots_list)} snapshots...')
-    except FileNotFoundError:
-        logger.info(f'File not found: {resource_ids_file_name}. Skipping snapshot deletion in {region_name}.')
+    if ledger is None:
+        ledger = lg.IdLedger(client_name, resource_name, run_date_time, logger)
+    if not ledger.exists:
+        logger.info(f'File not found: {client_name} {resource_name}.txt. Skipping snapshot deletion in {region_name}.')
         return snapshots_deleted
 
-    original_snapshots_list_length = len(snapshots_list)
-    rds_snapshots_to_delete = []
-    aurora_snapshots_to_delete = []
+    # Only search for unresolved snapshots, limited to those the region inventory located in this region
+    snapshots_list = ledger.pending(region_ids)
+    logger.info(f'Locating {len(snapshots_list)} snapshots...')
 
-    # Search for each snapshot. If it exists, delete the snapshot
-    for snap in snapshots_list:
-        if get_db_snapshot(rds_client, snap, logger):
-            rds_snapshots_to_delete.append(snap)
-        elif get_cluster_snapshot(rds_client, snap, logger):
-            aurora_snapshots_to_delete.append(snap)
-        else:
-            logger.info(f'         Skipping {snap}...')
+    # Classify each snapshot from the region's catalog of manual snapshots instead of probing it
+    if catalog is None:
+        try:
+            catalog = rc.build_catalog(rds_client)
+        except er.AWS_ERRORS as e:
+            logger.debug(e)
+            logger.info(f'   Unable to list RDS snapshots in {region_name}. Skipping snapshot deletion.')
+            return snapshots_deleted
+
+    rds_snapshots_to_delete, aurora_snapshots_to_delete, missing = get_snapshots(snapshots_list, catalog, logger)
+    ledger.mark_not_found(missing)
 
     # Double failsafe in place to prevent API calls if dry_run is set to True
     if dry_run:
-        logger.info(f'\n\nDry Run is set to True. There is no DryRun parameter for delete_db_snapshot or '
-                    f'delete_cluster_snapshot, so no API calls will be made in order to prevent resource deletion.'
-                    f'\nThere are {len(rds_snapshots_to_delete)} RDS snapshots and {len(aurora_snapshots_to_delete)} '
-                    f'Aurora snapshots that can be deleted in this region.')
-        if rds_snapshots_to_delete:
-            for snap_to_delete in rds_snapshots_to_delete:
-                snapshots_list.remove(snap_to_delete)
-        if aurora_snapshots_to_delete:
-            for snap_to_delete in aurora_snapshots_to_delete:
-                snapshots_list.remove(snap_to_delete)
+        record_dry_run(ledger, account_number, region_name, resource_name,
+                       rds_snapshots_to_delete + aurora_snapshots_to_delete, missing, catalog, logger)
     else:
+        results = []
         if rds_snapshots_to_delete:
             logger.info(f'\nDeleting {len(rds_snapshots_to_delete)} RDS snapshots...')
-            del_file = open(f'{client_name}_{run_date_time}/{deleted_ids_file_name}', 'a')
-            err_file = open(f'{client_name}_{run_date_time}/{error_ids_file_name}', 'a')
-            errors_list = [line.strip() for line in err_file]
-            for snap_to_delete in rds_snapshots_to_delete:
-                if snap_to_delete not in errors_list:
-                    if delete_db_snapshot(rds_client, snap_to_delete, dry_run, logger):
-                        snapshots_deleted += 1
-                        del_file.write(snap_to_delete + '\n')
-                        snapshots_list.remove(snap_to_delete)
-                else:
-                    err_file.write(snap_to_delete + '\n')
-            del_file.close()
-            err_file.close()
+            results += rl.map_calls(limiter, lambda snap_to_delete: delete_db_snapshot(rds_client, snap_to_delete,
+                                                                                       dry_run, logger, limiter),
+                                    rds_snapshots_to_delete)
         if aurora_snapshots_to_delete:
             logger.info(f'\nDeleting {len(aurora_snapshots_to_delete)} Aurora snapshots...')
-            del_file = open(f'{client_name}_{run_date_time}/{deleted_ids_file_name}', 'a')
-            err_file = open(f'{client_name}_{run_date_time}/{error_ids_file_name}', 'a')
-            errors_list = [line.strip() for line in err_file]
-            for snap_to_delete in aurora_snapshots_to_delete:
-                if snap_to_delete not in errors_list:
-                    if delete_cluster_snapshot(rds_client, snap_to_delete, dry_run, logger):
-                        snapshots_deleted += 1
-                        del_file.write(snap_to_delete + '\n')
-                        snapshots_list.remove(snap_to_delete)
-                else:
-                    err_file.write(snap_to_delete + '\n')
-            del_file.close()
-            err_file.close()
+            results += rl.map_calls(limiter, lambda snap_to_delete: delete_cluster_snapshot(rds_client,
+                                                                                            snap_to_delete, dry_run,
+                                                                                            logger, limiter),
+                                    aurora_snapshots_to_delete)
+        deleted_snapshots = [snap_to_delete for snap_to_delete, deleted in results if deleted]
+        snapshots_deleted = len(deleted_snapshots)
+        ledger.mark_deleted(deleted_snapshots)
+        ledger.mark_errors([snap_to_delete for snap_to_delete, deleted in results if not deleted])
+
+    # Rewrite the working file without the deleted snapshots; it is removed once it is empty
+    remaining_snapshots = ledger.flush()
 
     logger.info(f'\nNumber of snapshots deleted: {snapshots_deleted}')
-    logger.info(f'Number of remaining snapshots: {len(snapshots_list)}')
-
-    # Rewrite snapshots file if snapshots were deleted
-    if 0 < len(snapshots_list) < original_snapshots_list_length:
-        logger.info('Rewriting working snapshots file...')
-        os.remove(f'{client_name}_{run_date_time}/{resource_ids_file_name}')
-        file = open(f'{client_name}_{run_date_time}/{resource_ids_file_name}', 'w')
-        for snap in snapshots_list:
-            file.write(snap + '\n')
-        file.close()
-    elif not snapshots_list:
-        os.remove(f'{client_name}_{run_date_time}/{resource_ids_file_name}')
+    logger.info(f'Number of remaining snapshots: {remaining_snapshots}')
+    if not remaining_snapshots:
         if dry_run:
             logger.info('No snapshots deleted, but all snapshots were found. Snapshots file removed.')
         else:
@@ -1,99 +1,111 @@
-import botocore.exceptions
-import os
-import shutil
+import modules.chunks as chunks
+import modules.errors as er
+import modules.ledger as lg
+import modules.log_pipeline as lp
+import modules.permission_probe as pp
+import modules.rate_limiter as rl
 
 
-def get_volume(ec2_client, volume_id, logger):
-    error_msg = f'      The volume {volume_id} does not exist in this region or account.'
-    logger.info(f'   Searching for {volume_id}...')
-    volume_exists = False
+# (operation, result key, ID key, filter, arguments) of the describe of volume IDs
+DESCRIBE = ('describe_volumes', 'Volumes', 'VolumeId', 'volume-id', {})
 
-    try:
-        response = ec2_client.describe_volumes(VolumeIds=[volume_id])
-        if response['Volumes']:
-            logger.info('      Volume found.')
-            volume_exists = True
+
+def get_volumes(ec2_client, volume_ids, logger):
+    # Resolve volume IDs in chunks. Returns sets of available, missing and in-use volume IDs.
+    volumes, unsearched = chunks.search(ec2_client, DESCRIBE, volume_ids, 'volumes', logger)
+    return sort_volumes(volumes, volume_ids, unsearched, logger)
+
+
+def sort_volumes(volumes, volume_ids, unsearched, logger):
+    # Sort the described volumes of volume_ids into available and in-use volumes. IDs that were not searched are
+    # neither found nor missing.
+    found = set()
+    in_use = set()
+    for volume in volumes:
+        if volume['State'] == 'available':
+            found.add(volume['VolumeId'])
         else:
-            logger.info(error_msg)
-    except botocore.exceptions.ClientError as e:
-        logger.debug(e)
-        logger.info(error_msg)
+            in_use.add(volume['VolumeId'])
+            logger.info('      The volume %s is %s and will be skipped.', volume['VolumeId'], volume['State'],
+                        extra=lp.DETAIL)
+
+    missing = set(volume_ids) - found - in_use - unsearched
+    logger.info(f'      {len(found)} volumes found, {len(in_use)} in use, '
+                f'{len(missing)} do not exist in this region or account.')
+    logger.debug('      Volumes not found: %s', sorted(missing))
 
-    return volume_exists
+    return found, missing, in_use
 
 
-def delete_volume(ec2_client, volume_id, dry_run, logger):
-    logger.info(f'   Trying deletion of {volume_id}...')
+def delete_volume(ec2_client, volume_id, dry_run, logger, limiter=None):
+    logger.info('   Trying deletion of %s...', volume_id, extra=lp.DETAIL)
     deleted = False
     try:
-        response = ec2_client.delete_volume(VolumeId=volume_id, DryRun=dry_run)
-        logger.info(f'      {response}')
+        response = rl.call(limiter, ec2_client.delete_volume, VolumeId=volume_id, DryRun=dry_run)
+        logger.debug('      %s', response)
         deleted = True
-    except botocore.exceptions.ClientError as e:
-        logger.info(f'      {e}')
-        if 'DryRunOperation' in str(e):
+    except er.AWS_ERRORS as e:
+        category = er.classify(e)
+        # Calls skipped by an open circuit are reported once for the region instead
+        if category != er.CIRCUIT_OPEN:
+            logger.info('      %s: %s', category, e, extra=lp.DETAIL)
+        if category == er.DRY_RUN:
             deleted = True
 
     return deleted
 
 
-def delete_volumes(ec2_client, client_name, region_name, resource_name, dry_run, run_date_time, logger):
-    resource_ids_file_name = f'{client_name} {resource_name}.txt'
-    deleted_ids_file_name = f'{client_name} {resource_name} deleted.txt'
-    error_ids_file_name = f'{client_name} {resource_name} errors.txt'
-    volumes_deleted = 0
+def record_dry_run(ledger, account_number, region_name, resource_name, volumes_to_delete, in_use, missing, verdict,
+                   failures, logger):
+    # Report the dry run of a region's volumes from the probe of delete_volume. Returns the volumes that would be
+    # deleted.
+    outcomes = pp.plan(volumes_to_delete, verdict, failures)
+    outcomes.update(pp.skipped(in_use, pp.IN_USE))
+    outcomes.update(pp.skipped(missing, pp.NOT_FOUND))
+    return pp.record(ledger, account_number, region_name, resource_name, outcomes, logger,
+                     {volume_id: (pp.AVAILABLE, []) for volume_id in volumes_to_delete})
 
-    # Copy the resource ids file if a copy doesn't already exist
-    file_copy_path = f'{client_name}_{run_date_time}/Copy of {resource_ids_file_name}'
-    if not os.path.isfile(file_copy_path):
-        shutil.copy(f'{client_name}_{run_date_time}/{resource_ids_file_name}', file_copy_path)
-        logger.info('Initial copy of resource ID file was successful.')
 
-    # Read volumes from file
-    try:
-        with open(f'{client_name}_{run_date_time}/{resource_ids_file_name}', 'r') as file:
-            volumes_list = [line.strip() for line in file]
-            logger.info(f'Locating {len(volumes_list)} volumes...')
-    except FileNotFoundError:
-        logger.info(f'File not found: {resource_ids_file_name}. Skipping volume deletion in {region_name}.')
-        return volumes_deleted
+def delete_volumes(ec2_client, client_name, region_name, resource_name, dry_run, run_date_time, logger,
+                   region_ids=None, limiter=None, ledger=None, account_number=None):
+    volumes_deleted = 0
 
-    original_volumes_list_length = len(volumes_list)
-    volumes_to_delete = []
+    if ledger is None:
+        ledger = lg.IdLedger(client_name, resource_name, run_date_time, logger)
+    if not ledger.exists:
+        logger.info(f'File not found: {client_name} {resource_name}.txt. Skipping volume deletion in {region_name}.')
+        return volumes_deleted
 
-    # Search for each volume. If it exists, delete the volume
-    for volume in volumes_list:
-        if get_volume(ec2_client, volume, logger):
-            volumes_to_delete.append(volume)
-    if volumes_to_delete:
+    # Only search for unresolved volumes, limited to those the region inventory located in this region
+    volumes_list = ledger.pending(region_ids)
+    logger.info(f'Locating {len(volumes_list)} volumes...')
+
+    # Search for all volumes in bulk. If a volume is available, delete the volume
+    found, missing, in_use = get_volumes(ec2_client, volumes_list, logger)
+    ledger.mark_not_found(missing)
+    volumes_to_delete = [volume for volume in volumes_list if volume in found]
+    if dry_run:
+        # One DryRun call for the region stands in for a call per volume
+        verdict, failures = pp.probe(account_number, region_name, 'delete_volume',
+                                     lambda volume_id: rl.call(limiter, ec2_client.delete_volume, VolumeId=volume_id,
+                                                               DryRun=True), volumes_to_delete, logger)
+        volumes_deleted = len(record_dry_run(ledger, account_number, region_name, resource_name, volumes_to_delete,
+                                             in_use, missing, verdict, failures, logger))
+    elif volumes_to_delete:
         logger.info(f'\nDeleting {len(volumes_to_delete)} volumes...')
-        del_file = open(f'{client_name}_{run_date_time}/{deleted_ids_file_name}', 'a')
-        err_file = open(f'{client_name}_{run_date_time}/{error_ids_file_name}', 'a')
-        errors_list = [line.strip() for line in err_file]
-        for vol_to_delete in volumes_to_delete:
-            if vol_to_delete not in errors_list:
-                if delete_volume(ec2_client, vol_to_delete, dry_run, logger):
-                    volumes_deleted += 1
-                    del_file.write(vol_to_delete + '\n')
-                    volumes_list.remove(vol_to_delete)
-                else:
-                    err_file.write(vol_to_delete + '\n')
-        del_file.close()
-        err_file.close()
+        results = rl.map_calls(limiter, lambda vol_to_delete: delete_volume(ec2_client, vol_to_delete, dry_run,
+                                                                            logger, limiter), volumes_to_delete)
+        deleted_volumes = [vol_to_delete for vol_to_delete, deleted in results if deleted]
+        volumes_deleted = len(deleted_volumes)
+        ledger.mark_deleted(deleted_volumes)
+        ledger.mark_errors([vol_to_delete for vol_to_delete, deleted in results if not deleted])
+
+    # Rewrite the working file without the deleted volumes; it is removed once it is empty
+    remaining_volumes = ledger.flush()
 
     logger.info(f'\nNumber of volumes deleted: {volumes_deleted}')
-    logger.info(f'Number of remaining volumes: {len(volumes_list)}')
-
-    # Rewrite volumes file if volumes were deleted
-    if 0 < len(volumes_list) < original_volumes_list_length:
-        logger.info('Rewriting working volumes file...')
-        os.remove(f'{client_name}_{run_date_time}/{resource_ids_file_name}')
-        file = open(f'{client_name}_{run_date_time}/{resource_ids_file_name}', 'w')
-        for volume in volumes_list:
-            file.write(volume + '\n')
-        file.close()
-    elif not volumes_list:
-        os.remove(f'{client_name}_{run_date_time}/{resource_ids_file_name}')
+    logger.info(f'Number of remaining volumes: {remaining_volumes}')
+    if not remaining_volumes:
         logger.info('All volumes deleted. Volumes file removed.')
 
     return volumes_deleted
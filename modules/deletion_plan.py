@@ -0,0 +1,148 @@
+import json
+import os
+import threading
+import modules.errors as er
+import modules.id_router as rt
+import modules.inventory as inv
+import modules.ip_catalog as ic
+import modules.permission_probe as pp
+import modules.rds_catalog as rc
+from datetime import datetime
+
+PLAN_DIRECTORY = 'plans'
+
+# Bumped whenever the layout of a plan changes; plans of any other version are refused
+PLAN_VERSION = 1
+
+# Columns of each row of a plan, one row per resource that would be deleted
+COLUMNS = ('client', 'account', 'region', 'type', 'id', 'state', 'dependencies')
+
+# Plans loaded by this process, keyed by path
+_plans = {}
+_plans_guard = threading.Lock()
+
+
+def plan_path(run_date_time, directory=PLAN_DIRECTORY):
+    return f'{directory}/plan_{run_date_time}.json'
+
+
+def read_report(path):
+    # Yield each line of a dry run report as a dict of its columns
+    if not os.path.isfile(path):
+        return
+    with open(path, 'r') as file:
+        for line in file:
+            yield dict(zip(pp.REPORT_COLUMNS, line.rstrip('\n').split('\t')))
+
+
+def write_plan(clients_dict, client_keys, resource_keys, resources_dict, run_date_time, logger):
+    # Collect every resource the dry run found would be deleted, from the dry run reports of each client, into one
+    # plan file. Returns the plan's path, or None when nothing would be deleted.
+    rows = {}
+    for client_key in client_keys:
+        client_name = clients_dict[client_key]['name']
+        for key in resource_keys:
+            for line in read_report(f'{client_name}_{run_date_time}/{client_name} {resources_dict[key]} dry run.txt'):
+                if line['outcome'] != pp.WOULD_DELETE:
+                    continue
+                # A resumed dry run can report a resource twice; the last report wins
+                dependencies = line.get('dependencies')
+                rows[(client_key, line['account'], line['region'], key, line['id'])] = \
+                    [client_key, line['account'], line['region'], key, line['id'], line.get('state', ''),
+                     dependencies.split(',') if dependencies else []]
+
+    if not rows:
+        logger.info('\nNothing would be deleted, so no deletion plan was written.')
+        return None
+
+    plan = {'version': PLAN_VERSION, 'run': run_date_time, 'created': datetime.now().isoformat(timespec='seconds'),
+            'clients': client_keys, 'resources': resource_keys, 'columns': list(COLUMNS), 'rows': list(rows.values())}
+    path = plan_path(run_date_time)
+    os.makedirs(PLAN_DIRECTORY, exist_ok=True)
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(plan, file, separators=(',', ':'))
+    os.replace(f'{path}.tmp', path)
+    logger.info(f'\nDeletion plan of {len(rows)} resources written to {path}.'
+                f'\nDelete them without searching for them again with: python main.py --apply {path}')
+    return path
+
+
+def load_plan(path, clients_dict, resources_dict):
+    # Read a plan file and index its rows by client, account and region
+    with open(path, 'r') as file:
+        plan = json.load(file)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError(f'Plan version {plan.get("version")} is not supported. This program reads version '
+                         f'{PLAN_VERSION}; write a new plan with a dry run.')
+    for client_key in plan['clients']:
+        if client_key not in clients_dict:
+            raise ValueError(f'Unknown client "{client_key}" in plan file.')
+    for key in plan['resources']:
+        if key not in resources_dict:
+            raise ValueError(f'Unknown resource "{key}" in plan file.')
+
+    plan['path'] = path
+    plan['index'] = {}
+    for client_key, account_number, region_name, key, resource_id, state, dependencies in plan['rows']:
+        plan['index'].setdefault((client_key, account_number, region_name), {}).setdefault(key, {})[resource_id] = \
+            (state, dependencies)
+    return plan
+
+
+def cached_plan(path, clients_dict, resources_dict):
+    # Workers of a farm run load the plan once per process
+    with _plans_guard:
+        if path not in _plans:
+            _plans[path] = load_plan(path, clients_dict, resources_dict)
+        return _plans[path]
+
+
+def planned(plan, client_key, account_number, region_name, resource_keys=None):
+    # {resource key: {ID: (state, dependency IDs)}} of what the plan deletes for a client in one account and region
+    planned_ids = plan['index'].get((client_key, account_number, region_name), {})
+    return {key: resource_ids for key, resource_ids in planned_ids.items()
+            if resource_keys is None or key in resource_keys}
+
+
+def write_resource_ids(plan, client_key, client_name, resources_dict, run_date_time, logger):
+    # Write the client's planned IDs to the working ID files, in place of the entry dialogs or a batch's sources.
+    # Returns the number of IDs written per resource key.
+    resource_ids = {}
+    for (plan_client_key, account_number, region_name), planned_ids in plan['index'].items():
+        if plan_client_key == client_key:
+            for key, ids in planned_ids.items():
+                resource_ids.setdefault(key, {}).update(dict.fromkeys(ids))
+
+    counts = rt.write_ids(((key, resource_id) for key in plan['resources']
+                           for resource_id in resource_ids.get(key, ())), client_name, resources_dict, run_date_time)
+    for key, count in counts.items():
+        logger.info(f'"{client_name} {resources_dict[key]}.txt" written successfully with {count} planned IDs.')
+    return counts
+
+
+def check_region(session, planned_ids, region_name, logger, account_number):
+    # The inventory of a region when a plan is applied: its planned IDs, so nothing is listed again. The planned IPs
+    # and RDS snapshots are described to catalog their current state; the other resource types are described by
+    # their deletion modules, which only ask for the planned IDs. A catalog that cannot be checked is built from the
+    # region's listing instead.
+    inventory = {}
+    for key, resource_ids in planned_ids.items():
+        inventory.setdefault(inv.RESOURCE_INVENTORY_TYPES[key], set()).update(resource_ids)
+
+    if '4' in planned_ids:
+        try:
+            ic.store_catalog(account_number, region_name,
+                             ic.check_catalog(session.client('ec2'), list(planned_ids['4'])))
+        except er.AWS_ERRORS as e:
+            logger.debug(e)
+            logger.info(f'   Unable to check the planned IPs in {region_name}. They will be listed instead.')
+    if '6' in planned_ids:
+        kinds = {identifier: state for identifier, (state, dependencies) in planned_ids['6'].items()}
+        try:
+            rc.store_catalog(account_number, region_name, rc.check_catalog(session.client('rds'), kinds))
+        except er.AWS_ERRORS as e:
+            logger.debug(e)
+            logger.info(f'   Unable to check the planned RDS snapshots in {region_name}. They will be listed '
+                        f'instead.')
+
+    return inventory
@@ -0,0 +1,110 @@
+import botocore.exceptions
+
+# Categories of failed API calls, worked out from botocore error codes and exception types
+NOT_FOUND = 'not found'
+THROTTLED = 'throttled'
+DENIED = 'denied'
+DEPENDENCY = 'dependency violation'
+TRANSIENT = 'transient'
+# A DryRun call that would have succeeded
+DRY_RUN = 'dry run'
+# A call skipped without being made, because its account, region and service are failing or out of time
+CIRCUIT_OPEN = 'circuit open'
+OTHER = 'other'
+
+# Exceptions of a failed API call: error responses, and timeouts and connection errors that have no response
+AWS_ERRORS = (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError)
+
+THROTTLE_ERROR_CODES = {
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'SlowDown'
+}
+
+# The caller may not make the call at all, e.g. an IAM or SCP denial or a region the account has not opted in to
+DENIED_ERROR_CODES = {
+    'UnauthorizedOperation',
+    'AccessDenied',
+    'AccessDeniedException',
+    'AuthFailure',
+    'OptInRequired',
+    'UnrecognizedClientException',
+    'InvalidClientTokenId',
+    'ExpiredToken',
+    'ExpiredTokenException',
+    'SignatureDoesNotMatch',
+    'Blocked'
+}
+
+# The resource exists but something still uses it or it is in the wrong state to be deleted
+DEPENDENCY_ERROR_CODES = {
+    'DependencyViolation',
+    'IncorrectState',
+    'InvalidState',
+    'VolumeInUse',
+    'InvalidSnapshot.InUse',
+    'InvalidIPAddress.InUse',
+    'InvalidDBSnapshotState',
+    'InvalidDBSnapshotStateFault',
+    'InvalidDBClusterSnapshotStateFault'
+}
+
+# Also any error code ending in NotFound or NotFoundFault
+NOT_FOUND_ERROR_CODES = {'InvalidAMIID.Unavailable'}
+
+TRANSIENT_ERROR_CODES = {
+    'InternalError',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'Unavailable',
+    'RequestTimeout',
+    'RequestTimeoutException',
+    'PriorRequestNotComplete'
+}
+
+DRY_RUN_ERROR_CODE = 'DryRunOperation'
+CIRCUIT_OPEN_ERROR_CODE = 'CircuitOpen'
+
+# Exceptions raised when no response arrived at all
+TRANSIENT_EXCEPTIONS = (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)
+
+
+def error_code(e):
+    # The error code of a failed call, or the exception's name when there was no error response
+    if isinstance(e, botocore.exceptions.ClientError):
+        return e.response.get('Error', {}).get('Code')
+    return type(e).__name__
+
+
+def classify_code(code, status_code=None):
+    # The category of an error response's code, falling back on its HTTP status
+    if code == DRY_RUN_ERROR_CODE:
+        return DRY_RUN
+    if code == CIRCUIT_OPEN_ERROR_CODE:
+        return CIRCUIT_OPEN
+    if code in THROTTLE_ERROR_CODES:
+        return THROTTLED
+    if code in DENIED_ERROR_CODES:
+        return DENIED
+    if code in DEPENDENCY_ERROR_CODES:
+        return DEPENDENCY
+    if code in NOT_FOUND_ERROR_CODES or (code or '').endswith(('NotFound', 'NotFoundFault')):
+        return NOT_FOUND
+    if code in TRANSIENT_ERROR_CODES or (status_code or 0) >= 500:
+        return TRANSIENT
+    return OTHER
+
+
+def classify(e):
+    # The category of a failed call's exception
+    if isinstance(e, botocore.exceptions.ClientError):
+        return classify_code(error_code(e), e.response.get('ResponseMetadata', {}).get('HTTPStatusCode'))
+    if isinstance(e, TRANSIENT_EXCEPTIONS):
+        return TRANSIENT
+    return OTHER
+
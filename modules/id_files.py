@@ -0,0 +1,72 @@
+import mmap
+import os
+import shutil
+import threading
+
+# Files at least this large are read through a memory map instead of buffered reads
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# Regions and accounts of a client can be processed concurrently and share the same working ID files,
+# so every read-modify-write of a file happens under that file's lock.
+_file_locks = {}
+_file_locks_guard = threading.Lock()
+
+
+def file_lock(path):
+    with _file_locks_guard:
+        if path not in _file_locks:
+            _file_locks[path] = threading.Lock()
+        return _file_locks[path]
+
+
+def copy_file_once(path, copy_path, logger):
+    with file_lock(copy_path):
+        if not os.path.isfile(copy_path) and os.path.isfile(path):
+            shutil.copy(path, copy_path)
+            logger.info('Initial copy of resource ID file was successful.')
+    return
+
+
+def read_ids(path, missing_ok=False):
+    with file_lock(path):
+        try:
+            with open(path, 'r') as file:
+                return [line.strip() for line in file]
+        except FileNotFoundError:
+            if missing_ok:
+                return []
+            raise
+
+
+def append_ids(path, resource_ids):
+    if resource_ids:
+        with file_lock(path):
+            with open(path, 'a') as file:
+                for resource_id in resource_ids:
+                    file.write(resource_id + '\n')
+    return
+
+
+def iter_id_chunks(path, chunk_size, offset=0):
+    # Yield the IDs of a file in lists of at most chunk_size, each with the byte offset just past its last line,
+    # so memory stays bounded by chunk_size however large the file is. Reading starts at offset.
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size >= MMAP_THRESHOLD:
+            source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            source = file
+        try:
+            source.seek(offset)
+            chunk = []
+            for line in iter(source.readline, b''):
+                resource_id = line.strip().decode('utf-8')
+                if resource_id:
+                    chunk.append(resource_id)
+                if len(chunk) >= chunk_size:
+                    yield chunk, source.tell()
+                    chunk = []
+            if chunk:
+                yield chunk, source.tell()
+        finally:
+            if source is not file:
+                source.close()
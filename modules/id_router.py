@@ -0,0 +1,138 @@
+import re
+
+# EC2 IDs are a prefix and 8 or 17 hex digits
+EC2_ID = r'[0-9a-f]{8}(?:[0-9a-f]{9})?'
+OCTET = r'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+
+# An RDS snapshot may be given by its ARN, e.g. arn:aws:rds:us-east-1:123456789012:snapshot:name, and is reduced to
+# its identifier
+RDS_ARN = r'arn:aws[a-z-]*:rds:[a-z0-9-]*:[0-9]*:(?:cluster-)?snapshot:'
+RDS_IDENTIFIER = r'[a-z][a-z0-9]*(?:-[a-z0-9]+)*'
+
+# One pattern classifies every line of a buffer in a single pass. Surrounding whitespace, tabs and quotes
+# from Excel are dropped. Manual RDS snapshot identifiers start with a letter and contain letters, digits and
+# single hyphens, up to 255 characters. Automated snapshots are named rds:<identifier>; anything else is captured
+# as other.
+LINE_PATTERN = re.compile(
+    rf'^[ \t"\']*(?:(?P<image>ami-{EC2_ID})|(?P<snapshot>snap-{EC2_ID})|(?P<volume>vol-{EC2_ID})|'
+    rf'(?P<ip>{OCTET}(?:\.{OCTET}){{3}})|(?P<automated>(?:{RDS_ARN})?rds:{RDS_IDENTIFIER})|'
+    rf'(?:{RDS_ARN})?(?P<rds>(?!(?:ami|snap|vol)-){RDS_IDENTIFIER})|'
+    rf'(?P<other>.*?))[ \t\r"\']*$',
+    re.IGNORECASE | re.MULTILINE)
+
+# Resource keys each ID type can be deleted by
+TYPE_KEYS = {
+    'image': ('1', '2'),
+    'snapshot': ('3',),
+    'ip': ('4',),
+    'volume': ('5',),
+    'rds': ('6',)
+}
+
+ACCEPTED = 'accepted'
+MOVED = 'moved'
+DUPLICATE = 'duplicate'
+INVALID = 'invalid'
+NOT_SELECTED = 'not selected'
+# Automated RDS snapshots are deleted by RDS when their retention period ends and cannot be deleted by anyone else
+AUTOMATED = 'automated snapshot, which cannot be deleted'
+
+
+def classify(text):
+    # Yield (id type, normalized ID) for each non-blank line of text; the type is None when the line is no ID and
+    # 'automated' for an automated RDS snapshot
+    for match in LINE_PATTERN.finditer(text):
+        id_type = match.lastgroup
+        value = match.group(id_type)
+        if not value:
+            continue
+        if id_type == 'other' or (id_type == 'rds' and len(value) > 255):
+            yield None, value
+        else:
+            yield id_type, value.lower()
+
+
+class IdRouter:
+    # Strips, de-duplicates and validates IDs before any API call, and sends each ID to the resource type its
+    # format belongs to, whichever box or column it was entered in. Names that are only valid as RDS
+    # identifiers are only accepted for RDS, so a typo in an EC2 box is never deleted as an RDS snapshot.
+
+    def __init__(self, resource_keys):
+        self.resource_keys = resource_keys
+        self.counts = {key: {ACCEPTED: 0, MOVED: 0, DUPLICATE: 0, INVALID: 0, NOT_SELECTED: 0, AUTOMATED: 0}
+                       for key in resource_keys}
+        self.rejected = []
+        self._seen = set()
+
+    def _target(self, key, id_type):
+        if id_type is None:
+            return None
+        if key in TYPE_KEYS[id_type]:
+            return key
+        if id_type == 'rds':
+            return None
+        for target in TYPE_KEYS[id_type]:
+            if target in self.resource_keys:
+                return target
+        return NOT_SELECTED
+
+    def route(self, key, text):
+        # Yield (resource key, ID) for every valid, first-seen ID in text entered for resource key
+        counts = self.counts[key]
+        for id_type, resource_id in classify(text):
+            if id_type == 'automated':
+                counts[AUTOMATED] += 1
+                self.rejected.append((key, resource_id, AUTOMATED))
+                continue
+            target = self._target(key, id_type)
+            if target is None:
+                counts[INVALID] += 1
+                self.rejected.append((key, resource_id, INVALID))
+            elif target == NOT_SELECTED:
+                counts[NOT_SELECTED] += 1
+                self.rejected.append((key, resource_id, f'{id_type} not selected'))
+            elif resource_id in self._seen:
+                counts[DUPLICATE] += 1
+            else:
+                self._seen.add(resource_id)
+                counts[ACCEPTED if target == key else MOVED] += 1
+                yield target, resource_id
+
+    def log_summary(self, client_name, resources_dict, logger):
+        for key, counts in self.counts.items():
+            logger.info(f'{client_name} {resources_dict[key]}: {counts[ACCEPTED]} IDs accepted, '
+                        f'{counts[MOVED]} moved to their resource type, {counts[DUPLICATE]} duplicates skipped, '
+                        f'{counts[INVALID]} invalid and {counts[NOT_SELECTED]} of unselected types rejected.')
+            if counts[AUTOMATED]:
+                logger.info(f'{client_name} {resources_dict[key]}: {counts[AUTOMATED]} automated RDS snapshots '
+                            f'(rds:...) rejected. RDS deletes automated snapshots itself when their retention period '
+                            f'ends; only manual snapshots can be deleted.')
+        for key, resource_id, reason in self.rejected:
+            logger.debug('   Rejected %s entered for %s: %s.', resource_id, resources_dict[key], reason)
+        return
+
+    def write_rejected(self, path, resources_dict):
+        # Rejected entries are kept for the record, with the resource type they were entered for and why
+        if self.rejected:
+            with open(path, 'w') as file:
+                for key, resource_id, reason in self.rejected:
+                    file.write(f'{resource_id}\t{resources_dict[key]}\t{reason}\n')
+        return
+
+
+def write_ids(routed_ids, client_name, resources_dict, run_date_time):
+    # Write (resource key, ID) pairs to each resource type's working file, creating the file on its first ID.
+    # Returns the number of IDs written per resource key.
+    files = {}
+    counts = {}
+    try:
+        for key, resource_id in routed_ids:
+            if key not in files:
+                files[key] = open(f'{client_name}_{run_date_time}/{client_name} {resources_dict[key]}.txt', 'w')
+                counts[key] = 0
+            files[key].write(resource_id + '\n')
+            counts[key] += 1
+    finally:
+        for file in files.values():
+            file.close()
+    return counts
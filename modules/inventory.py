@@ -0,0 +1,138 @@
+import modules.errors as er
+import modules.inventory_cache as ivc
+import modules.ip_catalog as ic
+import modules.rds_catalog as rc
+
+# Resource keys from main.resources_dict mapped to the inventory that holds their IDs
+RESOURCE_INVENTORY_TYPES = {
+    '1': 'images',
+    '2': 'images',
+    '3': 'snapshots',
+    '4': 'addresses',
+    '5': 'volumes',
+    '6': 'rds_snapshots'
+}
+
+
+def list_images(ec2_client, rds_client):
+    paginator = ec2_client.get_paginator('describe_images')
+    return {image['ImageId'] for page in paginator.paginate(Owners=['self']) for image in page['Images']}
+
+
+def list_snapshots(ec2_client, rds_client):
+    paginator = ec2_client.get_paginator('describe_snapshots')
+    return {snapshot['SnapshotId'] for page in paginator.paginate(OwnerIds=['self'])
+            for snapshot in page['Snapshots']}
+
+
+def list_addresses(ec2_client, rds_client):
+    # The catalog maps each IP to its allocation and association; its keys are the inventory
+    return ic.build_catalog(ec2_client)
+
+
+def list_volumes(ec2_client, rds_client):
+    paginator = ec2_client.get_paginator('describe_volumes')
+    return {volume['VolumeId'] for page in paginator.paginate() for volume in page['Volumes']}
+
+
+def list_rds_snapshots(ec2_client, rds_client):
+    # The catalog maps each snapshot identifier to its kind; its keys are the inventory
+    return rc.build_catalog(rds_client)
+
+
+INVENTORY_LISTERS = {
+    'images': list_images,
+    'snapshots': list_snapshots,
+    'addresses': list_addresses,
+    'volumes': list_volumes,
+    'rds_snapshots': list_rds_snapshots
+}
+
+
+def get_region_inventory(session, resource_keys, region_name, logger, account_number=None):
+    # Take one inventory per resource type needed for the selected resources. A type whose inventory
+    # could not be taken maps to None, so its IDs are searched for directly instead of being routed.
+    # The RDS snapshot and IP catalogs are kept for the run, so deletion classifies them without new calls.
+    # Inventories an earlier run took within the cache's TTL are read from the cache instead of listed again. A
+    # cached address inventory only routes IPs; they are released from a catalog listed again when they are deleted.
+    ec2 = session.client('ec2')
+    rds = session.client('rds')
+    inventory = {}
+
+    for inventory_type in {RESOURCE_INVENTORY_TYPES[key] for key in resource_keys}:
+        cached = None if account_number is None else ivc.cached_inventory(account_number, region_name,
+                                                                          inventory_type)
+        try:
+            if cached is not None:
+                inventory[inventory_type], age = cached
+                logger.debug(f'   Using the {inventory_type} inventory of {region_name} cached {age:.0f} seconds ago.')
+            else:
+                inventory[inventory_type] = INVENTORY_LISTERS[inventory_type](ec2, rds)
+                if account_number is not None:
+                    # Only the IPs are cached. Whether an IP is associated changes at any time, so the IP catalog
+                    # that decides what is released is only ever the one listed in this run.
+                    ivc.store_inventory(account_number, region_name, inventory_type,
+                                        set(inventory[inventory_type]) if inventory_type == 'addresses'
+                                        else inventory[inventory_type])
+                    if inventory_type == 'addresses':
+                        ic.store_catalog(account_number, region_name, inventory[inventory_type])
+            if inventory_type == 'rds_snapshots' and account_number is not None:
+                rc.store_catalog(account_number, region_name, inventory[inventory_type])
+            logger.debug(f'   {len(inventory[inventory_type])} {inventory_type} in {region_name}.')
+        except er.AWS_ERRORS as e:
+            logger.debug(e)
+            logger.info(f'   Unable to take {inventory_type} inventory in {region_name} ({er.classify(e)}). '
+                        f'These IDs will be searched for directly.')
+            inventory[inventory_type] = None
+
+    return inventory
+
+
+def forget_deleted(account_number, region_name, deleted, image_snapshots_deleted=0):
+    # Take the IDs deleted in a region out of its cached inventories, so later runs do not route IDs to where they
+    # no longer are. deleted maps resource keys to IDs. The snapshots of deleted images are not known by ID, so
+    # the region's cached snapshot inventory is dropped instead.
+    for key, resource_ids in deleted.items():
+        if resource_ids:
+            ivc.forget(account_number, region_name, RESOURCE_INVENTORY_TYPES[key], resource_ids)
+    if image_snapshots_deleted:
+        ivc.drop(account_number, region_name, RESOURCE_INVENTORY_TYPES['3'])
+    return
+
+
+def add_to_index(index, inventory, account_number, region_name):
+    # Map every inventoried ID to the (account, region) pairs that own it. RDS snapshot identifiers
+    # and IPs are only unique within an account and region, so an ID can have more than one home.
+    for inventory_type, resource_ids in inventory.items():
+        if resource_ids is None:
+            continue
+        for resource_id in resource_ids:
+            index.setdefault(resource_id, set()).add((account_number, region_name))
+    return
+
+
+def route_ids(index, requested_ids, inventories, account_number, logger):
+    # Split the requested IDs of each resource key by the region in this account that owns them.
+    # Regions without any hits are left out; keys whose inventory failed get None (search all IDs).
+    routed = {}
+
+    for region_name, inventory in inventories.items():
+        region_ids = {}
+        for key, resource_ids in requested_ids.items():
+            if inventory.get(RESOURCE_INVENTORY_TYPES[key]) is None:
+                region_ids[key] = None
+            else:
+                region_ids[key] = {resource_id for resource_id in resource_ids
+                                   if (account_number, region_name) in index.get(resource_id, ())}
+
+        if any(ids is None or ids for ids in region_ids.values()):
+            routed[region_name] = region_ids
+        else:
+            logger.info(f'No requested resources found in {region_name}. Skipping this region.')
+
+    located = {resource_id for ids in requested_ids.values() for resource_id in ids
+               if any(home[0] == account_number for home in index.get(resource_id, ()))}
+    total = len(set().union(*requested_ids.values()))
+    logger.info(f'{len(located)} of {total} requested resource IDs located in account {account_number}.')
+
+    return routed
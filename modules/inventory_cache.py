@@ -0,0 +1,115 @@
+import contextlib
+import json
+import os
+import sqlite3
+import time
+
+CACHE_DIRECTORY = 'cache'
+CACHE_PATH = f'{CACHE_DIRECTORY}/inventory.sqlite'
+
+# Seconds a region's inventory is reused by later runs before it is listed again; 0 turns the cache off. Set from
+# --inventory-ttl.
+TTL = 3600
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS inventories (
+    account_number TEXT NOT NULL,
+    region TEXT NOT NULL,
+    inventory_type TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    resource_ids TEXT NOT NULL,
+    PRIMARY KEY (account_number, region, inventory_type)
+);
+'''
+
+
+def connect(path=CACHE_PATH):
+    # One connection per call, so threads and worker processes never share one. The rollback journal is used, as
+    # by the work queue, so the cache can sit on a file system shared by the workers of a farm.
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def encode(inventory):
+    # ID sets are stored as lists and the RDS snapshot catalog as an object
+    if isinstance(inventory, dict):
+        return json.dumps(inventory, separators=(',', ':'))
+    return json.dumps(sorted(inventory), separators=(',', ':'))
+
+
+def decode(text):
+    inventory = json.loads(text)
+    if isinstance(inventory, dict):
+        return inventory
+    return set(inventory)
+
+
+def cached_inventory(account_number, region_name, inventory_type):
+    # Returns the cached inventory of an account, region and type with its age in seconds, or None when there is
+    # none younger than the TTL
+    if TTL <= 0 or not os.path.isfile(CACHE_PATH):
+        return None
+    with contextlib.closing(connect()) as connection:
+        row = connection.execute('SELECT fetched, resource_ids FROM inventories WHERE account_number = ? AND '
+                                 'region = ? AND inventory_type = ?',
+                                 (account_number, region_name, inventory_type)).fetchone()
+    if row is None:
+        return None
+    age = time.time() - row[0]
+    if age > TTL:
+        return None
+    return decode(row[1]), age
+
+
+def store_inventory(account_number, region_name, inventory_type, inventory):
+    # Stamp a freshly listed inventory with the time it was fetched
+    if TTL <= 0:
+        return
+    with contextlib.closing(connect()) as connection:
+        connection.execute('INSERT OR REPLACE INTO inventories (account_number, region, inventory_type, fetched, '
+                           'resource_ids) VALUES (?, ?, ?, ?, ?)',
+                           (account_number, region_name, inventory_type, time.time(), encode(inventory)))
+    return
+
+
+def forget(account_number, region_name, inventory_type, resource_ids):
+    # Take IDs this run deleted out of a cached inventory. The entry keeps its fetch time, since the rest of it
+    # is as fresh as it was. Runs even with the cache turned off, so no entry a later run reads is left stale.
+    if not os.path.isfile(CACHE_PATH):
+        return
+    with contextlib.closing(connect()) as connection:
+        cursor = connection.cursor()
+        # Taken up front, so two regions' workers never overwrite each other's changes to the same entry
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            row = cursor.execute('SELECT resource_ids FROM inventories WHERE account_number = ? AND region = ? AND '
+                                 'inventory_type = ?', (account_number, region_name, inventory_type)).fetchone()
+            if row is not None:
+                inventory = decode(row[0])
+                for resource_id in resource_ids:
+                    if isinstance(inventory, dict):
+                        inventory.pop(resource_id, None)
+                    else:
+                        inventory.discard(resource_id)
+                cursor.execute('UPDATE inventories SET resource_ids = ? WHERE account_number = ? AND region = ? '
+                               'AND inventory_type = ?',
+                               (encode(inventory), account_number, region_name, inventory_type))
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+    return
+
+
+def drop(account_number, region_name, inventory_type):
+    # Remove a cached inventory whose deleted IDs are not known one by one, so the next run lists it again
+    if not os.path.isfile(CACHE_PATH):
+        return
+    with contextlib.closing(connect()) as connection:
+        connection.execute('DELETE FROM inventories WHERE account_number = ? AND region = ? AND inventory_type = ?',
+                           (account_number, region_name, inventory_type))
+    return
@@ -0,0 +1,51 @@
+import threading
+import modules.chunks as chunks
+
+# Domain of addresses allocated for use in a VPC; other addresses are EC2-Classic and have no allocation ID
+VPC = 'vpc'
+
+# Catalogs built during the run, keyed by (account, region)
+_catalogs = {}
+_catalogs_guard = threading.Lock()
+
+
+def catalog_addresses(addresses):
+    # Map each Elastic IP of a describe_addresses response to its (allocation ID, association ID, domain)
+    return {address['PublicIp']: (address.get('AllocationId'), address.get('AssociationId'),
+                                  address.get('Domain', VPC))
+            for address in addresses if 'PublicIp' in address}
+
+
+def build_catalog(ec2_client):
+    # describe_addresses is not paginated, so this is one call per region however many IPs are requested
+    return catalog_addresses(ec2_client.describe_addresses()['Addresses'])
+
+
+def check_catalog(ec2_client, ips):
+    # Catalog only the given IPs, a filter's worth at a time, when a plan is applied and the rest of the region's
+    # addresses do not matter
+    addresses = []
+    for chunk in chunks.chunk_ids(ips):
+        addresses.extend(ec2_client.describe_addresses(Filters=[{'Name': 'public-ip', 'Values': chunk}])['Addresses'])
+    return catalog_addresses(addresses)
+
+
+def release_params(entry, ip):
+    # VPC addresses are released by allocation ID; PublicIp only works for EC2-Classic addresses
+    allocation_id, association_id, domain = entry
+    if domain == VPC and allocation_id:
+        return {'AllocationId': allocation_id}
+    return {'PublicIp': ip}
+
+
+def store_catalog(account_number, region_name, catalog):
+    # The region inventory stores the catalog it built, so it is reused for the rest of the run
+    with _catalogs_guard:
+        _catalogs[(account_number, region_name)] = catalog
+    return
+
+
+def cached_catalog(account_number, region_name):
+    # Returns the catalog of an account and region if one was built in this run, otherwise None
+    with _catalogs_guard:
+        return _catalogs.get((account_number, region_name))
@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+
+JOURNAL_DIRECTORY = 'journal'
+
+
+class Journal:
+    # Append-only JSONL write-ahead log of one run, keyed by run_date_time. Every ID outcome is written with
+    # its client, resource, account and region before the run moves on, so an interrupted run can be resumed
+    # from the journal without probing resolved IDs again. A torn last line from a crash is skipped on replay.
+
+    def __init__(self, run_date_time, directory=JOURNAL_DIRECTORY):
+        self.run_date_time = run_date_time
+        self.path = f'{directory}/run_{run_date_time}.jsonl'
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._file = None
+        self._replay = None
+        self._lock = threading.Lock()
+
+    def _write(self, records, sync=False):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            for record in records:
+                self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as file:
+                for line in file:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+        except FileNotFoundError:
+            return
+
+    def start_run(self, client_keys, resource_keys, dry_run):
+        self._write([{'event': 'run', 'clients': client_keys, 'resources': resource_keys, 'dry_run': dry_run}],
+                    sync=True)
+
+    def run_info(self):
+        # Returns the client keys, resource keys and dry run setting the run was started with
+        for record in self._read():
+            if record['event'] == 'run':
+                return record['clients'], record['resources'], record['dry_run']
+        return None
+
+    def record_ids(self, client_name, resource_name, scope, resource_ids, state):
+        account_number, region_name = scope if scope else (None, None)
+        self._write([{'event': 'id', 'client': client_name, 'resource': resource_name, 'account': account_number,
+                      'region': region_name, 'id': resource_id, 'state': state} for resource_id in resource_ids])
+
+    def record_scope(self, client_name, resource_name, scope):
+        # A finished account and region is synced to disk, so a resume never searches it again
+        account_number, region_name = scope
+        self._write([{'event': 'scope', 'client': client_name, 'resource': resource_name,
+                      'account': account_number, 'region': region_name}], sync=True)
+
+    def record_checkpoint(self, client_name, resource_name, offset, remaining_size, totals):
+        # Every ID before offset in the working file is handled, the remaining ones fill the first remaining_size
+        # bytes of the side file, and totals counts the handled IDs per state
+        self._write([{'event': 'checkpoint', 'client': client_name, 'resource': resource_name, 'offset': offset,
+                      'remaining_size': remaining_size, 'totals': totals}], sync=True)
+
+    def record_finish(self, client_name, resource_name):
+        # Written before the working file is replaced, so no checkpoint offset is applied to the new file
+        self._write([{'event': 'finish', 'client': client_name, 'resource': resource_name}], sync=True)
+
+    def replay(self, client_name, resource_name):
+        # Returns the last recorded state of each ID and the finished (account, region) scopes since the last
+        # checkpoint, and that checkpoint as (offset, remaining_size, totals), or None. Only the window in
+        # progress is held in memory.
+        if self._replay is None:
+            self._replay = {}
+            for record in self._read():
+                if record['event'] not in ('id', 'scope', 'checkpoint', 'finish'):
+                    continue
+                key = (record['client'], record['resource'])
+                states, scopes, checkpoint = self._replay.get(key, ({}, set(), None))
+                if record['event'] == 'id':
+                    states[record['id']] = record['state']
+                elif record['event'] == 'scope':
+                    scopes.add((record['account'], record['region']))
+                elif record['event'] == 'checkpoint':
+                    states, scopes, checkpoint = {}, set(), (record['offset'], record['remaining_size'],
+                                                             record['totals'])
+                else:
+                    states, scopes, checkpoint = {}, set(), None
+                self._replay[key] = states, scopes, checkpoint
+        return self._replay.get((client_name, resource_name), ({}, set(), None))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        return
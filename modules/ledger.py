@@ -0,0 +1,249 @@
+import os
+import threading
+import modules.id_files as idf
+
+PENDING = 'pending'
+NOT_FOUND = 'not found'
+DELETED = 'deleted'
+ERROR = 'error'
+
+# IDs still worth searching for in the next region or account
+UNRESOLVED = (PENDING, NOT_FOUND)
+
+# IDs held in memory at once when a ledger streams its working file in windows
+WINDOW_SIZE = 50000
+
+
+class IdLedger:
+    # Tracks the state of every ID of one client and resource type across all accounts and regions.
+    # Lookups and updates are O(1) per ID, and one instance is shared by every worker of the client.
+    #
+    # With window_size, only one window of the working file is held at a time: load_window() reads the next
+    # window and commit_window() streams its remaining IDs to a side file, so memory stays flat however many
+    # IDs the client has. The working file is replaced once every window is committed. Without window_size the
+    # whole file is loaded up front and flush() rewrites it.
+
+    def __init__(self, client_name, resource_name, run_date_time, logger, copy_prefix='Copy of', journal=None,
+                 window_size=None):
+        self.client_name = client_name
+        self.resource_name = resource_name
+        self.logger = logger
+        self.resource_ids_path = f'{client_name}_{run_date_time}/{client_name} {resource_name}.txt'
+        self.deleted_ids_path = f'{client_name}_{run_date_time}/{client_name} {resource_name} deleted.txt'
+        self.error_ids_path = f'{client_name}_{run_date_time}/{client_name} {resource_name} errors.txt'
+        self.remaining_ids_path = f'{self.resource_ids_path}.remaining'
+        self.window_size = window_size
+
+        self._states = {}
+        self._done_scopes = set()
+        self._totals = {PENDING: 0, NOT_FOUND: 0, DELETED: 0, ERROR: 0}
+        self._window_end = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.journal = journal
+
+        # Copy the resource ids file if a copy doesn't already exist
+        idf.copy_file_once(self.resource_ids_path,
+                           f'{client_name}_{run_date_time}/{copy_prefix} {client_name} {resource_name}.txt', logger)
+
+        self.exists = os.path.isfile(self.resource_ids_path)
+
+        # IDs that already failed in this run are not tried again
+        self._failed_ids = set(idf.read_ids(self.error_ids_path, missing_ok=True)) if self.exists else set()
+
+        # Outcomes journaled before an interrupted run was stopped take precedence over the working file,
+        # which is only rewritten at the end of each region or window
+        self._replayed_states = {}
+        offset = 0
+        if journal is not None:
+            self._replayed_states, self._done_scopes, checkpoint = journal.replay(client_name, resource_name)
+            if checkpoint is not None and window_size is not None:
+                # Continue after the last committed window, dropping anything appended to the side file since
+                offset, remaining_size, self._totals = checkpoint
+                with open(self.remaining_ids_path, 'a') as file:
+                    file.truncate(remaining_size)
+
+        self._chunks = None
+        if self.exists:
+            if window_size is None:
+                for chunk, end_offset in idf.iter_id_chunks(self.resource_ids_path, WINDOW_SIZE):
+                    self._add_ids(chunk)
+            else:
+                if offset == 0 and os.path.isfile(self.remaining_ids_path):
+                    os.remove(self.remaining_ids_path)
+                self._chunks = idf.iter_id_chunks(self.resource_ids_path, window_size, offset)
+
+    def _add_ids(self, resource_ids):
+        for resource_id in resource_ids:
+            if resource_id in self._failed_ids:
+                self._states[resource_id] = ERROR
+            else:
+                self._states[resource_id] = self._replayed_states.get(resource_id, PENDING)
+                if self._states[resource_id] != PENDING:
+                    self._dirty = True
+
+    def __len__(self):
+        return len(self._states)
+
+    def state(self, resource_id):
+        return self._states.get(resource_id)
+
+    def load_window(self):
+        # Read the next window of the working file. Returns False once the file is exhausted.
+        chunk = next(self._chunks, None) if self._chunks is not None else None
+        if chunk is None:
+            return False
+        resource_ids, self._window_end = chunk
+        with self._lock:
+            self._add_ids(resource_ids)
+        return True
+
+    def pending(self, region_ids=None):
+        # Unresolved IDs, limited to the IDs the region inventory located in this region when given
+        with self._lock:
+            if region_ids is None:
+                return [resource_id for resource_id, state in self._states.items() if state in UNRESOLVED]
+            return sorted(resource_id for resource_id in region_ids if self._states.get(resource_id) in UNRESOLVED)
+
+    def _mark(self, resource_ids, state, path=None, scope=None):
+        with self._lock:
+            for resource_id in resource_ids:
+                if resource_id in self._states:
+                    self._states[resource_id] = state
+            self._dirty = True
+            if path:
+                idf.append_ids(path, resource_ids)
+        if self.journal is not None and resource_ids:
+            self.journal.record_ids(self.client_name, self.resource_name, scope, resource_ids, state)
+
+    def mark_not_found(self, resource_ids, scope=None):
+        # Only pending IDs change; an ID found or handled in another region keeps that state
+        with self._lock:
+            for resource_id in resource_ids:
+                if self._states.get(resource_id) == PENDING:
+                    self._states[resource_id] = NOT_FOUND
+        if self.journal is not None and resource_ids:
+            self.journal.record_ids(self.client_name, self.resource_name, scope, resource_ids, NOT_FOUND)
+
+    def mark_deleted(self, resource_ids, record=True, scope=None):
+        # RDS dry runs make no API calls, so their resolved IDs are not recorded as deleted
+        self._mark(resource_ids, DELETED, self.deleted_ids_path if record else None, scope)
+
+    def mark_errors(self, resource_ids, scope=None):
+        self._mark(resource_ids, ERROR, self.error_ids_path, scope)
+
+    def scope_done(self, scope):
+        # True when a resumed run already finished this (account, region) for this resource type
+        return scope in self._done_scopes
+
+    def finish_scope(self, scope):
+        with self._lock:
+            self._done_scopes.add(scope)
+        if self.journal is not None:
+            self.journal.record_scope(self.client_name, self.resource_name, scope)
+
+    def for_scope(self, account_number, region_name):
+        return LedgerScope(self, (account_number, region_name))
+
+    def flush(self):
+        # Rewrite the working file with the IDs not yet deleted, removing it once none remain.
+        # Returns the number of remaining IDs. A windowed ledger rewrites the file in finish() instead.
+        with self._lock:
+            remaining_ids = [resource_id for resource_id, state in self._states.items() if state != DELETED]
+            if self.window_size is not None:
+                return len(remaining_ids) + sum(count for state, count in self._totals.items() if state != DELETED)
+            if self._dirty and self.exists:
+                if not remaining_ids:
+                    os.remove(self.resource_ids_path)
+                    self.exists = False
+                else:
+                    self.logger.info('Rewriting working resource ID file...')
+                    with open(f'{self.resource_ids_path}.tmp', 'w') as file:
+                        for resource_id in remaining_ids:
+                            file.write(resource_id + '\n')
+                    os.replace(f'{self.resource_ids_path}.tmp', self.resource_ids_path)
+                self._dirty = False
+        return len(remaining_ids)
+
+    def commit_window(self):
+        # Append the window's remaining IDs to the side file, checkpoint the journal past the window and drop
+        # the window from memory
+        with self._lock:
+            with open(self.remaining_ids_path, 'a') as file:
+                for resource_id, state in self._states.items():
+                    self._totals[state] += 1
+                    if state != DELETED:
+                        file.write(resource_id + '\n')
+                remaining_size = file.tell()
+            self._states = {}
+            self._replayed_states = {}
+            self._done_scopes = set()
+        if self.journal is not None:
+            self.journal.record_checkpoint(self.client_name, self.resource_name, self._window_end, remaining_size,
+                                           self._totals)
+
+    def finish(self):
+        # Replace the working file with the remaining IDs of every committed window, or remove it when none remain
+        if self._chunks is None:
+            return
+        self._chunks.close()
+        self._chunks = None
+        if self.journal is not None:
+            self.journal.record_finish(self.client_name, self.resource_name)
+        if os.path.isfile(self.remaining_ids_path) and os.path.getsize(self.remaining_ids_path) > 0:
+            self.logger.info('Rewriting working resource ID file...')
+            os.replace(self.remaining_ids_path, self.resource_ids_path)
+        else:
+            os.remove(self.resource_ids_path)
+            if os.path.isfile(self.remaining_ids_path):
+                os.remove(self.remaining_ids_path)
+            self.exists = False
+
+    def summary(self):
+        with self._lock:
+            counts = dict(self._totals)
+            for state in self._states.values():
+                counts[state] += 1
+        return counts
+
+
+class LedgerScope:
+    # The client's ledger as seen from one account and region, so journaled outcomes record where they happened.
+    # Flushing the scope marks the region finished for the resource type.
+
+    def __init__(self, ledger, scope):
+        self.ledger = ledger
+        self.scope = scope
+        # IDs deleted through this scope, for the post-deletion verification
+        self.deleted_ids = []
+
+    @property
+    def exists(self):
+        return self.ledger.exists
+
+    @property
+    def resource_ids_path(self):
+        return self.ledger.resource_ids_path
+
+    @property
+    def done(self):
+        return self.ledger.scope_done(self.scope)
+
+    def pending(self, region_ids=None):
+        return self.ledger.pending(region_ids)
+
+    def mark_not_found(self, resource_ids):
+        self.ledger.mark_not_found(resource_ids, self.scope)
+
+    def mark_deleted(self, resource_ids, record=True):
+        self.ledger.mark_deleted(resource_ids, record, self.scope)
+        if record:
+            self.deleted_ids.extend(resource_ids)
+
+    def mark_errors(self, resource_ids):
+        self.ledger.mark_errors(resource_ids, self.scope)
+
+    def flush(self):
+        remaining = self.ledger.flush()
+        self.ledger.finish_scope(self.scope)
+        return remaining
@@ -0,0 +1,124 @@
+import atexit
+import gzip
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import modules.metrics as mt
+
+# Rotated log files are gzipped; a run keeps at most BACKUP_COUNT of them next to the live file
+MAX_BYTES = 50 * 1024 * 1024
+BACKUP_COUNT = 20
+
+# One in SAMPLE_RATE per-ID lines is shown on the console; all of them go to the log file
+SAMPLE_RATE = 100
+
+# Passed as extra= on per-ID lines in hot loops, so the console samples them instead of printing each one
+DETAIL = {'detail': True}
+
+# Attributes every LogRecord has; anything else on a record was passed with extra= and is written as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_listeners = []
+
+
+class JsonLinesFormatter(logging.Formatter):
+    # One JSON object per record, with the resource type it was logged for and any extra= fields
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'thread': record.threadName, 'message': record.getMessage().strip()}
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    # Lets through every record except per-ID detail lines, of which one in sample_rate is let through
+
+    def __init__(self, sample_rate):
+        super().__init__()
+        self._sample_rate = max(sample_rate, 1)
+        # next() on itertools.count is atomic, so worker threads need no lock
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        if not getattr(record, 'detail', False):
+            return True
+        return next(self._counter) % self._sample_rate == 0
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler formats each message before queueing it. The queue never leaves the process, so the record is
+    # queued as it is and the listener thread does the formatting instead of the worker that logged it.
+
+    def prepare(self, record):
+        # Label the record in the worker's context; the listener thread has no resource type of its own
+        record.resource = mt.current_resource()
+        return record
+
+
+def _gzip_namer(name):
+    return f'{name}.gz'
+
+
+def _gzip_rotator(source, destination):
+    with open(source, 'rb') as source_file, gzip.open(destination, 'wb') as destination_file:
+        shutil.copyfileobj(source_file, destination_file)
+    os.remove(source)
+
+
+def start(logger, path, level=logging.DEBUG, sample_rate=SAMPLE_RATE, stream=sys.stdout, max_bytes=MAX_BYTES,
+          backup_count=BACKUP_COUNT):
+    # Send the logger's records through a queue to a listener thread that writes them to a rotating JSONL file at
+    # level and to stream at INFO, sampling per-ID lines. Other libraries only log warnings. No console is written
+    # to when stream is None. The listener is stopped, flushing the queue, by stop() or when the program exits.
+    file_handler = logging.handlers.RotatingFileHandler(path, mode='a', maxBytes=max_bytes,
+                                                        backupCount=backup_count, encoding='utf-8')
+    file_handler.namer = _gzip_namer
+    file_handler.rotator = _gzip_rotator
+    file_handler.setFormatter(JsonLinesFormatter())
+    file_handler.setLevel(level)
+    handlers = [file_handler]
+
+    if stream is not None:
+        console = logging.StreamHandler(stream)
+        console.setLevel(logging.INFO)
+        console.addFilter(SampleFilter(sample_rate))
+        handlers.append(console)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    if not _listeners:
+        atexit.register(stop)
+    _listeners.append(listener)
+
+    # Records below every handler's level are dropped in the worker before any message is formatted. The console
+    # keeps its INFO lines whatever the file's level.
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    logger.setLevel(min(level, logging.INFO) if stream is not None else level)
+    return
+
+
+def stop():
+    # Write out every queued record and stop the listener threads
+    while _listeners:
+        _listeners.pop().stop()
+    return
+
+
+def region_summary(logger, account_name, region_name, ips, images, snapshots, volumes, rds_snaps):
+    # The one line per account and region the console keeps once per-ID lines are sampled
+    logger.info('\n%s %s: %d IPs released, %d images deregistered, %d EBS snapshots deleted, %d volumes deleted, '
+                '%d RDS snapshots deleted.', account_name, region_name, ips, images, snapshots, volumes, rds_snaps,
+                extra={'account': account_name, 'region': region_name})
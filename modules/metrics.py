@@ -0,0 +1,203 @@
+import bisect
+import contextlib
+import contextvars
+import copy
+import json
+import os
+import threading
+import time
+import modules.errors as er
+
+METRICS_DIRECTORY = 'metrics'
+METRIC_PREFIX = 'wchclean'
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LABEL_NAMES = ('service', 'operation', 'account', 'region', 'resource')
+
+# Label of calls made outside any resource type, e.g. logins
+OTHER = 'other'
+INVENTORY = 'inventory'
+
+# The resource type each call is made for. Worker threads and asyncio tasks each have their own context, so
+# concurrent resource types never mix up their labels.
+_resource = contextvars.ContextVar('resource', default=OTHER)
+
+_stats = {}
+_resource_ids = {}
+_stats_guard = threading.Lock()
+
+
+def set_resource(resource_name):
+    return _resource.set(resource_name)
+
+
+def current_resource():
+    return _resource.get()
+
+
+@contextlib.contextmanager
+def resource_label(resource_name):
+    # Label every API call made in the block with resource_name
+    token = _resource.set(resource_name)
+    try:
+        yield
+    finally:
+        _resource.reset(token)
+
+
+def _labels_stats(labels):
+    if labels not in _stats:
+        _stats[labels] = {'calls': 0, 'errors': {}, 'retries': 0, 'throttles': 0, 'latency_sum': 0.0,
+                          'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+    return _stats[labels]
+
+
+def instrument(client, account_number):
+    # Attach the metric hooks to a botocore or aiobotocore client. Each call is counted by service, operation,
+    # account, region and the resource type it was made for.
+    service = client.meta.service_model.service_name
+    region_name = client.meta.region_name
+
+    def labels(event_name, context):
+        return service, event_name.rsplit('.', 1)[1], account_number, region_name, context['metrics'][1]
+
+    def record(event_name, context, retries, error_code):
+        if 'metrics' not in context:
+            return
+        latency = time.monotonic() - context['metrics'][0]
+        with _stats_guard:
+            stats = _labels_stats(labels(event_name, context))
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['latency_sum'] += latency
+            stats['latency_buckets'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            if error_code is not None:
+                stats['errors'][error_code] = stats['errors'].get(error_code, 0) + 1
+
+    def before_call(event_name, context, **kwargs):
+        context['metrics'] = (time.monotonic(), _resource.get())
+
+    def after_call(event_name, parsed, context, **kwargs):
+        record(event_name, context, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+               parsed.get('Error', {}).get('Code'))
+
+    def after_call_error(event_name, exception, context, **kwargs):
+        record(event_name, context, 0, type(exception).__name__)
+
+    def needs_retry(event_name, response, request_dict, **kwargs):
+        # Fired after every attempt, so throttles retried inside botocore are counted too
+        context = request_dict.get('context', {})
+        if response is None or 'metrics' not in context:
+            return None
+        if response[1].get('Error', {}).get('Code') in er.THROTTLE_ERROR_CODES:
+            with _stats_guard:
+                _labels_stats(labels(event_name, context))['throttles'] += 1
+        return None
+
+    # before-call and needs-retry stop at the first handler that returns a response, so these have to run first
+    client.meta.events.register_first('before-call.*.*', before_call)
+    client.meta.events.register_first('needs-retry.*.*', needs_retry)
+    client.meta.events.register('after-call.*.*', after_call)
+    client.meta.events.register('after-call-error.*.*', after_call_error)
+    return client
+
+
+def record_resource_ids(resource_name, id_count):
+    with _stats_guard:
+        _resource_ids[resource_name] = _resource_ids.get(resource_name, 0) + id_count
+    return
+
+
+def resource_calls():
+    # Returns {resource type: (API calls, IDs handled)} for every resource type that handled IDs
+    with _stats_guard:
+        calls = {resource_name: 0 for resource_name in _resource_ids}
+        for labels, stats in _stats.items():
+            if labels[4] in calls:
+                calls[labels[4]] += stats['calls']
+        return {resource_name: (calls[resource_name], _resource_ids[resource_name]) for resource_name in calls}
+
+
+def check_budget(calls_per_id):
+    # Returns (resource type, API calls, IDs) for each resource type that made more calls per ID than the budget
+    return [(resource_name, calls, id_count) for resource_name, (calls, id_count) in resource_calls().items()
+            if calls > calls_per_id * max(id_count, 1)]
+
+
+def _snapshot():
+    # A consistent copy of the stats of every label set, as (labels, stats) pairs
+    with _stats_guard:
+        return [(dict(zip(LABEL_NAMES, labels)), copy.deepcopy(stats)) for labels, stats in sorted(_stats.items())]
+
+
+def _bucket_names():
+    return [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+
+
+def summary():
+    calls = [{**labels, 'calls': stats['calls'], 'errors': stats['errors'], 'retries': stats['retries'],
+              'throttles': stats['throttles'], 'latency_seconds_sum': round(stats['latency_sum'], 6),
+              'latency_buckets': dict(zip(_bucket_names(), stats['latency_buckets']))}
+             for labels, stats in _snapshot()]
+    resources = {resource_name: {'calls': calls_made, 'ids': id_count,
+                                 'calls_per_id': round(calls_made / id_count, 3) if id_count else None}
+                 for resource_name, (calls_made, id_count) in resource_calls().items()}
+    return {'calls': calls, 'resources': resources}
+
+
+def _label_text(**labels):
+    values = {name: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+              for name, value in labels.items()}
+    return '{' + ','.join(f'{name}="{value}"' for name, value in values.items()) + '}'
+
+
+def prometheus_text():
+    # Render the metrics in the Prometheus text exposition format, for the node exporter's textfile collector
+    lines = []
+
+    def add(name, metric_type, help_text, samples):
+        lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+        lines.append(f'# TYPE {METRIC_PREFIX}_{name} {metric_type}')
+        for suffix, labels, value in samples:
+            lines.append(f'{METRIC_PREFIX}_{name}{suffix}{_label_text(**labels)} {value}')
+
+    rows = _snapshot()
+    add('api_calls_total', 'counter', 'AWS API calls made.',
+        [('', labels, stats['calls']) for labels, stats in rows])
+    add('api_errors_total', 'counter', 'AWS API calls that returned an error, by error code.',
+        [('', {**labels, 'code': code}, count) for labels, stats in rows
+         for code, count in sorted(stats['errors'].items())])
+    add('api_retries_total', 'counter', 'Retries made by botocore.',
+        [('', labels, stats['retries']) for labels, stats in rows])
+    add('api_throttles_total', 'counter', 'Attempts that were throttled.',
+        [('', labels, stats['throttles']) for labels, stats in rows])
+
+    latency_samples = []
+    for labels, stats in rows:
+        cumulative = 0
+        for bound, count in zip(_bucket_names(), stats['latency_buckets']):
+            cumulative += count
+            latency_samples.append(('_bucket', {**labels, 'le': bound}, cumulative))
+        latency_samples.append(('_sum', labels, round(stats['latency_sum'], 6)))
+        latency_samples.append(('_count', labels, stats['calls']))
+    add('api_latency_seconds', 'histogram', 'AWS API call latency, including botocore retries.', latency_samples)
+
+    add('resource_ids_total', 'counter', 'Resource IDs handled.',
+        [('', {'resource': resource_name}, id_count) for resource_name, (calls, id_count)
+         in sorted(resource_calls().items())])
+    return '\n'.join(lines) + '\n'
+
+
+def write_reports(run_date_time, directory=METRICS_DIRECTORY):
+    # Write the JSON summary and the Prometheus textfile of the run. Both are replaced atomically, so a
+    # collector never reads a partial file. Returns the two paths.
+    os.makedirs(directory, exist_ok=True)
+    json_path = os.path.join(directory, f'run_{run_date_time}.json')
+    prometheus_path = os.path.join(directory, f'run_{run_date_time}.prom')
+    for path, text in ((json_path, json.dumps(summary(), indent=2)), (prometheus_path, prometheus_text())):
+        with open(f'{path}.tmp', 'w') as file:
+            file.write(text)
+        os.replace(f'{path}.tmp', path)
+    return json_path, prometheus_path
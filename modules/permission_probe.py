@@ -0,0 +1,157 @@
+import collections
+import threading
+import modules.errors as er
+import modules.id_files as idf
+import modules.log_pipeline as lp
+
+# Outcome of each resource in a dry run's report
+WOULD_DELETE = 'would delete'
+WOULD_FAIL = 'would fail'
+WOULD_SKIP = 'would skip'
+
+# Verdicts of a permission probe
+ALLOWED = 'allowed'
+DENIED = 'denied'
+UNPROBED = 'unprobed'
+
+# Resources tried per action before the probe gives up, when each of them fails its DryRun call on its own state
+MAX_PROBES = 3
+NO_VERDICT = (UNPROBED, 'no resource could be probed')
+
+# Reasons resources are skipped without a deletion being tried
+NOT_FOUND = 'not found'
+IN_USE = 'in use'
+NOT_COMPLETED = 'not completed'
+ASSOCIATED = 'associated'
+TOO_NEW = 'less than three months old'
+
+# States a resource that would be deleted was found in, as recorded in the report and the deletion plan. RDS
+# snapshots record their kind instead.
+REGISTERED = 'registered'
+COMPLETED = 'completed'
+UNASSOCIATED = 'unassociated'
+AVAILABLE = 'available'
+
+# Columns of each line of a dry run report
+REPORT_COLUMNS = ('id', 'outcome', 'reason', 'account', 'region', 'state', 'dependencies')
+
+# Probe verdicts of the run as (verdict, error code), keyed by (account, region, operation)
+_probes = {}
+_probes_guard = threading.Lock()
+
+
+def probe_result(e):
+    # The verdict and error code of a DryRun call's error. A denial means the caller may not make the call at all;
+    # the verdict is None when the error is about the resource, or says nothing about the permission.
+    category = er.classify(e)
+    if category == er.DRY_RUN:
+        return ALLOWED, er.error_code(e)
+    if category == er.DENIED:
+        return DENIED, er.error_code(e)
+    return None, er.error_code(e)
+
+
+def cached_probe(account_number, region_name, operation):
+    with _probes_guard:
+        return _probes.get((account_number, region_name, operation))
+
+
+def store_probe(account_number, region_name, operation, verdict, logger):
+    with _probes_guard:
+        _probes[(account_number, region_name, operation)] = verdict
+    logger.info(f'   Permission probe of {operation} in {region_name}: {verdict[0]} ({verdict[1]}).')
+    return
+
+
+def probe(account_number, region_name, operation, call, resource_ids, logger):
+    # Check whether operation is allowed with one DryRun call per account, region and operation, instead of one
+    # per resource. call(resource_id) makes the DryRun call for one of resource_ids. Returns the (verdict, error
+    # code) and the error codes of the probed resources that failed on their own state.
+    failures = {}
+    verdict = cached_probe(account_number, region_name, operation)
+    if verdict is not None or not resource_ids:
+        return verdict or (UNPROBED, None), failures
+
+    for resource_id in resource_ids[:MAX_PROBES]:
+        try:
+            call(resource_id)
+            error = None
+        except er.AWS_ERRORS as e:
+            error = e
+        verdict = probe_verdict(account_number, region_name, operation, resource_id, error, failures, logger)
+        if verdict is not None:
+            return verdict, failures
+
+    # Nothing is cached, so the next resource type or region tries again
+    return NO_VERDICT, failures
+
+
+def probe_verdict(account_number, region_name, operation, resource_id, error, failures, logger):
+    # The verdict of one probe's DryRun call, which failed with error or succeeded when it is None. The verdict is
+    # stored for the run; None is returned, and the failure recorded, when the call failed on the resource's own
+    # state and the next resource has to be tried.
+    if error is None:
+        verdict = ALLOWED, None
+    else:
+        logger.debug(error)
+        verdict = probe_result(error)
+    if verdict[0] is None:
+        failures[resource_id] = verdict[1]
+        return None
+    store_probe(account_number, region_name, operation, verdict, logger)
+    return verdict
+
+
+def plan(resource_ids, verdict, failures):
+    # The (outcome, reason) of each resource to delete, worked out offline from the probe of its operation
+    allowed, code = verdict
+    outcomes = {}
+    for resource_id in resource_ids:
+        if resource_id in failures:
+            outcomes[resource_id] = WOULD_FAIL, failures[resource_id]
+        elif allowed == DENIED:
+            outcomes[resource_id] = WOULD_FAIL, code
+        elif allowed == UNPROBED:
+            outcomes[resource_id] = WOULD_DELETE, f'permission not checked: {code}'
+        else:
+            outcomes[resource_id] = WOULD_DELETE, ''
+    return outcomes
+
+
+def skipped(resource_ids, reason):
+    return {resource_id: (WOULD_SKIP, reason) for resource_id in sorted(resource_ids)}
+
+
+def report_path(ledger, suffix='dry run'):
+    return f'{ledger.resource_ids_path[:-len(".txt")]} {suffix}.txt'
+
+
+def report(ledger, account_number, region_name, resource_name, outcomes, logger, details=None, suffix='dry run'):
+    # Log the dry run's counts and append every resource's outcome and reason to the dry run report next to the
+    # working file. details maps IDs to the (state, dependency IDs) they were found with.
+    if details is None:
+        details = {}
+    counts = collections.Counter(outcome for outcome, reason in outcomes.values())
+    logger.info(f'   Dry run of {resource_name} in {region_name}: {counts[WOULD_DELETE]} would be deleted, '
+                f'{counts[WOULD_FAIL]} would fail, {counts[WOULD_SKIP]} would be skipped.')
+    for resource_id, (outcome, reason) in outcomes.items():
+        logger.info('      %s %s%s', resource_id, outcome, f': {reason}' if reason else '', extra=lp.DETAIL)
+    lines = []
+    for resource_id, (outcome, reason) in outcomes.items():
+        state, dependencies = details.get(resource_id, ('', []))
+        lines.append(f'{resource_id}\t{outcome}\t{reason}\t{account_number}\t{region_name}\t{state}\t'
+                     f'{",".join(dependencies)}')
+    idf.append_ids(report_path(ledger, suffix), lines)
+    return
+
+
+def record(ledger, account_number, region_name, resource_name, outcomes, logger, details=None):
+    # Mark the resources that would be deleted or would fail in the ledger, as a run would, and report every
+    # outcome. Nothing was deleted, so nothing is recorded in the deleted IDs file. Returns the IDs that would be
+    # deleted.
+    would_delete = [resource_id for resource_id, (outcome, reason) in outcomes.items() if outcome == WOULD_DELETE]
+    ledger.mark_deleted(would_delete, record=False)
+    ledger.mark_errors([resource_id for resource_id, (outcome, reason) in outcomes.items()
+                        if outcome == WOULD_FAIL])
+    report(ledger, account_number, region_name, resource_name, outcomes, logger, details)
+    return would_delete
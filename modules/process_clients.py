@@ -5,85 +5,200 @@ import modules.release_ips as ri
 import modules.delete_volumes as dv
 import modules.delete_ec2_snapshots as des
 import modules.delete_rds_snapshots as drs
+import modules.batch_input as bi
+import modules.inventory as inv
+import modules.ledger as lg
+import modules.rds_catalog as rc
+import modules.ip_catalog as ic
+import modules.rate_limiter as rl
+import modules.async_engine as ae
+import modules.session_pool as sp
+import modules.metrics as mt
+import modules.log_pipeline as lp
+import modules.verify_deletions as vf
+import modules.deletion_plan as dp
+import modules.circuit_breaker as cb
 from botocore.exceptions import ClientError
-import aws_sso_lib as sso
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 
 
-def create_boto3_session(profile, login, start_url, sso_region, role_name, region):
-    if login == 'sso':
-        account_id = int(profile['account_number'])
-        session = sso.get_boto3_session(start_url, sso_region, account_id, role_name, region=region,
-                                        login=False, sso_cache=None, credential_cache=None)
-    else:
-        session = boto3.Session(region_name=region)
-    return session
+def take_inventory(profile, login, start_url, sso_region, role_name, region, resource_keys, logger, planned_ids=None):
+    # The pooled session and its clients are reused by the deletion workers of the region. An applied plan already
+    # knows what is in the region, so only the resources it is about to delete are checked.
+    session = sp.get_session(profile, login, start_url, sso_region, role_name, region)
+    cb.start_deadline(profile['account_number'], region)
+    with mt.resource_label(mt.INVENTORY):
+        if planned_ids is not None:
+            inventory = dp.check_region(session, planned_ids, region, logger, profile['account_number'])
+        else:
+            inventory = inv.get_region_inventory(session, resource_keys, region, logger, profile['account_number'])
+    return session, inventory
 
 
 def delete_resources(profile, client_name, region_name, session, resource_keys, resources_dict,
-                     dry_run, run_date_time, three_months, logger):
+                     dry_run, run_date_time, three_months, logger, region_ids=None, ledgers=None, verify=False):
     account_name = profile['account_name']
     account_number = profile['account_number']
 
-    # Create boto3 clients for EC2, RDS
+    # EC2 and RDS clients of the region, created once per run
     ec2 = session.client('ec2')
     rds = session.client('rds')
 
+    # Mutating calls are paced per account and region; the limiters are shared by every worker in that scope
+    ec2_limiter = rl.get_rate_limiter(account_number, region_name, 'ec2')
+    rds_limiter = rl.get_rate_limiter(account_number, region_name, 'rds')
+
     logger.info(f'\n** Starting resource deletion for {account_name} in {region_name}. **')
+    cb.start_deadline(account_number, region_name)
 
     ips = 0
     images = 0
     snapshots = 0
+    image_snapshots = 0
     volumes = 0
     rds_snaps = 0
 
+    if region_ids is None:
+        region_ids = {}
+    if ledgers is None:
+        ledgers = {}
+    scopes = {}
+
     for key in resource_keys:
         resource_name = resources_dict[key]
+        ids_in_region = region_ids.get(key)
+        ledger = ledgers[key].for_scope(account_number, region_name) if key in ledgers else None
+        scopes[key] = ledger
+
+        # API calls made from here on are labelled with the resource type in the run's metrics
+        mt.set_resource(resource_name)
+
+        # Skip resource types with no IDs located in this region by the inventory
+        if ids_in_region is not None and not ids_in_region:
+            logger.debug(f'\nNo {resource_name} IDs located in {region_name}.')
+            continue
+
+        # Skip resource types a resumed run already finished in this region
+        if ledger is not None and ledger.done:
+            logger.info(f'\n{resource_name} in {account_name} {region_name} was completed before the run was '
+                        f'resumed. Skipping.')
+            continue
+
+        # Skip resource types whose service keeps failing in this region, or whose region ran out of time. Their
+        # IDs are left unresolved, and the region unfinished, for a later or resumed run.
+        reason = cb.skip_reason(account_number, region_name, 'rds' if key == '6' else 'ec2')
+        if reason is not None:
+            logger.info(f'\nSkipping {resource_name} in {account_name} {region_name}: {reason}.')
+            continue
 
         if key == '1':
             logger.info('\nOld EC2 Image:'
                         '\n-------------')
             image_count, snapshot_count = di.delete_images(ec2, client_name, region_name, resource_name, dry_run,
-                                                           run_date_time, three_months, logger)
+                                                           run_date_time, three_months, logger, ids_in_region,
+                                                           ec2_limiter, ledger, account_number)
             images += image_count
             snapshots += snapshot_count
+            image_snapshots += snapshot_count
         if key == '2':
             logger.info('\nEC2 Image Not Associated:'
                         '\n------------------------')
             image_count, snapshot_count = di.delete_images(ec2, client_name, region_name, resource_name, dry_run,
-                                                           run_date_time, three_months, logger)
+                                                           run_date_time, three_months, logger, ids_in_region,
+                                                           ec2_limiter, ledger, account_number)
             images += image_count
             snapshots += snapshot_count
+            image_snapshots += snapshot_count
         if key == '3':
             logger.info('\nEC2 Old Snapshots:'
                         '\n-----------------')
             snapshot_count = des.delete_snapshots(ec2, client_name, region_name, resource_name, dry_run,
-                                                  run_date_time, logger)
+                                                  run_date_time, logger, ids_in_region, ec2_limiter, ledger,
+                                                  account_number)
             snapshots += snapshot_count
         if key == '4':
             logger.info('\nUnattached Elastic IPs:'
                         '\n----------------------')
             ip_count = ri.release_ips(ec2, client_name, region_name, resource_name, dry_run,
-                                      run_date_time, logger)
+                                      run_date_time, logger, ids_in_region, ec2_limiter, ledger,
+                                      ic.cached_catalog(account_number, region_name), account_number)
             ips += ip_count
         if key == '5':
             logger.info('\nUnattached EBS Volumes:'
                         '\n----------------------')
             volume_count = dv.delete_volumes(ec2, client_name, region_name, resource_name, dry_run,
-                                             run_date_time, logger)
+                                             run_date_time, logger, ids_in_region, ec2_limiter, ledger,
+                                             account_number)
             volumes += volume_count
         if key == '6':
             logger.info('\nRDS Old Snapshots:'
                         '\n-----------------')
             rds_count = drs.delete_snapshots(rds, client_name, region_name, resource_name, dry_run,
-                                             run_date_time, logger)
+                                             run_date_time, logger, ids_in_region, rds_limiter, ledger,
+                                             rc.cached_catalog(account_number, region_name), account_number)
             rds_snaps += rds_count
 
+    # Later runs that reuse the region's cached inventories do not look for what was just deleted
+    deleted = {key: scope.deleted_ids for key, scope in scopes.items() if scope is not None}
+    inv.forget_deleted(account_number, region_name, deleted, image_snapshots)
+
+    # Confirm in bulk that every resource deleted in the region is gone. Dry runs delete nothing.
+    if verify and not dry_run:
+        stragglers = vf.verify_deletions(ec2, rds, deleted, resources_dict, logger)
+        for key, key_stragglers in stragglers.items():
+            vf.report_stragglers(scopes[key], account_number, region_name, resources_dict[key], deleted[key],
+                                 key_stragglers, logger)
+
+    # The worker thread is reused, so its later calls are not labelled with the last resource type
+    mt.set_resource(mt.OTHER)
+    cb.report(account_number, region_name, logger)
+    lp.region_summary(logger, account_name, region_name, ips, images, snapshots, volumes, rds_snaps)
     return ips, images, snapshots, volumes, rds_snaps
 
 
+def client_login(client):
+    # Returns the client's login type, SSO start URL, SSO region and role name; the last three are None for aal
+    if client['login'] == 'sso':
+        return client['login'], client['start_url'], client['sso_region'], client['role_name']
+    return client['login'], None, None, None
+
+
+def log_in_client(client, client_name, logger):
+    # Log in to every account of the client. Logins are interactive and cannot run concurrently. Returns the
+    # logged-in profiles and the accounts and clients that could not be logged in to.
+    login, start_url, sso_region, role_name = client_login(client)
+    logged_in_profiles = []
+    accounts_not_logged_in_list = []
+    clients_not_logged_in_list = []
+
+    for profile in client['profiles']:
+        logged_in = False
+
+        # log in to the client
+        if login == 'sso' or login == 'aal':
+            logged_in = aws.aws_login(login, profile, client_name, logger,
+                                      start_url=start_url, sso_region=sso_region, role_name=role_name)
+        else:
+            logger.info(f'No login type configured for {client_name}. Skipping this client.')
+            clients_not_logged_in_list.append(client_name)
+
+        if logged_in:
+            logged_in_profiles.append(profile)
+
+        else:
+            if login == 'sso':
+                logger.info(f'You were not logged in, skipping {client_name}.')
+                clients_not_logged_in_list.append(client_name)
+            else:
+                logger.info(f'You were not logged in, skipping {profile["profile_name"]}.')
+                accounts_not_logged_in_list.append(profile['profile_name'])
+
+    return logged_in_profiles, accounts_not_logged_in_list, clients_not_logged_in_list
+
+
 def process_clients(clients_dict, client_keys, resource_keys, resources_dict, dry_run,
-                    run_date_time, three_months, logger):
+                    run_date_time, three_months, logger, max_workers=1, engine='threads', max_in_flight=200,
+                    journal=None, resume=False, id_sources=None, verify=False, plan=None):
     accounts_logged_in = 0
     accounts_not_logged_in_list = []
     clients_logged_in = 0
@@ -97,64 +212,118 @@ def process_clients(clients_dict, client_keys, resource_keys, resources_dict, dr
 
     for key in client_keys:
         client_name = clients_dict[key]['name']
-        login = clients_dict[key]['login']
+        login, start_url, sso_region, role_name = client_login(clients_dict[key])
 
         msg = f'Starting resource deletion process for {client_name}.'
         logger.info(f'\n{"+" * len(msg)}'
                     f'\n{msg}'
                     f'\n{"+" * len(msg)}')
 
-        reg.get_resource_ids(client_name, resource_keys, resources_dict, run_date_time, logger)
+        # A resumed run continues from the working files and journal of the interrupted run, and a batch run
+        # reads the IDs from its source files instead of the entry dialogs
+        if not resume:
+            if plan is not None:
+                dp.write_resource_ids(plan, key, client_name, resources_dict, run_date_time, logger)
+            elif id_sources is not None:
+                bi.write_resource_ids(client_name, resource_keys, resources_dict, run_date_time,
+                                      id_sources.get(key, {}), logger)
+            else:
+                reg.get_resource_ids(client_name, resource_keys, resources_dict, run_date_time, logger)
 
-        for profile in clients_dict[key]['profiles']:
-            profile_name = profile['profile_name']
-            logged_in = False
-            start_url = None
-            sso_region = None
-            role_name = None
+        # One ledger per resource type tracks the client's IDs across all accounts and regions, one window of the
+        # working file at a time
+        ledgers = {key: lg.IdLedger(client_name, resources_dict[key], run_date_time, logger,
+                                    copy_prefix='INPUT' if key in ('1', '2') else 'Copy of', journal=journal,
+                                    window_size=lg.WINDOW_SIZE)
+                   for key in resource_keys}
 
-            if login == 'sso':
-                start_url = clients_dict[key]['start_url']
-                sso_region = clients_dict[key]['sso_region']
-                role_name = clients_dict[key]['role_name']
-
-            # log in to the client
-            if login == 'sso' or login == 'aal':
-                logged_in = aws.aws_login(login, profile, client_name, logger,
-                                          start_url=start_url, sso_region=sso_region)
-            else:
-                logger.info(f'No login type configured for {client_name}. Skipping this client.')
-                clients_not_logged_in_list.append(client_name)
+        # Log in to every account first
+        logged_in_profiles, accounts_not_logged_in, clients_not_logged_in = log_in_client(clients_dict[key],
+                                                                                          client_name, logger)
+        accounts_not_logged_in_list.extend(accounts_not_logged_in)
+        clients_not_logged_in_list.extend(clients_not_logged_in)
+        if login == 'sso':
+            clients_logged_in += len(logged_in_profiles)
+        else:
+            accounts_logged_in += len(logged_in_profiles)
 
-            if logged_in:
-                if login == 'sso':
-                    clients_logged_in += 1
-                else:
-                    accounts_logged_in += 1
+        # Index of each inventoried resource ID to the (account, region) pairs that own it
+        index = {}
 
+        # Regions of every logged-in account run concurrently, up to max_workers at a time
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+            # Take an inventory of each region so every ID is only handled in the region that owns it
+            # Regions an applied plan deletes nothing in are left out
+            inventory_futures = {}
+            inventories = {}
+            for profile in logged_in_profiles:
+                logger.info(f'\nLocating resources for {profile["account_name"]}...')
+                inventories[profile['account_number']] = {}
                 for region in profile['region']:
+                    planned_ids = None
+                    if plan is not None:
+                        planned_ids = dp.planned(plan, key, profile['account_number'], region, resource_keys)
+                        if not planned_ids:
+                            continue
+                    inventory_futures[(profile['account_number'], region)] = \
+                        executor.submit(take_inventory, profile, login, start_url, sso_region, role_name, region,
+                                        resource_keys, logger, planned_ids)
+
+            sessions = {}
+            for (account_number, region), future in inventory_futures.items():
+                sessions[(account_number, region)], inventory = future.result()
+                inventories[account_number][region] = inventory
+                inv.add_to_index(index, inventory, account_number, region)
+
+            # Route and delete one window of IDs at a time, so memory stays flat however many IDs the client has
+            window = 0
+            while True:
+                loaded_keys = [key for key in resource_keys if ledgers[key].load_window()]
+                if not loaded_keys:
+                    break
+                window += 1
+                requested_ids = {key: set(ledgers[key].pending()) for key in resource_keys}
+                logger.info(f'\nProcessing window {window}: {sum(len(ids) for ids in requested_ids.values())} IDs.')
 
-                    # create a boto3 session
-                    session = create_boto3_session(profile, login, start_url, sso_region, role_name, region)
+                units = []
+                for profile in logged_in_profiles:
+                    account_number = profile['account_number']
+                    routed_ids = inv.route_ids(index, requested_ids, inventories[account_number], account_number,
+                                               logger)
 
-                    ips_region, images_region, snapshots_region, \
-                        volumes_region, rds_region = delete_resources(profile, client_name, region, session,
-                                                                      resource_keys, resources_dict, dry_run,
-                                                                      run_date_time, three_months, logger)
+                    for region, region_ids in routed_ids.items():
+                        units.append((profile, region, sessions[(account_number, region)], region_ids))
+
+                if engine == 'async':
+                    # Every region runs as coroutines on one event loop, bounded by max_in_flight requests
+                    region_results = ae.run(units, resource_keys, resources_dict, dry_run, three_months, ledgers,
+                                            logger, max_in_flight, sp.ENDPOINT_URL, verify)
+                else:
+                    delete_futures = [executor.submit(delete_resources, profile, client_name, region, session,
+                                                      resource_keys, resources_dict, dry_run, run_date_time,
+                                                      three_months, logger, region_ids, ledgers, verify)
+                                      for profile, region, session, region_ids in units]
+                    region_results = [future.result() for future in delete_futures]
+
+                # Merge the per-region counters for the summary
+                for ips_region, images_region, snapshots_region, volumes_region, rds_region in region_results:
                     ips += ips_region
                     images += images_region
                     snapshots += snapshots_region
                     volumes += volumes_region
                     rds_snaps += rds_region
 
-            else:
-                if login == 'sso':
-                    logger.info(f'You were not logged in, skipping {client_name}.')
-                    clients_not_logged_in_list.append(client_name)
-                else:
-                    logger.info(f'You were not logged in, skipping {profile["profile_name"]}.')
-                    accounts_not_logged_in_list.append(profile['profile_name'])
-                continue
+                for resource_key in loaded_keys:
+                    ledgers[resource_key].commit_window()
+
+        for resource_key in resource_keys:
+            ledgers[resource_key].finish()
+            summary = ledgers[resource_key].summary()
+            mt.record_resource_ids(resources_dict[resource_key], sum(summary.values()))
+            logger.info(f'\n{client_name} {resources_dict[resource_key]}: {summary[lg.DELETED]} deleted, '
+                        f'{summary[lg.ERROR]} errors, {summary[lg.NOT_FOUND]} not found, '
+                        f'{summary[lg.PENDING]} not located.')
 
     logger.debug(f'Did not log into: {accounts_not_logged_in_list}')
 
@@ -162,7 +331,7 @@ def process_clients(clients_dict, client_keys, resource_keys, resources_dict, dr
         logger.debug('\nNo successful logins recorded. No reports will be generated.')
 
         # Return if no accounts were accessed
-        return 1
+        return 1, clients_not_logged_in_list, ips, images, snapshots, volumes, rds_snaps
     else:
         return accounts_not_logged_in_list, clients_not_logged_in_list, ips, images, snapshots, \
             volumes, rds_snaps
@@ -0,0 +1,134 @@
+import contextvars
+import random
+import threading
+import time
+import modules.circuit_breaker as cb
+import modules.errors as er
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 20.0
+
+
+class RateLimiter:
+    # Paces mutating calls for one account, region and service with a token bucket, and bounds how many are in
+    # flight. Both the rate and the in-flight limit are halved when a call is throttled and recover additively
+    # while calls succeed (AIMD), so the limiter settles just below the rate the service will sustain.
+
+    def __init__(self, rate=5.0, min_rate=0.5, max_rate=20.0, burst=10, concurrency=4, max_concurrency=16,
+                 breaker=None):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.throttles = 0
+        # Calls of a scope whose circuit is open fail at once, without waiting for a token
+        self.breaker = breaker
+
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _take(self):
+        # Take a token and an in-flight slot when both are free. Returns True once taken.
+        self._refill()
+        if self._in_flight < self.concurrency and self._tokens >= 1:
+            self._tokens -= 1
+            self._in_flight += 1
+            return True
+        return False
+
+    def acquire(self):
+        with self._condition:
+            while not self._take():
+                if self._in_flight >= self.concurrency:
+                    # Woken by release() when a slot frees up
+                    self._condition.wait()
+                else:
+                    self._condition.wait((1 - self._tokens) / self.rate)
+
+    def try_acquire(self):
+        # acquire() without blocking, for the async engine. Returns 0 once a token and a slot are taken, otherwise
+        # the seconds to wait before trying again: until the next token, or one token's time while every slot is busy.
+        with self._condition:
+            if self._take():
+                return 0
+            return max(1 - self._tokens, 1 if self._in_flight >= self.concurrency else 0) / self.rate
+
+    def release(self, throttled):
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                self.throttles += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.concurrency = max(1, self.concurrency // 2)
+                self._successes = 0
+            else:
+                self.rate = min(self.max_rate, self.rate + 0.1)
+                self._successes += 1
+                if self._successes >= self.concurrency * 10:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                    self._successes = 0
+            self._condition.notify_all()
+
+    def check(self, operation_name):
+        # The error a call fails with at once when its scope's circuit is open, without waiting for a token
+        return self.breaker.check(operation_name) if self.breaker is not None else None
+
+    def call(self, function, **kwargs):
+        # Retry throttled calls with full-jitter exponential backoff; any other error goes to the caller
+        for attempt in range(MAX_ATTEMPTS):
+            error = self.check(function.__name__)
+            if error is not None:
+                raise error
+            self.acquire()
+            throttled = False
+            try:
+                return function(**kwargs)
+            except er.AWS_ERRORS as e:
+                throttled = er.classify(e) == er.THROTTLED
+                if not throttled or attempt == MAX_ATTEMPTS - 1:
+                    raise
+            finally:
+                self.release(throttled)
+            time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+
+
+_limiters = {}
+_limiters_guard = threading.Lock()
+
+
+def get_rate_limiter(account_number, region_name, service):
+    # EC2 and RDS throttle separately per account and region, so each scope shares one limiter across workers
+    with _limiters_guard:
+        key = (account_number, region_name, service)
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(breaker=cb.get_breaker(*key))
+        return _limiters[key]
+
+
+def call(limiter, function, **kwargs):
+    if limiter is None:
+        return function(**kwargs)
+    return limiter.call(function, **kwargs)
+
+
+def map_calls(limiter, function, items):
+    # Run function for each item, concurrently when a limiter is given (its in-flight limit does the bounding).
+    # Each item runs in a copy of the caller's context, so context variables such as the metrics label carry over.
+    # Returns (item, result) pairs in the order of items.
+    if limiter is None or len(items) < 2:
+        return [(item, function(item)) for item in items]
+    contexts = [contextvars.copy_context() for item in items]
+    with ThreadPoolExecutor(max_workers=limiter.max_concurrency) as executor:
+        return list(zip(items, executor.map(lambda context, item: context.run(function, item), contexts, items)))
@@ -0,0 +1,65 @@
+import threading
+import modules.chunks as chunks
+
+INSTANCE = 'instance'
+CLUSTER = 'cluster'
+
+# (kind, operation, result key, ID key, filter) of the describe of each kind of manual snapshot
+DESCRIBES = ((INSTANCE, 'describe_db_snapshots', 'DBSnapshots', 'DBSnapshotIdentifier', 'db-snapshot-id'),
+             (CLUSTER, 'describe_db_cluster_snapshots', 'DBClusterSnapshots', 'DBClusterSnapshotIdentifier',
+              'db-cluster-snapshot-id'))
+ID_KEYS = {kind: id_key for kind, operation, result_key, id_key, filter_name in DESCRIBES}
+
+# Catalogs built during the run, keyed by (account, region)
+_catalogs = {}
+_catalogs_guard = threading.Lock()
+
+
+def snapshot_pages(rds_client):
+    # Yield (kind, snapshots) for each page of the region's manual DB and cluster snapshots
+    for kind, operation, result_key, id_key, filter_name in DESCRIBES:
+        for page in rds_client.get_paginator(operation).paginate(SnapshotType='manual'):
+            yield kind, page[result_key]
+
+
+def add_to_catalog(catalog, kind, snapshots):
+    for snapshot in snapshots:
+        catalog[snapshot[ID_KEYS[kind]]] = kind
+    return
+
+
+def build_catalog(rds_client):
+    # Map every manual DB and cluster snapshot identifier in the region to its kind, so each ID is classified
+    # in O(1) and deleted with the right API without probing
+    catalog = {}
+    for kind, snapshots in snapshot_pages(rds_client):
+        add_to_catalog(catalog, kind, snapshots)
+    return catalog
+
+
+def check_catalog(rds_client, kinds):
+    # Catalog only the given snapshots, a filter's worth at a time, when a plan is applied. kinds maps each
+    # identifier to the kind it was planned with; a snapshot that is gone is left out.
+    catalog = {}
+    for kind, operation, result_key, id_key, filter_name in DESCRIBES:
+        identifiers = [identifier for identifier, planned_kind in kinds.items() if planned_kind == kind]
+        for chunk in chunks.chunk_ids(identifiers):
+            for page in rds_client.get_paginator(operation).paginate(Filters=[{'Name': filter_name,
+                                                                               'Values': chunk}]):
+                for snapshot in page[result_key]:
+                    if snapshot[id_key] in kinds:
+                        catalog[snapshot[id_key]] = kind
+    return catalog
+
+
+def store_catalog(account_number, region_name, catalog):
+    # The region inventory stores the catalog it built, so it is reused for the rest of the run
+    with _catalogs_guard:
+        _catalogs[(account_number, region_name)] = catalog
+    return
+
+
+def cached_catalog(account_number, region_name):
+    # Returns the catalog of an account and region if one was built in this run, otherwise None
+    with _catalogs_guard:
+        return _catalogs.get((account_number, region_name))
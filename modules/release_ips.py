@@ -1,99 +1,116 @@
-import botocore.exceptions
-import os
-import shutil
-
-
-def get_ip(ec2_client, ip, logger):
-    error_msg = f'      The IP {ip} does not exist in this region or account.'
-    logger.info(f'   Searching for {ip}...')
-    ip_exists = False
-
-    try:
-        response = ec2_client.describe_addresses(PublicIps=[ip])
-        if response['Addresses']:
-            logger.info('      IP found.')
-            ip_exists = True
+import modules.errors as er
+import modules.ip_catalog as ic
+import modules.ledger as lg
+import modules.log_pipeline as lp
+import modules.permission_probe as pp
+import modules.rate_limiter as rl
+
+
+def get_ips(ips, catalog, logger):
+    # Resolve IPs from the region's address catalog without any API calls. Returns the release parameters of each
+    # unassociated IP, and sets of missing and associated IPs.
+    logger.info(f'   Searching for {len(ips)} IPs...')
+    found = {}
+    associated = set()
+
+    for ip in ips:
+        if ip not in catalog:
+            continue
+        if catalog[ip][1] is not None:
+            associated.add(ip)
+            logger.info('      The IP %s is associated with %s and will be skipped.', ip, catalog[ip][1],
+                        extra=lp.DETAIL)
         else:
-            logger.info(error_msg)
-    except botocore.exceptions.ClientError as e:
-        logger.debug(e)
-        logger.info(error_msg)
+            found[ip] = ic.release_params(catalog[ip], ip)
+
+    missing = set(ips) - set(found) - associated
+    logger.info(f'      {len(found)} IPs found, {len(associated)} associated, '
+                f'{len(missing)} do not exist in this region or account.')
+    logger.debug('      IPs not found: %s', sorted(missing))
 
-    return ip_exists
+    return found, missing, associated
 
 
-def release_ip(ec2_client, ip, dry_run, logger):
-    logger.info(f'   Trying release of {ip}...')
+def release_ip(ec2_client, ip, release_params, dry_run, logger, limiter=None):
+    logger.info('   Trying release of %s...', ip, extra=lp.DETAIL)
     deleted = False
     try:
-        response = ec2_client.release_address(PublicIp=ip, DryRun=dry_run)
-        logger.info(f'      {response}')
+        response = rl.call(limiter, ec2_client.release_address, DryRun=dry_run, **release_params)
+        logger.debug('      %s', response)
         deleted = True
-    except botocore.exceptions.ClientError as e:
-        logger.info(f'      {e}')
-        if 'DryRunOperation' in str(e):
+    except er.AWS_ERRORS as e:
+        category = er.classify(e)
+        # Calls skipped by an open circuit are reported once for the region instead
+        if category != er.CIRCUIT_OPEN:
+            logger.info('      %s: %s', category, e, extra=lp.DETAIL)
+        if category == er.DRY_RUN:
             deleted = True
 
     return deleted
 
 
-def release_ips(ec2_client, client_name, region_name, resource_name, dry_run, run_date_time, logger):
-    resource_ids_file_name = f'{client_name} {resource_name}.txt'
-    deleted_ids_file_name = f'{client_name} {resource_name} deleted.txt'
-    error_ids_file_name = f'{client_name} {resource_name} errors.txt'
-    ips_released = 0
+def record_dry_run(ledger, account_number, region_name, resource_name, ips_to_release, associated, missing, found,
+                   verdict, failures, logger):
+    # Report the dry run of a region's IPs from the probe of release_address. found maps each IP to its release
+    # parameters. Returns the IPs that would be released.
+    outcomes = pp.plan(ips_to_release, verdict, failures)
+    outcomes.update(pp.skipped(associated, pp.ASSOCIATED))
+    outcomes.update(pp.skipped(missing, pp.NOT_FOUND))
+    details = {ip: (pp.UNASSOCIATED, [found[ip]['AllocationId']] if 'AllocationId' in found[ip] else [])
+               for ip in ips_to_release}
+    return pp.record(ledger, account_number, region_name, resource_name, outcomes, logger, details)
 
-    # Copy the resource ids file if a copy doesn't already exist
-    file_copy_path = f'{client_name}_{run_date_time}/Copy of {resource_ids_file_name}'
-    if not os.path.isfile(file_copy_path):
-        shutil.copy(f'{client_name}_{run_date_time}/{resource_ids_file_name}', file_copy_path)
-        logger.info('Initial copy of resource ID file was successful.')
 
-    # Read IPs from file
-    try:
-        with open(f'{client_name}_{run_date_time}/{resource_ids_file_name}', 'r') as file:
-            ips_list = [line.strip() for line in file]
-            logger.info(f'Locating {len(ips_list)} IPs...')
-    except FileNotFoundError:
-        logger.info(f'File not found: {resource_ids_file_name}. Skipping IP release in {region_name}.')
-        return ips_released
+def release_ips(ec2_client, client_name, region_name, resource_name, dry_run, run_date_time, logger,
+                region_ids=None, limiter=None, ledger=None, catalog=None, account_number=None):
+    ips_released = 0
 
-    original_ips_list_length = len(ips_list)
-    ips_to_release = []
+    if ledger is None:
+        ledger = lg.IdLedger(client_name, resource_name, run_date_time, logger)
+    if not ledger.exists:
+        logger.info(f'File not found: {client_name} {resource_name}.txt. Skipping IP release in {region_name}.')
+        return ips_released
 
-    # Search for each IP. If it exists, delete the IP
-    for ip in ips_list:
-        if get_ip(ec2_client, ip, logger):
-            ips_to_release.append(ip)
-    if ips_to_release:
+    # Only search for unresolved IPs, limited to those the region inventory located in this region
+    ips_list = ledger.pending(region_ids)
+    logger.info(f'Locating {len(ips_list)} IPs...')
+
+    # Look up every IP in the region's address catalog, listing the addresses once if the inventory did not
+    if catalog is None:
+        try:
+            catalog = ic.build_catalog(ec2_client)
+        except er.AWS_ERRORS as e:
+            logger.debug(e)
+            logger.info(f'   Unable to list Elastic IPs in {region_name}. Skipping IP release.')
+            return ips_released
+
+    # Release every unassociated IP by allocation ID; associated IPs stay in the working file
+    found, missing, associated = get_ips(ips_list, catalog, logger)
+    ledger.mark_not_found(missing)
+    ips_to_release = [ip for ip in ips_list if ip in found]
+    if dry_run:
+        # One DryRun call for the region stands in for a call per IP
+        verdict, failures = pp.probe(account_number, region_name, 'release_address',
+                                     lambda ip: rl.call(limiter, ec2_client.release_address, DryRun=True,
+                                                        **found[ip]), ips_to_release, logger)
+        ips_released = len(record_dry_run(ledger, account_number, region_name, resource_name, ips_to_release,
+                                          associated, missing, found, verdict, failures, logger))
+    elif ips_to_release:
         logger.info(f'\nReleasing {len(ips_to_release)} IPs...')
-        del_file = open(f'{client_name}_{run_date_time}/{deleted_ids_file_name}', 'a')
-        err_file = open(f'{client_name}_{run_date_time}/{error_ids_file_name}', 'a')
-        errors_list = [line.strip() for line in err_file]
-        for ip_to_release in ips_to_release:
-            if ip_to_release not in errors_list:
-                if release_ip(ec2_client, ip_to_release, dry_run, logger):
-                    ips_released += 1
-                    del_file.write(ip_to_release + '\n')
-                    ips_list.remove(ip_to_release)
-                else:
-                    err_file.write(ip_to_release + '\n')
-        del_file.close()
-        err_file.close()
+        results = rl.map_calls(limiter, lambda ip_to_release: release_ip(ec2_client, ip_to_release,
+                                                                         found[ip_to_release], dry_run, logger,
+                                                                         limiter), ips_to_release)
+        released_ips = [ip_to_release for ip_to_release, released in results if released]
+        ips_released = len(released_ips)
+        ledger.mark_deleted(released_ips)
+        ledger.mark_errors([ip_to_release for ip_to_release, released in results if not released])
+
+    # Rewrite the working file without the released IPs; it is removed once it is empty
+    remaining_ips = ledger.flush()
 
     logger.info(f'\nNumber of IPs released: {ips_released}')
-    logger.info(f'Number of remaining IPs: {len(ips_list)}')
-
-    # Rewrite IPs file if IPs were deleted
-    if 0 < len(ips_list) < original_ips_list_length:
-        logger.info('Rewriting working IPs file...')
-        os.remove(f'{client_name}_{run_date_time}/{resource_ids_file_name}')
-        file = open(f'{client_name}_{run_date_time}/{resource_ids_file_name}', 'w')
-        for ip in ips_list:
-            file.write(ip + '\n')
-        file.close()
-    elif not ips_list:
-        os.remove(f'{client_name}_{run_date_time}/{resource_ids_file_name}')
+    logger.info(f'Number of remaining IPs: {remaining_ips}')
+    if not remaining_ips:
         logger.info('All IPs released. IPs file removed.')
 
     return ips_released
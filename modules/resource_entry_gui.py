@@ -1,62 +1,92 @@
-import easygui as eg
+import itertools
 import sys
 import os
+import modules.id_router as rt
+
+# Batch runs never open a dialog, so they run on machines without easygui or tkinter
+try:
+    import easygui as eg
+except ImportError:
+    eg = None
+
+# IDs shown in the confirmation box; the full list is in the resource ID file
+PREVIEW_SIZE = 100
+
+
+def iter_lines(text):
+    # Yield the lines of a pasted entry one at a time instead of splitting the whole paste into a list
+    start = 0
+    while start <= len(text):
+        end = text.find('\n', start)
+        if end == -1:
+            end = len(text)
+        yield text[start:end]
+        start = end + 1
 
 
 def get_resource_ids(client_name, resource_keys, resources_dict, run_date_time, logger):
-    resource_ids_list = [[], [], [], [], [], []]
+    # Returns the number of IDs written for each resource type
+    resource_id_counts = [0, 0, 0, 0, 0, 0]
+    router = rt.IdRouter(resource_keys)
 
-    for key in resource_keys:
-        resource_name = resources_dict[key]
-        should_continue = False
-
-        while not should_continue:
-            entry = eg.enterbox(f'Enter resource IDs for:'
-                                f'\n\nClient: {client_name}'
-                                f'\nResource: {resource_name}'
-                                f'\n\nCopy/paste directly from Excel. Disregard the strange-looking formatting in the '
-                                f'entry field.'
-                                f'\n\nIf there are no resources to enter, leave the entry field blank and click the '
-                                f'<OK> button.',
-                                title=f'{client_name} {resource_name} Resource Entry')
-            if entry is None:
-                logger.info(f'\nExiting application.')
-                sys.exit(0)
-
-            if entry:
-                entry_list = entry.split('\n')
-
-                confirmed = eg.indexbox(f'You have entered {len(entry_list)} {resource_name} IDs:'
-                                        f'\n\n{os.linesep.join(f"{entry}" for entry in entry_list)}'
-                                        f'\n\nIs this correct?', title='Confirm Resource ID Entry',
-                                        choices=['Yes', 'No', 'Exit'], cancel_choice='Exit')
-
-                # 'Exit' exits the app; 'No' re-prompts for same resource; 'Yes' writes the resource file and continues.
-                if confirmed == 2:
+    def routed_ids():
+        # Each box is routed into the working ID files as soon as it is confirmed, so no entry is kept once the
+        # next box is shown. An ID pasted in the wrong box still goes to the file of its resource type.
+        for key in resource_keys:
+            resource_name = resources_dict[key]
+            should_continue = False
+
+            while not should_continue:
+                entry = eg.enterbox(f'Enter resource IDs for:'
+                                    f'\n\nClient: {client_name}'
+                                    f'\nResource: {resource_name}'
+                                    f'\n\nCopy/paste directly from Excel. Disregard the strange-looking formatting in '
+                                    f'the entry field.'
+                                    f'\n\nIf there are no resources to enter, leave the entry field blank and click '
+                                    f'the <OK> button.',
+                                    title=f'{client_name} {resource_name} Resource Entry')
+                if entry is None:
                     logger.info(f'\nExiting application.')
                     sys.exit(0)
-                elif confirmed == 1:
-                    logger.info(f'{resource_name} resources not confirmed.')
-                elif confirmed == 0:
-                    logger.info(f'\n{resource_name}: {entry_list}')
-                    resource_ids_list[int(key) - 1] = entry_list
-
-                    # Write a file of each resource ID set for backup reference
-                    try:
-                        file = open(f'{client_name}_{run_date_time}/{client_name} {resource_name}.txt', 'w')
-                        for i in range(len(entry_list)):
-                            if i == (len(entry_list) - 1):
-                                file.write(entry_list[i])
-                            else:
-                                file.write(entry_list[i] + '\n')
-                        file.close()
-                        logger.info(f'"{client_name} {resource_name}.txt" written successfully.')
-                    except FileNotFoundError:
-                        logger.info(f'Something went wrong when trying to write "{client_name} {resource_name}.txt".')
 
+                if entry:
+                    entry_count = entry.count('\n') + 1
+                    preview = os.linesep.join(itertools.islice(iter_lines(entry), PREVIEW_SIZE))
+                    if entry_count > PREVIEW_SIZE:
+                        preview += f'{os.linesep}... and {entry_count - PREVIEW_SIZE} more'
+
+                    confirmed = eg.indexbox(f'You have entered {entry_count} {resource_name} IDs:'
+                                            f'\n\n{preview}'
+                                            f'\n\nIs this correct?', title='Confirm Resource ID Entry',
+                                            choices=['Yes', 'No', 'Exit'], cancel_choice='Exit')
+
+                    # 'Exit' exits the app; 'No' re-prompts for same resource; 'Yes' routes the entry and continues.
+                    if confirmed == 2:
+                        logger.info(f'\nExiting application.')
+                        sys.exit(0)
+                    elif confirmed == 1:
+                        logger.info(f'{resource_name} resources not confirmed.')
+                    elif confirmed == 0:
+                        logger.info(f'\n{resource_name}: {entry_count} IDs entered.')
+                        yield from router.route(key, entry)
+                        should_continue = True
+                else:
+                    logger.info(f'{resource_name} resources not entered.')
                     should_continue = True
-            else:
-                logger.info(f'{resource_name} resources not entered. No file written.')
-                should_continue = True
 
-    return
+    try:
+        written = rt.write_ids(routed_ids(), client_name, resources_dict, run_date_time)
+    except FileNotFoundError:
+        logger.info(f'Something went wrong when trying to write the resource ID files for {client_name}.')
+        written = {}
+    router.log_summary(client_name, resources_dict, logger)
+    router.write_rejected(f'{client_name}_{run_date_time}/{client_name} rejected IDs.txt', resources_dict)
+
+    for key in resource_keys:
+        if key in written:
+            resource_id_counts[int(key) - 1] = written[key]
+            logger.info(f'"{client_name} {resources_dict[key]}.txt" written successfully with {written[key]} IDs.')
+        else:
+            logger.info(f'No valid {resources_dict[key]} IDs entered. No file written.')
+
+    return resource_id_counts
@@ -0,0 +1,107 @@
+import aws_sso_lib as sso
+import boto3
+import botocore.config
+import botocore.utils
+import modules.circuit_breaker as cb
+import modules.metrics as mt
+import os
+import threading
+
+# Clients are shared by every worker of a region, so their connection pools are sized for the most calls a rate
+# limiter lets run at once
+CLIENT_CONFIG = botocore.config.Config(max_pool_connections=20)
+
+# Endpoint every client is created against instead of the AWS endpoints when set, e.g. the benchmark's local
+# stand-in for EC2, RDS and STS
+ENDPOINT_URL = None
+
+# The AWS CLI's credential cache. botocore's JSONFileCache defaults to ~/.aws/boto/cache instead.
+CLI_CACHE = os.path.expanduser(os.path.join('~', '.aws', 'cli', 'cache'))
+
+
+class CredentialCache:
+    # SSO role credentials kept in memory and in the AWS CLI's file cache (~/.aws/cli/cache) until they expire, so
+    # every region of an account, and later runs, reuse them instead of calling GetRoleCredentials again.
+    # botocore checks the expiry of cached credentials and refreshes them itself.
+
+    def __init__(self, directory=CLI_CACHE):
+        self._memory = {}
+        self._disk = botocore.utils.JSONFileCache(directory)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._memory or key in self._disk
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key not in self._memory:
+                self._memory[key] = self._disk[key]
+            return self._memory[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            try:
+                self._disk[key] = value
+            except OSError:
+                # The in-memory copy still serves the rest of the run
+                pass
+
+
+class PooledSession:
+    # One account and role in one region. Each client is created once and shared by every worker in the region,
+    # reusing its connection pool; the credentials belong to the account's session and are shared by all regions.
+
+    def __init__(self, session, session_lock, account_number, region_name):
+        self.account_number = account_number
+        self.region_name = region_name
+        self._session = session
+        self._session_lock = session_lock
+        self._clients = {}
+
+    def client(self, service_name):
+        # boto3 sessions are not thread-safe, so clients of the same account are created one at a time
+        with self._session_lock:
+            if service_name not in self._clients:
+                client = self._session.client(service_name, region_name=self.region_name, endpoint_url=ENDPOINT_URL,
+                                              config=CLIENT_CONFIG)
+                self._clients[service_name] = cb.guard(mt.instrument(client, self.account_number),
+                                                       self.account_number)
+            return self._clients[service_name]
+
+    def get_credentials(self):
+        return self._session.get_credentials()
+
+
+_credential_cache = CredentialCache()
+_account_sessions = {}
+_sessions = {}
+_sessions_guard = threading.Lock()
+
+
+def get_credential_cache():
+    # The SSO role credential cache shared by every session of the run, including the login checks
+    return _credential_cache
+
+
+def _create_session(profile, login, start_url, sso_region, role_name, region):
+    if login == 'sso':
+        return sso.get_boto3_session(start_url, sso_region, int(profile['account_number']), role_name,
+                                     region=region, login=False, credential_cache=get_credential_cache())
+    # Name the profile explicitly instead of relying on AWS_PROFILE, which the next login overwrites
+    return boto3.Session(profile_name=profile['profile_name'], region_name=region)
+
+
+def get_session(profile, login, start_url, sso_region, role_name, region):
+    # Sessions are pooled by (account, role, region) and shared by every worker and resource type of the run.
+    # All regions of an account and role share one set of credentials.
+    account_key = (profile['account_number'], role_name if login == 'sso' else profile['profile_name'])
+    with _sessions_guard:
+        if account_key not in _account_sessions:
+            session = _create_session(profile, login, start_url, sso_region, role_name, region)
+            _account_sessions[account_key] = (session, threading.Lock())
+        session_key = account_key + (region,)
+        if session_key not in _sessions:
+            _sessions[session_key] = PooledSession(*_account_sessions[account_key], profile['account_number'], region)
+        return _sessions[session_key]
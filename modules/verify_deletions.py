@@ -0,0 +1,134 @@
+import time
+import modules.chunks as chunks
+import modules.delete_ec2_snapshots as des
+import modules.delete_images as di
+import modules.delete_volumes as dv
+import modules.errors as er
+import modules.id_files as idf
+import modules.log_pipeline as lp
+import modules.metrics as mt
+import modules.rds_catalog as rc
+
+# Polls of just-deleted IDs back off exponentially from BACKOFF_BASE to BACKOFF_CAP seconds, until every ID is gone
+# or TIMEOUT seconds have passed
+BACKOFF_BASE = 2.0
+BACKOFF_CAP = 30.0
+TIMEOUT = 300.0
+
+# States in which a resource that is still described counts as gone
+GONE_STATES = {'deregistered', 'deleted'}
+
+# State of an ID whose resource type could not be described at all
+UNVERIFIED = 'unverified'
+
+
+# EC2 resource keys from main.resources_dict mapped to the describe that shows which of their IDs still exist. IPs and
+# RDS snapshots are listed for the whole region instead.
+EC2_DESCRIBES = {
+    '1': di.DESCRIBE,
+    '2': di.DESCRIBE,
+    '3': des.DESCRIBE,
+    '5': dv.DESCRIBE
+}
+
+
+def ec2_states(describe, resources):
+    id_key = describe[2]
+    return {resource[id_key]: resource.get('State', 'available') for resource in resources}
+
+
+def address_states(addresses, resource_ids):
+    resource_ids = set(resource_ids)
+    return {address['PublicIp']: 'associated' if address.get('AssociationId') else 'allocated'
+            for address in addresses if address.get('PublicIp') in resource_ids}
+
+
+def add_snapshot_states(present, kind, snapshots, resource_ids):
+    # Add the states of one page of RDS snapshots of a kind whose identifiers are in the set resource_ids
+    for snapshot in snapshots:
+        if snapshot[rc.ID_KEYS[kind]] in resource_ids:
+            present[snapshot[rc.ID_KEYS[kind]]] = snapshot.get('Status', 'available')
+    return
+
+
+def describe_states(ec2_client, rds_client, key, resource_ids):
+    # Returns {ID: state} of the resource IDs that are still described: EC2 resources a filter's worth at a time,
+    # IPs in one call and RDS snapshots by listing the region's manual snapshots. Errors go to the caller, so an ID
+    # is never confirmed as gone because it could not be described.
+    if key in EC2_DESCRIBES:
+        resources = []
+        for chunk in chunks.chunk_ids(resource_ids):
+            resources.extend(chunks.describe_chunk(ec2_client, EC2_DESCRIBES[key], chunk))
+        return ec2_states(EC2_DESCRIBES[key], resources)
+    if key == '4':
+        return address_states(ec2_client.describe_addresses()['Addresses'], resource_ids)
+    present = {}
+    resource_ids = set(resource_ids)
+    for kind, snapshots in rc.snapshot_pages(rds_client):
+        add_snapshot_states(present, kind, snapshots, resource_ids)
+    return present
+
+
+def backoff_delay(attempt):
+    return min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)
+
+
+def still_present(present, resource_ids):
+    # The IDs of resource_ids still described in a state other than gone, with their states
+    return {resource_id: present[resource_id] for resource_id in resource_ids
+            if resource_id in present and present[resource_id] not in GONE_STATES}
+
+
+def record_poll(stragglers, remaining, key, present):
+    # Update the stragglers and the IDs still polled of one resource type from a poll's {ID: state}. present is None
+    # when the type could not be described; its IDs are unverified and it is not polled again.
+    if present is None:
+        stragglers[key] = {resource_id: UNVERIFIED for resource_id in remaining[key]}
+        del remaining[key]
+        return
+    stragglers[key] = still_present(present, remaining[key])
+    remaining[key] = list(stragglers[key])
+    if not remaining[key]:
+        del remaining[key]
+    return
+
+
+def verify_deletions(ec2_client, rds_client, deleted, resources_dict, logger, timeout=TIMEOUT):
+    # Poll every resource type's just-deleted IDs of one region together, in bulk, until none is described any
+    # more or the timeout passes. deleted maps resource keys to IDs. Returns {key: {ID: last state}} of the
+    # stragglers.
+    remaining = {key: list(resource_ids) for key, resource_ids in deleted.items() if resource_ids}
+    stragglers = {}
+    deadline = time.monotonic() + timeout
+    attempt = 0
+
+    while remaining:
+        for key in list(remaining):
+            try:
+                with mt.resource_label(resources_dict[key]):
+                    present = describe_states(ec2_client, rds_client, key, remaining[key])
+            except er.AWS_ERRORS as e:
+                logger.debug(e)
+                present = None
+            record_poll(stragglers, remaining, key, present)
+
+        delay = backoff_delay(attempt)
+        if not remaining or time.monotonic() + delay > deadline:
+            break
+        time.sleep(delay)
+        attempt += 1
+
+    return stragglers
+
+
+def report_stragglers(ledger, account_number, region_name, resource_name, deleted_ids, stragglers, logger):
+    # Log how many deletions were confirmed and record every straggler with its state next to the working file
+    with mt.resource_label(resource_name):
+        logger.info(f'   {resource_name} in {region_name}: {len(deleted_ids) - len(stragglers)} of '
+                    f'{len(deleted_ids)} deletions confirmed, {len(stragglers)} still present.')
+        for resource_id, state in stragglers.items():
+            logger.info('      %s is still %s.', resource_id, state, extra=lp.DETAIL)
+    idf.append_ids(f'{ledger.resource_ids_path[:-len(".txt")]} stragglers.txt',
+                   [f'{resource_id}\t{state}\t{account_number}\t{region_name}'
+                    for resource_id, state in sorted(stragglers.items())])
+    return
@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+import time
+
+QUEUE_DIRECTORY = 'farm'
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+# A unit whose lease runs out is handed to the next worker that asks, up to MAX_ATTEMPTS times
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    client_key TEXT NOT NULL,
+    account_number TEXT NOT NULL,
+    region TEXT NOT NULL,
+    resource_key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    UNIQUE (client_key, account_number, region, resource_key)
+);
+CREATE INDEX IF NOT EXISTS units_state ON units (state, lease_expires);
+CREATE TABLE IF NOT EXISTS merges (client_key TEXT NOT NULL, resource_key TEXT NOT NULL,
+                                   PRIMARY KEY (client_key, resource_key));
+'''
+
+
+def queue_path(run_date_time, directory=QUEUE_DIRECTORY):
+    return f'{directory}/run_{run_date_time}.sqlite'
+
+
+class WorkQueue:
+    # Durable queue of the (client, account, region, resource type) units of one run in a SQLite file. Worker
+    # processes, on this machine or others sharing the file system, claim units with leases they renew while they
+    # work; a unit whose worker died is claimed again once its lease expires. The rollback journal is used instead
+    # of WAL, which does not work on network file systems. Each method is its own transaction, and one instance
+    # belongs to one thread.
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._connection.executescript(_SCHEMA)
+
+    def _transaction(self, statements):
+        # Run statements, a function of the cursor, in a write transaction taken up front, so two workers never
+        # both read a unit as free before either claims it
+        cursor = self._connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            result = statements(cursor)
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        return result
+
+    def save_settings(self, settings):
+        self._transaction(lambda cursor: cursor.executemany(
+            'INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)',
+            [(name, json.dumps(value)) for name, value in settings.items()]))
+        return
+
+    def settings(self):
+        return {name: json.loads(value) for name, value in
+                self._connection.execute('SELECT name, value FROM settings')}
+
+    def add_units(self, units):
+        # Units already queued, e.g. by the interrupted run being resumed, keep their state
+        self._transaction(lambda cursor: cursor.executemany(
+            'INSERT OR IGNORE INTO units (client_key, account_number, region, resource_key, state) '
+            'VALUES (?, ?, ?, ?, ?)', [tuple(unit) + (PENDING,) for unit in units]))
+        return
+
+    def claim(self, worker, lease_seconds=LEASE_SECONDS):
+        # Lease the next pending or expired unit to worker. Returns (unit ID, client key, account, region,
+        # resource key), or None when no unit is free right now.
+        def statements(cursor):
+            now = time.time()
+            # Units that ran out of attempts are failed instead of being handed out again
+            cursor.execute('UPDATE units SET state = ?, error = ? WHERE state = ? AND lease_expires < ? '
+                           'AND attempts >= ?', (FAILED, 'lease expired', LEASED, now, MAX_ATTEMPTS))
+            row = cursor.execute('SELECT id, client_key, account_number, region, resource_key FROM units '
+                                 'WHERE state = ? OR (state = ? AND lease_expires < ?) ORDER BY id LIMIT 1',
+                                 (PENDING, LEASED, now)).fetchone()
+            if row is not None:
+                cursor.execute('UPDATE units SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 '
+                               'WHERE id = ?', (LEASED, worker, now + lease_seconds, row[0]))
+            return row
+
+        return self._transaction(statements)
+
+    def renew(self, unit_id, worker, lease_seconds=LEASE_SECONDS):
+        # Returns False when the lease was lost, i.e. the unit expired and was claimed by another worker
+        return self._transaction(lambda cursor: cursor.execute(
+            'UPDATE units SET lease_expires = ? WHERE id = ? AND worker = ? AND state = ?',
+            (time.time() + lease_seconds, unit_id, worker, LEASED)).rowcount == 1)
+
+    def complete(self, unit_id, worker, result):
+        # Record the unit's result; returns False, recording nothing, when the lease was lost
+        return self._transaction(lambda cursor: cursor.execute(
+            'UPDATE units SET state = ?, result = ?, lease_expires = NULL WHERE id = ? AND worker = ? AND state = ?',
+            (DONE, json.dumps(result), unit_id, worker, LEASED)).rowcount == 1)
+
+    def fail(self, unit_id, worker, error, retry=True):
+        # Hand the unit back for another attempt, or fail it when it is out of attempts or not worth retrying
+        def statements(cursor):
+            cursor.execute('UPDATE units SET state = CASE WHEN ? AND attempts < ? THEN ? ELSE ? END, error = ?, '
+                           'lease_expires = NULL WHERE id = ? AND worker = ? AND state = ?',
+                           (retry, MAX_ATTEMPTS, PENDING, FAILED, error, unit_id, worker, LEASED))
+
+        self._transaction(statements)
+        return
+
+    def retry_failed(self):
+        # Give failed units a fresh set of attempts, when a run is resumed
+        self._transaction(lambda cursor: cursor.execute(
+            'UPDATE units SET state = ?, attempts = 0, error = NULL WHERE state = ?', (PENDING, FAILED)))
+        return
+
+    def counts(self):
+        # Number of units in each state
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        counts.update(self._connection.execute('SELECT state, COUNT(*) FROM units GROUP BY state'))
+        return counts
+
+    def active_leases(self):
+        # Number of units leased to a worker whose lease has not run out
+        return self._connection.execute('SELECT COUNT(*) FROM units WHERE state = ? AND lease_expires >= ?',
+                                        (LEASED, time.time())).fetchone()[0]
+
+    def finished(self):
+        # True once no unit is pending or leased
+        return self._connection.execute('SELECT COUNT(*) FROM units WHERE state IN (?, ?)',
+                                        (PENDING, LEASED)).fetchone()[0] == 0
+
+    def results(self, client_key, resource_key):
+        # The results of the client's done units of a resource type
+        return [json.loads(result) for result, in self._connection.execute(
+            'SELECT result FROM units WHERE client_key = ? AND resource_key = ? AND state = ? ORDER BY id',
+            (client_key, resource_key, DONE))]
+
+    def failures(self):
+        # (client key, account, region, resource key, error) of every failed unit
+        return self._connection.execute('SELECT client_key, account_number, region, resource_key, error FROM units '
+                                        'WHERE state = ? ORDER BY id', (FAILED,)).fetchall()
+
+    def merged(self, client_key, resource_key):
+        return self._connection.execute('SELECT COUNT(*) FROM merges WHERE client_key = ? AND resource_key = ?',
+                                        (client_key, resource_key)).fetchone()[0] > 0
+
+    def mark_merged(self, client_key, resource_key):
+        self._transaction(lambda cursor: cursor.execute(
+            'INSERT OR IGNORE INTO merges (client_key, resource_key) VALUES (?, ?)', (client_key, resource_key)))
+        return
+
+    def close(self):
+        self._connection.close()
+        return
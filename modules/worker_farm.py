@@ -0,0 +1,390 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import modules.aws_login as aws
+import modules.batch_input as bi
+import modules.circuit_breaker as cb
+import modules.deletion_plan as dp
+import modules.id_files as idf
+import modules.inventory as inv
+import modules.inventory_cache as ivc
+import modules.ledger as lg
+import modules.process_clients as pc
+import modules.resource_entry_gui as reg
+import modules.session_pool as sp
+import modules.work_queue as wq
+
+# Seconds an idle worker waits before asking again while other workers still hold leases
+POLL_SECONDS = 5
+
+# Outcome of an ID resolved without being recorded as deleted, next to the ledger states in unit result files
+UNRECORDED = 'unrecorded'
+
+# When a unit's results name an ID more than once, the later outcome here wins
+OUTCOME_ORDER = (lg.NOT_FOUND, lg.ERROR, UNRECORDED, lg.DELETED)
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+
+
+def worker_name():
+    # Unique among the workers of every machine sharing the queue, and safe in file names
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def client_directory(client_name, run_date_time):
+    return f'{client_name}_{run_date_time}'
+
+
+def resource_ids_path(client_name, resource_name, run_date_time):
+    return f'{client_directory(client_name, run_date_time)}/{client_name} {resource_name}.txt'
+
+
+class UnitLedger:
+    # Stands in for the client's IdLedger in one window of a work unit. The window's outcomes are kept in memory and
+    # appended to the unit's result file; the coordinator applies them to the working files once every unit of the
+    # client is done.
+
+    def __init__(self, resource_ids_path, resource_ids):
+        self.resource_ids_path = resource_ids_path
+        self.exists = True
+        self.done = False
+        self._states = {resource_id: lg.PENDING for resource_id in resource_ids}
+        self._unrecorded = set()
+        self.deleted_ids = []
+
+    def for_scope(self, account_number, region_name):
+        return self
+
+    def pending(self, region_ids=None):
+        if region_ids is None:
+            return [resource_id for resource_id, state in self._states.items() if state in lg.UNRESOLVED]
+        return sorted(resource_id for resource_id in region_ids if self._states.get(resource_id) in lg.UNRESOLVED)
+
+    def _mark(self, resource_ids, state):
+        for resource_id in resource_ids:
+            if resource_id in self._states:
+                self._states[resource_id] = state
+
+    def mark_not_found(self, resource_ids):
+        self._mark([resource_id for resource_id in resource_ids if self._states.get(resource_id) == lg.PENDING],
+                   lg.NOT_FOUND)
+
+    def mark_deleted(self, resource_ids, record=True):
+        # RDS dry runs make no API calls, so their resolved IDs are not recorded as deleted
+        self._mark(resource_ids, lg.DELETED)
+        if record:
+            self.deleted_ids.extend(resource_ids)
+        else:
+            self._unrecorded.update(resource_ids)
+
+    def mark_errors(self, resource_ids):
+        self._mark(resource_ids, lg.ERROR)
+
+    def flush(self):
+        return sum(1 for state in self._states.values() if state != lg.DELETED)
+
+    def outcome_lines(self):
+        # A line of ID and outcome for each of the unit's IDs searched for without being found, deleted, resolved
+        # without being recorded, or failed
+        for resource_id, state in self._states.items():
+            if state == lg.DELETED and resource_id in self._unrecorded:
+                state = UNRECORDED
+            if state != lg.PENDING:
+                yield f'{resource_id}\t{state}'
+
+
+def keep_leased(path, unit_id, worker, stop):
+    # Renew the unit's lease until stop is set, on a connection of this thread's own
+    queue = wq.WorkQueue(path)
+    try:
+        while not stop.wait(wq.LEASE_SECONDS / 3):
+            if not queue.renew(unit_id, worker):
+                break
+    finally:
+        queue.close()
+    return
+
+
+def unit_windows(path, inventory):
+    # The unit's IDs, one list at a time. Only the IDs the region's inventory located are handled, and they fit in
+    # one list; when the inventory could not be taken, every ID is searched for one lg.WINDOW_SIZE window at a time.
+    if not os.path.isfile(path):
+        return
+    if inventory is None:
+        for chunk, end_offset in idf.iter_id_chunks(path, lg.WINDOW_SIZE):
+            yield chunk
+    else:
+        yield [resource_id for chunk, end_offset in idf.iter_id_chunks(path, lg.WINDOW_SIZE)
+               for resource_id in chunk if resource_id in inventory]
+
+
+def run_unit(unit, clients_dict, resources_dict, settings, logger):
+    # Delete one resource type of one client in one account and region. Returns the unit's result, after writing
+    # the IDs it resolved to a result file in the client's directory, or None when the account's credentials are no
+    # longer valid.
+    unit_id, client_key, account_number, region, key = unit
+    client = clients_dict[client_key]
+    client_name = client['name']
+    resource_name = resources_dict[key]
+    run_date_time = settings['run_date_time']
+    profile = next(profile for profile in client['profiles'] if profile['account_number'] == account_number)
+    login, start_url, sso_region, role_name = pc.client_login(client)
+
+    # The coordinator logged in already. Workers run headless, here or on other machines, so expired credentials
+    # fail the unit instead of opening a login window.
+    if not aws.verify_login(login, profile, logger, start_url=start_url, sso_region=sso_region, role_name=role_name):
+        logger.info(f'Not logged in to {profile["account_name"]}. Log in and resume the run to retry the unit.')
+        return None
+    session = sp.get_session(profile, login, start_url, sso_region, role_name, region)
+    cb.start_deadline(account_number, region)
+
+    # Only the client's IDs located in this region are handled; all of them are searched for when the region's
+    # inventory could not be taken. An applied plan already knows them.
+    path = resource_ids_path(client_name, resource_name, run_date_time)
+    if settings.get('plan') is not None:
+        planned_ids = dp.planned(dp.cached_plan(settings['plan'], clients_dict, resources_dict), client_key,
+                                 account_number, region, [key])
+        inventory = dp.check_region(session, planned_ids, region, logger, account_number)
+    else:
+        inventory = inv.get_region_inventory(session, [key], region, logger, account_number)
+    inventory = inventory.get(inv.RESOURCE_INVENTORY_TYPES[key], set())
+
+    # Each window's outcomes are appended to the result file as soon as the window is done. The file is moved into
+    # place before the unit is completed, so the queue never refers to a result file that does not exist.
+    units_directory = f'{client_directory(client_name, run_date_time)}/units'
+    os.makedirs(units_directory, exist_ok=True)
+    result_path = f'{units_directory}/{unit_id}.txt'
+    open(f'{result_path}.tmp', 'w').close()
+    counts = [0, 0, 0, 0, 0]
+    for resource_ids in unit_windows(path, inventory):
+        ledger = UnitLedger(path, resource_ids)
+        window_counts = pc.delete_resources(profile, client_name, region, session, [key], resources_dict,
+                                            settings['dry_run'], run_date_time, settings['three_months'], logger,
+                                            {key: None if inventory is None else set(resource_ids)}, {key: ledger},
+                                            settings.get('verify', False))
+        counts = [count + window_count for count, window_count in zip(counts, window_counts)]
+        idf.append_ids(f'{result_path}.tmp', list(ledger.outcome_lines()))
+    os.replace(f'{result_path}.tmp', result_path)
+    return {'file': result_path, 'counts': counts}
+
+
+def run_worker(path, clients_dict, resources_dict, logger):
+    # Claim and run units from the queue at path until none are left. Any number of workers, on this machine or on
+    # others sharing the file system, can run at once. Returns the number of units this worker completed.
+    queue = wq.WorkQueue(path)
+    settings = queue.settings()
+    ivc.TTL = settings.get('inventory_ttl', ivc.TTL)
+    cb.DEADLINE = settings.get('region_deadline', cb.DEADLINE)
+    worker = worker_name()
+    completed = 0
+    logger.info(f'\nWorker {worker} started on {path}.')
+
+    while True:
+        unit = queue.claim(worker)
+        if unit is None:
+            if queue.finished():
+                break
+            # Other workers hold the remaining units; their leases may still run out
+            time.sleep(POLL_SECONDS)
+            continue
+
+        unit_id, client_key, account_number, region, key = unit
+        logger.info(f'\nUnit {unit_id}: {clients_dict[client_key]["name"]} {resources_dict[key]} in '
+                    f'{account_number} {region}.')
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=keep_leased, args=(path, unit_id, worker, stop), daemon=True)
+        heartbeat.start()
+        try:
+            result = run_unit(unit, clients_dict, resources_dict, settings, logger)
+        except Exception as e:
+            # One unit failing does not stop the worker; the unit is retried up to wq.MAX_ATTEMPTS times
+            logger.debug(e, exc_info=True)
+            logger.info(f'Unit {unit_id} failed: {e!r}')
+            queue.fail(unit_id, worker, repr(e))
+        else:
+            if result is None:
+                queue.fail(unit_id, worker, 'not logged in', retry=False)
+            elif queue.complete(unit_id, worker, result):
+                completed += 1
+            else:
+                logger.info(f'Unit {unit_id} was claimed by another worker after its lease expired.')
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    queue.close()
+    logger.info(f'\nWorker {worker} finished: {completed} units completed.')
+    return completed
+
+
+def window_outcomes(result_files, window):
+    # The merged outcome of each of the window's IDs over every unit's result file, read a line at a time. An ID
+    # deleted in one region is not an error because another region could not delete it.
+    outcomes = {}
+    for result_file in result_files:
+        with open(result_file) as file:
+            for line in file:
+                resource_id, outcome = line.rstrip('\n').split('\t')
+                if resource_id in window and \
+                        OUTCOME_ORDER.index(outcome) >= OUTCOME_ORDER.index(outcomes.get(resource_id, lg.NOT_FOUND)):
+                    outcomes[resource_id] = outcome
+    return outcomes
+
+
+def merge_results(queue, client_key, client_name, key, resource_name, run_date_time, logger):
+    # Apply the unit results of a client's resource type to its working, deleted and error files, as the client's
+    # IdLedger does in a single-process run, one lg.WINDOW_SIZE window of the working file at a time. Returns the
+    # ledger summary counts.
+    path = resource_ids_path(client_name, resource_name, run_date_time)
+    summary = {lg.PENDING: 0, lg.NOT_FOUND: 0, lg.DELETED: 0, lg.ERROR: 0}
+    if not os.path.isfile(path):
+        return summary
+
+    result_files = [result['file'] for result in queue.results(client_key, key)]
+    remaining = 0
+    with open(f'{path}.tmp', 'w') as file:
+        for chunk, end_offset in idf.iter_id_chunks(path, lg.WINDOW_SIZE):
+            outcomes = window_outcomes(result_files, set(chunk))
+            deleted = []
+            errors = []
+            for resource_id in chunk:
+                outcome = outcomes.get(resource_id, lg.PENDING)
+                if outcome in (lg.DELETED, UNRECORDED):
+                    summary[lg.DELETED] += 1
+                    if outcome == lg.DELETED:
+                        deleted.append(resource_id)
+                    continue
+                file.write(resource_id + '\n')
+                remaining += 1
+                summary[outcome] += 1
+                if outcome == lg.ERROR:
+                    errors.append(resource_id)
+            idf.append_ids(f'{client_directory(client_name, run_date_time)}/{client_name} {resource_name} '
+                           f'deleted.txt', sorted(deleted))
+            idf.append_ids(f'{client_directory(client_name, run_date_time)}/{client_name} {resource_name} '
+                           f'errors.txt', sorted(errors))
+    if remaining:
+        logger.info('Rewriting working resource ID file...')
+        os.replace(f'{path}.tmp', path)
+    else:
+        os.remove(f'{path}.tmp')
+        os.remove(path)
+    return summary
+
+
+def start_workers(path, count):
+    # Local workers run main.py --worker in the current directory, so they read the same clients file and write
+    # to the same client directories
+    return [subprocess.Popen([sys.executable, MAIN_SCRIPT, '--worker', path]) for worker in range(count)]
+
+
+def process_clients(clients_dict, client_keys, resource_keys, resources_dict, dry_run, run_date_time, three_months,
+                    logger, farm_workers, resume=False, id_sources=None, verify=False, plan=None):
+    # Same run and return value as process_clients.process_clients, with every (client, account, region, resource
+    # type) unit queued in a durable work queue and run by farm_workers worker processes. A resumed run reuses the
+    # queue, so only unfinished units run again.
+    path = wq.queue_path(run_date_time)
+    queue = wq.WorkQueue(path)
+    queue.save_settings({'run_date_time': run_date_time, 'dry_run': dry_run, 'three_months': three_months,
+                         'verify': verify, 'plan': None if plan is None else plan['path'],
+                         'inventory_ttl': ivc.TTL, 'region_deadline': cb.DEADLINE})
+    if resume:
+        queue.retry_failed()
+
+    accounts_logged_in = 0
+    accounts_not_logged_in_list = []
+    clients_logged_in = 0
+    clients_not_logged_in_list = []
+
+    for key in client_keys:
+        client_name = clients_dict[key]['name']
+        login = clients_dict[key]['login']
+
+        msg = f'Queueing resource deletion for {client_name}.'
+        logger.info(f'\n{"+" * len(msg)}'
+                    f'\n{msg}'
+                    f'\n{"+" * len(msg)}')
+
+        if not resume:
+            if plan is not None:
+                dp.write_resource_ids(plan, key, client_name, resources_dict, run_date_time, logger)
+            elif id_sources is not None:
+                bi.write_resource_ids(client_name, resource_keys, resources_dict, run_date_time,
+                                      id_sources.get(key, {}), logger)
+            else:
+                reg.get_resource_ids(client_name, resource_keys, resources_dict, run_date_time, logger)
+        for resource_key in resource_keys:
+            copy_prefix = 'INPUT' if resource_key in ('1', '2') else 'Copy of'
+            idf.copy_file_once(resource_ids_path(client_name, resources_dict[resource_key], run_date_time),
+                               f'{client_directory(client_name, run_date_time)}/{copy_prefix} {client_name} '
+                               f'{resources_dict[resource_key]}.txt', logger)
+
+        # Logins are interactive, so they happen here; the workers reuse the cached credentials
+        logged_in_profiles, accounts_not_logged_in, clients_not_logged_in = pc.log_in_client(clients_dict[key],
+                                                                                             client_name, logger)
+        accounts_not_logged_in_list.extend(accounts_not_logged_in)
+        clients_not_logged_in_list.extend(clients_not_logged_in)
+        if login == 'sso':
+            clients_logged_in += len(logged_in_profiles)
+        else:
+            accounts_logged_in += len(logged_in_profiles)
+
+        # An applied plan only queues the units it deletes something in
+        queue.add_units([(key, profile['account_number'], region, resource_key)
+                         for profile in logged_in_profiles for region in profile['region']
+                         for resource_key in resource_keys
+                         if plan is None or dp.planned(plan, key, profile['account_number'], region, [resource_key])])
+
+    counts = queue.counts()
+    logger.info(f'\n{counts[wq.PENDING] + counts[wq.LEASED]} work units queued in {path}. Starting {farm_workers} '
+                f'workers; more can join from other machines with: python main.py --worker {path}')
+    for process in start_workers(path, farm_workers):
+        process.wait()
+
+    # Workers on other machines may still hold units after the local ones have exited
+    while queue.active_leases():
+        time.sleep(POLL_SECONDS)
+
+    for client_key, account_number, region, resource_key, error in queue.failures():
+        logger.info(f'Unit failed: {clients_dict[client_key]["name"]} {resources_dict[resource_key]} in '
+                    f'{account_number} {region}: {error}')
+
+    ips = images = snapshots = volumes = rds_snaps = 0
+    if not queue.finished():
+        logger.info(f'\nSome work units are unfinished. Resume the run with --resume {run_date_time} --farm N to run '
+                    f'them.')
+    for key in client_keys:
+        client_name = clients_dict[key]['name']
+        for resource_key in resource_keys:
+            for result in queue.results(key, resource_key):
+                ips_unit, images_unit, snapshots_unit, volumes_unit, rds_unit = result['counts']
+                ips += ips_unit
+                images += images_unit
+                snapshots += snapshots_unit
+                volumes += volumes_unit
+                rds_snaps += rds_unit
+
+            # Working files are only rewritten once, when every unit of the run is done or failed
+            if not queue.finished() or queue.merged(key, resource_key):
+                continue
+            summary = merge_results(queue, key, client_name, resource_key, resources_dict[resource_key],
+                                    run_date_time, logger)
+            queue.mark_merged(key, resource_key)
+            logger.info(f'\n{client_name} {resources_dict[resource_key]}: {summary[lg.DELETED]} deleted, '
+                        f'{summary[lg.ERROR]} errors, {summary[lg.NOT_FOUND]} not found, '
+                        f'{summary[lg.PENDING]} not located.')
+    queue.close()
+
+    logger.debug(f'Did not log into: {accounts_not_logged_in_list}')
+
+    if accounts_logged_in == 0 and clients_logged_in == 0:
+        logger.debug('\nNo successful logins recorded. No reports will be generated.')
+
+        # Return if no accounts were accessed
+        return 1, clients_not_logged_in_list, ips, images, snapshots, volumes, rds_snaps
+    else:
+        return accounts_not_logged_in_list, clients_not_logged_in_list, ips, images, snapshots, \
+            volumes, rds_snaps
@@ -0,0 +1,12 @@
+import logging
+import os
+import sys
+import pytest
+
+# The modules are imported as modules.<name>, as main.py does, whichever directory pytest is started from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger('tests')
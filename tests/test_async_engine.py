@@ -0,0 +1,44 @@
+import asyncio
+import botocore.exceptions
+import pytest
+import modules.async_engine as ae
+import modules.circuit_breaker as cb
+import modules.errors as er
+import modules.rate_limiter as rl
+
+
+class Client:
+    # Throttles the first calls, then deletes
+    def __init__(self, throttles):
+        self.throttles = throttles
+        self.calls = 0
+
+    async def delete_snapshot(self, **kwargs):
+        self.calls += 1
+        if self.calls <= self.throttles:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'RequestLimitExceeded'}}, 'DeleteSnapshot')
+        return {}
+
+
+def test_call_feeds_throttles_back_to_the_limiter(monkeypatch):
+    monkeypatch.setattr(rl, 'BACKOFF_BASE', 0)
+    limiter = rl.RateLimiter(rate=8.0, concurrency=4)
+    client = Client(throttles=2)
+    asyncio.run(ae.call(client, 'delete_snapshot', limiter, asyncio.Semaphore(1), SnapshotId='snap-0123abcd'))
+
+    assert client.calls == 3
+    assert limiter.throttles == 2
+    assert limiter.rate == 2.1
+    assert limiter.concurrency == 1
+    assert limiter._in_flight == 0
+
+
+def test_call_fails_at_once_when_the_circuit_is_open():
+    breaker = cb.CircuitBreaker(('111111111111', 'us-east-1', 'ec2'), threshold=1)
+    breaker.record(er.DENIED)
+    client = Client(throttles=0)
+    with pytest.raises(er.AWS_ERRORS) as error:
+        asyncio.run(ae.call(client, 'delete_snapshot', rl.RateLimiter(breaker=breaker), asyncio.Semaphore(1),
+                            SnapshotId='snap-0123abcd'))
+    assert er.classify(error.value) == er.CIRCUIT_OPEN
+    assert client.calls == 0
@@ -0,0 +1,57 @@
+import pytest
+
+pytest.importorskip('aws_sso_lib')
+import modules.aws_login as aws
+
+PROFILE = {'profile_name': 'missing-profile', 'region': ['us-east-1'], 'account_number': '111111111111',
+           'tenant_id': 'tenant', 'app_id_uri': 'https://signin.aws.amazon.com/saml'}
+
+
+class Login:
+    # Stands in for the aws-azure-login process, which never logs in here
+    started = 0
+
+    def __init__(self, *args, **kwargs):
+        Login.started += 1
+
+    def communicate(self):
+        return '', ''
+
+    def wait(self):
+        return 0
+
+
+@pytest.fixture(autouse=True)
+def empty_aws_config(tmp_path, monkeypatch):
+    (tmp_path / 'config').write_text('')
+    (tmp_path / 'credentials').write_text('')
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmp_path / 'config'))
+    monkeypatch.setenv('AWS_SHARED_CREDENTIALS_FILE', str(tmp_path / 'credentials'))
+    # aws_login sets AWS_PROFILE and the aws-azure-login variables, so each is set first for monkeypatch to undo
+    for name in ('AWS_PROFILE', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN', 'AZURE_TENANT_ID',
+                 'AZURE_APP_ID_URI', 'AZURE_DEFAULT_ROLE_ARN', 'AZURE_DEFAULT_DURATION_HOURS'):
+        monkeypatch.setenv(name, '')
+        monkeypatch.delenv(name)
+    monkeypatch.setattr(aws, '_verified_profiles', set())
+    Login.started = 0
+    monkeypatch.setattr(aws.subprocess, 'Popen', Login)
+
+
+def test_missing_profile_is_not_logged_in(logger):
+    assert not aws.verify_identity(logger, 'missing-profile', 'us-east-1')
+
+
+def test_missing_profile_fails_the_login(logger):
+    assert not aws.aws_login('aal', PROFILE, 'Client', logger)
+    assert Login.started == 1
+    assert aws._verified_profiles == set()
+
+
+def test_verified_profile_is_not_checked_again(logger, monkeypatch):
+    checks = []
+    monkeypatch.setattr(aws, 'verify_identity', lambda *args, **kwargs: checks.append(args) or True)
+
+    assert aws.aws_login('aal', PROFILE, 'Client', logger)
+    assert aws.aws_login('aal', PROFILE, 'Client', logger)
+    assert len(checks) == 1
+    assert Login.started == 0
@@ -0,0 +1,110 @@
+import json
+import os
+import pytest
+import modules.batch_input as bi
+
+CLIENTS = {'1': {'name': 'Client'}, '2': {'name': 'Other Client'}}
+RESOURCES = {'3': 'EC2 Old Snapshots', '4': 'Unattached Elastic IPs', '5': 'Unattached EBS Volumes'}
+
+
+def write_manifest(directory, manifest):
+    path = directory / 'batch.json'
+    path.write_text(json.dumps(manifest))
+    return str(path)
+
+
+def test_load_manifest(tmp_path):
+    path = write_manifest(tmp_path, {
+        'clients': ['Client', '2'],
+        'resources': ['3', 'unattached ebs volumes'],
+        'dry_run': False,
+        'sources': {'Client': 'exports/report.csv',
+                    'Other Client': {'EC2 Old Snapshots': 'snapshots.json', '5': '/data/volumes.xlsx'}}
+    })
+    client_keys, resource_keys, dry_run, sources = bi.load_manifest(path, CLIENTS, RESOURCES)
+    assert (client_keys, resource_keys, dry_run) == (['1', '2'], ['3', '5'], False)
+    # A shared source holds every selected resource type; paths are relative to the batch file
+    report = os.path.join(str(tmp_path), 'exports/report.csv')
+    assert sources == {'1': {'3': (report, True), '5': (report, True)},
+                       '2': {'3': (os.path.join(str(tmp_path), 'snapshots.json'), False),
+                             '5': ('/data/volumes.xlsx', False)}}
+
+
+@pytest.mark.parametrize('dry_run, expected', [(None, True), (True, True), ('false', True), (False, False)])
+def test_deleting_has_to_be_asked_for(tmp_path, dry_run, expected):
+    manifest = {'clients': ['1'], 'resources': ['3']}
+    if dry_run is not None:
+        manifest['dry_run'] = dry_run
+    assert bi.load_manifest(write_manifest(tmp_path, manifest), CLIENTS, RESOURCES)[2] is expected
+
+
+@pytest.mark.parametrize('manifest', [{'clients': ['1'], 'resources': []},
+                                      {'clients': ['Nobody'], 'resources': ['3']},
+                                      {'clients': ['1'], 'resources': ['3'], 'sources': {'1': {'Old AMIs': 'a.csv'}}}])
+def test_invalid_manifests_are_refused(tmp_path, manifest):
+    with pytest.raises(ValueError):
+        bi.load_manifest(write_manifest(tmp_path, manifest), CLIENTS, RESOURCES)
+
+
+def test_columns_are_found_by_heading(tmp_path, logger):
+    # Saved by Excel, with a byte order mark
+    path = tmp_path / 'report.csv'
+    path.write_text('\ufeffAccount,Snapshot_ID,Volume ID,Public IP\n'
+                    '111111111111, snap-00000001 ,vol-00000001,\n'
+                    '111111111111,,vol-00000002,10.0.0.1\n', encoding='utf-8')
+    assert list(bi.read_ids(str(path), '3', True, logger)) == ['snap-00000001']
+    assert list(bi.read_ids(str(path), '5', True, logger)) == ['vol-00000001', 'vol-00000002']
+    assert list(bi.read_ids(str(path), '4', True, logger)) == ['10.0.0.1']
+
+
+def test_dedicated_sources_fall_back_on_the_first_column(tmp_path, logger):
+    path = tmp_path / 'volumes.csv'
+    path.write_text('vol-00000001,in use\nvol-00000002\n')
+    assert list(bi.read_ids(str(path), '5', False, logger)) == ['vol-00000001', 'vol-00000002']
+    # A shared source without the resource type's column has none of its IDs
+    assert list(bi.read_ids(str(path), '5', True, logger)) == []
+
+
+@pytest.mark.parametrize('data', [
+    [{'Snapshot ID': 'snap-00000001', 'Region': 'us-east-1'}, {'Snapshot ID': 'snap-00000002'}],
+    {'data': [{'Snapshot ID': 'snap-00000001', 'Region': 'us-east-1'}, {'Snapshot ID': 'snap-00000002'}]},
+])
+def test_json_rows(tmp_path, logger, data):
+    path = tmp_path / 'snapshots.json'
+    path.write_text(json.dumps(data))
+    assert list(bi.read_rows(str(path))) == [['Snapshot ID', 'Region'], ['snap-00000001', 'us-east-1'],
+                                             ['snap-00000002', '']]
+    assert list(bi.read_ids(str(path), '3', True, logger)) == ['snap-00000001', 'snap-00000002']
+
+
+def test_json_list_of_ids(tmp_path, logger):
+    path = tmp_path / 'snapshots.json'
+    path.write_text(json.dumps(['snap-00000001', 'snap-00000002']))
+    assert list(bi.read_ids(str(path), '3', False, logger)) == ['snap-00000001', 'snap-00000002']
+
+
+def test_xlsx_rows(tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+    workbook = openpyxl.Workbook()
+    workbook.active.append(['Volume ID', 'Size'])
+    workbook.active.append(['vol-00000001', 8])
+    workbook.active.append(['vol-00000002', None])
+    workbook.save(tmp_path / 'volumes.xlsx')
+    assert list(bi.read_rows(str(tmp_path / 'volumes.xlsx'))) == [['Volume ID', 'Size'], ['vol-00000001', '8'],
+                                                                  ['vol-00000002', '']]
+
+
+def test_per_resource_sources_are_written_to_the_working_files(tmp_path, monkeypatch, logger):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'Client_20240101_000000').mkdir()
+    (tmp_path / 'snapshots.csv').write_text('Snapshot ID\nsnap-00000001\nvol-00000001\nsnap-00000001\n')
+    (tmp_path / 'volumes.json').write_text(json.dumps(['vol-00000002']))
+    path = write_manifest(tmp_path, {'clients': ['1'], 'resources': ['3', '5'],
+                                     'sources': {'1': {'3': 'snapshots.csv', '5': 'volumes.json'}}})
+    client_keys, resource_keys, dry_run, sources = bi.load_manifest(path, CLIENTS, RESOURCES)
+
+    assert bi.write_resource_ids('Client', resource_keys, RESOURCES, '20240101_000000', sources['1'], logger) == \
+        {'3': 1, '5': 2}
+    assert (tmp_path / 'Client_20240101_000000/Client EC2 Old Snapshots.txt').read_text() == 'snap-00000001\n'
+    assert (tmp_path / 'Client_20240101_000000/Client Unattached EBS Volumes.txt').read_text() == \
+        'vol-00000001\nvol-00000002\n'
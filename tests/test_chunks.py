@@ -0,0 +1,74 @@
+import botocore.exceptions
+import pytest
+import modules.chunks as chunks
+import modules.delete_ec2_snapshots as des
+import modules.delete_volumes as dv
+
+SNAPSHOT_IDS = [f'snap-{number:08x}' for number in range(450)]
+
+
+class Ec2:
+    # Describes the snapshots of each filter it is given, with every third one pending. Describes whose first ID is
+    # in fail raise, and IDs in gone are not found.
+    def __init__(self, fail=(), gone=()):
+        self.fail = fail
+        self.gone = gone
+        self.filters = []
+
+    def get_paginator(self, operation):
+        assert operation == 'describe_snapshots'
+        return self
+
+    def paginate(self, Filters, OwnerIds):
+        assert Filters[0]['Name'] == 'snapshot-id' and OwnerIds == ['self']
+        values = Filters[0]['Values']
+        self.filters.append(values)
+        if values[0] in self.fail:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InternalError'}}, 'DescribeSnapshots')
+        snapshots = [{'SnapshotId': snapshot_id, 'State': 'pending' if int(snapshot_id[5:], 16) % 3 == 0 else
+                      'completed'} for snapshot_id in values if snapshot_id not in self.gone]
+        # Two pages per filter
+        return [{'Snapshots': snapshots[:10]}, {'Snapshots': snapshots[10:]}]
+
+
+@pytest.mark.parametrize('count, sizes', [(0, []), (1, [1]), (200, [200]), (201, [200, 1]), (450, [200, 200, 50])])
+def test_chunk_ids(count, sizes):
+    ids = (f'vol-{number:08x}' for number in range(count))
+    result = list(chunks.chunk_ids(ids))
+    assert [len(chunk) for chunk in result] == sizes
+    assert [resource_id for chunk in result for resource_id in chunk] == [f'vol-{number:08x}' for number in
+                                                                         range(count)]
+
+
+def test_search_describes_a_filter_at_a_time(logger):
+    ec2 = Ec2()
+    snapshots, unsearched = chunks.search(ec2, des.DESCRIBE, SNAPSHOT_IDS, 'snapshots', logger)
+    assert [len(values) for values in ec2.filters] == [200, 200, 50]
+    assert [snapshot['SnapshotId'] for snapshot in snapshots] == SNAPSHOT_IDS
+    assert unsearched == set()
+
+
+def test_failed_describe_does_not_mark_its_ids_not_found(logger):
+    gone = {SNAPSHOT_IDS[1], SNAPSHOT_IDS[449]}
+    ec2 = Ec2(fail=(SNAPSHOT_IDS[200],), gone=gone)
+    found, missing, in_use = des.get_snapshots(ec2, SNAPSHOT_IDS, logger)
+
+    assert missing == gone
+    searched = set(SNAPSHOT_IDS[:200] + SNAPSHOT_IDS[400:]) - gone
+    assert found | in_use == searched
+    assert in_use == {snapshot_id for snapshot_id in searched if int(snapshot_id[5:], 16) % 3 == 0}
+    # The chunk that failed is neither found nor missing, so it is searched again in a later region or run
+    assert not set(SNAPSHOT_IDS[200:400]) & (found | missing | in_use)
+
+
+def test_search_failed_logs_the_chunk(logger, caplog):
+    error = botocore.exceptions.ClientError({'Error': {'Code': 'UnauthorizedOperation'}}, 'DescribeVolumes')
+    with caplog.at_level('INFO', logger=logger.name):
+        chunks.search_failed(['vol-00000001', 'vol-00000002'], 'volumes', error, logger)
+    assert 'Unable to search volumes vol-00000001 through vol-00000002: denied.' in caplog.text
+
+
+def test_sort_volumes_skips_unsearched_ids(logger):
+    volumes = [{'VolumeId': 'vol-00000001', 'State': 'available'}, {'VolumeId': 'vol-00000002', 'State': 'in-use'}]
+    assert dv.sort_volumes(volumes, ['vol-00000001', 'vol-00000002', 'vol-00000003', 'vol-00000004'],
+                           {'vol-00000004'}, logger) == ({'vol-00000001'}, {'vol-00000003'}, {'vol-00000002'})
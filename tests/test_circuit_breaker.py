@@ -0,0 +1,121 @@
+import pytest
+import modules.circuit_breaker as cb
+import modules.errors as er
+
+SCOPE = ('111111111111', 'us-east-1', 'ec2')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cb.time, 'monotonic', clock)
+    monkeypatch.setattr(cb, '_deadlines', {})
+    monkeypatch.setattr(cb, '_breakers', {})
+    return clock
+
+
+@pytest.fixture
+def breaker(clock):
+    return cb.CircuitBreaker(SCOPE, threshold=3, open_seconds=60)
+
+
+def trip(breaker, category=er.DENIED):
+    for failure in range(breaker.threshold):
+        assert breaker.allow() is None
+        breaker.record(category)
+
+
+def test_opens_after_threshold_failures_in_a_row(breaker):
+    for failure in range(breaker.threshold - 1):
+        breaker.record(er.TRANSIENT)
+    assert breaker.blocked() is None
+    breaker.record(er.DENIED)
+    assert breaker.blocked() == '3 denied calls in a row'
+    assert breaker.trips == 1
+
+
+def test_success_resets_the_failure_count(breaker):
+    for failure in range(breaker.threshold - 1):
+        breaker.record(er.DENIED)
+    breaker.record(None)
+    breaker.record(er.DENIED)
+    assert breaker.blocked() is None
+
+
+@pytest.mark.parametrize('category', [er.THROTTLED, er.NOT_FOUND, er.DEPENDENCY, er.OTHER])
+def test_failures_of_one_resource_do_not_count(breaker, category):
+    for failure in range(breaker.threshold * 2):
+        breaker.record(category)
+    assert breaker.blocked() is None
+    assert breaker.trips == 0
+
+
+def test_open_circuit_skips_calls(breaker):
+    trip(breaker)
+    assert breaker.allow() == breaker.reason
+    error = breaker.check('DeleteSnapshot')
+    assert er.error_code(error) == er.CIRCUIT_OPEN_ERROR_CODE
+    assert er.classify(error) == er.CIRCUIT_OPEN
+    assert breaker.skipped == 2
+
+
+def test_half_open_trial_success_closes(breaker, clock):
+    trip(breaker)
+    clock.now += 59
+    assert breaker.blocked() is not None
+    clock.now += 1
+    assert breaker.blocked() is None
+
+    # Only one call is let through while the trial is in flight
+    assert breaker.allow() is None
+    assert breaker.allow() is not None
+    assert breaker.check('DeleteSnapshot') is not None
+    breaker.record(None)
+
+    assert breaker.allow() is None
+    assert breaker.trips == 1
+
+
+def test_half_open_trial_failure_opens_again(breaker, clock):
+    trip(breaker)
+    clock.now += 60
+    assert breaker.allow() is None
+    breaker.record(er.TRANSIENT)
+
+    assert breaker.blocked() == '4 transient calls in a row'
+    assert breaker.trips == 1
+    clock.now += 59
+    assert breaker.allow() is not None
+    clock.now += 1
+    assert breaker.allow() is None
+
+
+def test_deadline_blocks_every_service_of_the_region(clock, monkeypatch):
+    monkeypatch.setattr(cb, 'DEADLINE', 30)
+    cb.start_deadline(*SCOPE[:2])
+    clock.now += 30
+    assert cb.skip_reason(*SCOPE) is None
+    clock.now += 1
+    assert cb.skip_reason(*SCOPE) == cb.DEADLINE_PASSED
+    assert cb.skip_reason(SCOPE[0], SCOPE[1], 'rds') == cb.DEADLINE_PASSED
+    assert cb.skip_reason(SCOPE[0], 'us-west-2', 'ec2') is None
+
+
+def test_no_deadline(clock, monkeypatch):
+    monkeypatch.setattr(cb, 'DEADLINE', 0)
+    cb.start_deadline(*SCOPE[:2])
+    clock.now += 10 ** 6
+    assert cb.skip_reason(*SCOPE) is None
+
+
+def test_breakers_are_shared_per_scope(clock):
+    assert cb.get_breaker(*SCOPE) is cb.get_breaker(*SCOPE)
+    assert cb.get_breaker(*SCOPE) is not cb.get_breaker(SCOPE[0], SCOPE[1], 'rds')
@@ -0,0 +1,97 @@
+import threading
+import botocore.exceptions
+import pytest
+import modules.delete_images as di
+import modules.rate_limiter as rl
+
+CLIENT = 'Client'
+RESOURCE = 'Old EC2 Image'
+RUN = '20240101_000000'
+ACCOUNT = '111111111111'
+
+# ami-1 and ami-2 share snap-shared; ami-new is too new to deregister and keeps snap-kept
+IMAGES = {
+    'ami-1': ['snap-1', 'snap-shared'],
+    'ami-2': ['snap-shared', 'snap-2'],
+    'ami-3': ['snap-3', 'snap-kept'],
+    'ami-new': ['snap-kept'],
+}
+
+
+def image(image_id):
+    return {'ImageId': image_id, 'CreationDate': '2024-06-01T00:00:00.000Z' if image_id == 'ami-new' else
+            '2020-01-01T00:00:00.000Z',
+            'BlockDeviceMappings': [{'Ebs': {'SnapshotId': snapshot_id}} for snapshot_id in IMAGES[image_id]]}
+
+
+class Ec2:
+    # Records every deregistration and deletion in the order they were made; deregistering the IDs in fail raises
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.events = []
+        self._lock = threading.Lock()
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Filters, Owners):
+        return [{'Images': [image(image_id) for image_id in Filters[0]['Values'] if image_id in IMAGES]}]
+
+    def deregister_image(self, ImageId, DryRun):
+        if ImageId in self.fail:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InvalidAMIID.Unavailable'}}, 'DeregisterImage')
+        with self._lock:
+            self.events.append(('deregister', ImageId))
+
+    def delete_snapshot(self, SnapshotId, DryRun):
+        with self._lock:
+            self.events.append(('delete', SnapshotId))
+
+
+@pytest.fixture
+def working_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    directory = tmp_path / f'{CLIENT}_{RUN}'
+    directory.mkdir()
+    path = directory / f'{CLIENT} {RESOURCE}.txt'
+    path.write_text(''.join(f'{image_id}\n' for image_id in IMAGES))
+    return path
+
+
+def delete_images(ec2, logger, limiter=None):
+    return di.delete_images(ec2, CLIENT, 'us-east-1', RESOURCE, False, RUN, '2024-03-01', logger, limiter=limiter,
+                            account_number=ACCOUNT)
+
+
+def test_shared_snapshots_are_released_by_the_last_image():
+    snapshot_refs = di.snapshot_references(IMAGES, list(IMAGES))
+    assert snapshot_refs == {'snap-1': 1, 'snap-shared': 2, 'snap-2': 1, 'snap-3': 1, 'snap-kept': 2}
+    assert di.release_snapshots(snapshot_refs, IMAGES['ami-1']) == ['snap-1']
+    assert di.release_snapshots(snapshot_refs, IMAGES['ami-2']) == ['snap-shared', 'snap-2']
+    assert di.release_snapshots(snapshot_refs, IMAGES['ami-3']) == ['snap-3']
+
+
+@pytest.mark.parametrize('limiter', [None, rl.RateLimiter(burst=100)])
+def test_shared_snapshot_is_deleted_after_the_second_image(working_file, logger, limiter):
+    ec2 = Ec2()
+    assert delete_images(ec2, logger, limiter) == (3, 4)
+
+    events = ec2.events
+    assert sorted(snapshot_id for event, snapshot_id in events if event == 'delete') == \
+        ['snap-1', 'snap-2', 'snap-3', 'snap-shared']
+    assert events.index(('delete', 'snap-shared')) > max(events.index(('deregister', 'ami-1')),
+                                                        events.index(('deregister', 'ami-2')))
+    # Each snapshot is deleted after its own image is deregistered
+    for image_id, snapshot_id in (('ami-1', 'snap-1'), ('ami-2', 'snap-2'), ('ami-3', 'snap-3')):
+        assert events.index(('delete', snapshot_id)) > events.index(('deregister', image_id))
+    assert working_file.read_text() == 'ami-new\n'
+
+
+def test_shared_snapshot_is_kept_when_an_image_fails(working_file, logger):
+    ec2 = Ec2(fail=('ami-2',))
+    assert delete_images(ec2, logger) == (2, 2)
+    assert ec2.events == [('deregister', 'ami-1'), ('delete', 'snap-1'), ('deregister', 'ami-3'),
+                          ('delete', 'snap-3')]
+    assert (working_file.parent / f'{CLIENT} {RESOURCE} errors.txt').read_text() == 'ami-2\n'
+    snaps = working_file.parent / f'{ACCOUNT} us-east-1 {CLIENT} {RESOURCE} snaps.txt'
+    assert snaps.read_text().split() == ['snap-1', 'snap-shared', 'snap-2', 'snap-3', 'snap-kept']
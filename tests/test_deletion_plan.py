@@ -0,0 +1,108 @@
+import json
+import pytest
+import modules.deletion_plan as dp
+import modules.delete_rds_snapshots as drs
+import modules.ip_catalog as ic
+import modules.permission_probe as pp
+import modules.rds_catalog as rc
+import modules.release_ips as ri
+
+CLIENTS = {'1': {'name': 'Client'}}
+RESOURCES = {'3': 'EC2 Old Snapshots', '4': 'Unattached Elastic IPs', '6': 'RDS Old Snapshots'}
+RUN = '20240101_000000'
+ACCOUNT = '111111111111'
+
+
+def write_report(resource_name, lines):
+    path = f'Client_{RUN}/Client {resource_name} dry run.txt'
+    with open(path, 'a') as file:
+        file.write(''.join('\t'.join(line) + '\n' for line in lines))
+
+
+@pytest.fixture
+def run_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / f'Client_{RUN}').mkdir()
+    monkeypatch.setattr(dp, '_plans', {})
+    monkeypatch.setattr(ic, '_catalogs', {})
+    monkeypatch.setattr(rc, '_catalogs', {})
+    return tmp_path
+
+
+def test_plan_round_trip(run_directory, logger):
+    write_report(RESOURCES['3'], [
+        ('snap-00000001', pp.WOULD_DELETE, '', ACCOUNT, 'us-east-1', pp.COMPLETED, ''),
+        ('snap-00000002', pp.WOULD_SKIP, pp.IN_USE, ACCOUNT, 'us-east-1', '', ''),
+        ('snap-00000003', pp.WOULD_FAIL, 'UnauthorizedOperation', ACCOUNT, 'us-west-2', '', ''),
+        # Reported again by a resumed dry run
+        ('snap-00000001', pp.WOULD_DELETE, '', ACCOUNT, 'us-east-1', pp.COMPLETED, 'ami-00000001'),
+    ])
+    write_report(RESOURCES['6'], [('my-snapshot', pp.WOULD_DELETE, 'permission not checked: RDS has no DryRun',
+                                   ACCOUNT, 'us-west-2', rc.CLUSTER, '')])
+
+    path = dp.write_plan(CLIENTS, ['1'], ['3', '4', '6'], RESOURCES, RUN, logger)
+    assert path == f'plans/plan_{RUN}.json'
+    plan = dp.load_plan(path, CLIENTS, RESOURCES)
+    assert plan['rows'] == [['1', ACCOUNT, 'us-east-1', '3', 'snap-00000001', pp.COMPLETED, ['ami-00000001']],
+                            ['1', ACCOUNT, 'us-west-2', '6', 'my-snapshot', rc.CLUSTER, []]]
+    assert dp.planned(plan, '1', ACCOUNT, 'us-east-1') == {'3': {'snap-00000001': (pp.COMPLETED, ['ami-00000001'])}}
+    assert dp.planned(plan, '1', ACCOUNT, 'us-west-2', ['3']) == {}
+    assert dp.cached_plan(path, CLIENTS, RESOURCES) is dp.cached_plan(path, CLIENTS, RESOURCES)
+
+
+def test_nothing_to_delete_writes_no_plan(run_directory, logger):
+    write_report(RESOURCES['3'], [('snap-00000002', pp.WOULD_SKIP, pp.IN_USE, ACCOUNT, 'us-east-1', '', '')])
+    assert dp.write_plan(CLIENTS, ['1'], ['3'], RESOURCES, RUN, logger) is None
+    assert not (run_directory / 'plans').exists()
+
+
+@pytest.mark.parametrize('change', [{'version': 2}, {'clients': ['2']}, {'resources': ['7']}])
+def test_foreign_plans_are_refused(run_directory, change):
+    plan = {'version': dp.PLAN_VERSION, 'run': RUN, 'clients': ['1'], 'resources': ['3'],
+            'columns': list(dp.COLUMNS), 'rows': []}
+    plan.update(change)
+    (run_directory / 'plan.json').write_text(json.dumps(plan))
+    with pytest.raises(ValueError):
+        dp.load_plan('plan.json', CLIENTS, RESOURCES)
+
+
+class Paginator:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, Filters):
+        return self.pages
+
+
+class Session:
+    # A region in which, since the dry run, one planned IP was released and another associated, and one planned
+    # RDS snapshot was deleted
+    def client(self, service):
+        return self
+
+    def describe_addresses(self, Filters):
+        assert Filters == [{'Name': 'public-ip', 'Values': ['10.0.0.1', '10.0.0.2', '10.0.0.3']}]
+        return {'Addresses': [{'PublicIp': '10.0.0.1', 'AllocationId': 'eipalloc-1', 'Domain': 'vpc'},
+                              {'PublicIp': '10.0.0.2', 'AllocationId': 'eipalloc-2', 'AssociationId': 'eipassoc-2',
+                               'Domain': 'vpc'}]}
+
+    def get_paginator(self, operation):
+        if operation == 'describe_db_snapshots':
+            return Paginator([{'DBSnapshots': [{'DBSnapshotIdentifier': 'db-1'}]}])
+        return Paginator([{'DBClusterSnapshots': []}])
+
+
+def test_check_region_skips_what_changed_since_the_dry_run(run_directory, logger):
+    planned_ids = {'3': {'snap-00000001': (pp.COMPLETED, [])},
+                   '4': {ip: (pp.UNASSOCIATED, []) for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3')},
+                   '6': {'db-1': (rc.INSTANCE, []), 'cluster-1': (rc.CLUSTER, [])}}
+    inventory = dp.check_region(Session(), planned_ids, 'us-east-1', logger, ACCOUNT)
+    assert inventory == {'snapshots': {'snap-00000001'}, 'addresses': set(planned_ids['4']),
+                         'rds_snapshots': {'db-1', 'cluster-1'}}
+
+    found, missing, associated = ri.get_ips(list(planned_ids['4']), ic.cached_catalog(ACCOUNT, 'us-east-1'), logger)
+    assert found == {'10.0.0.1': {'AllocationId': 'eipalloc-1'}}
+    assert missing == {'10.0.0.3'}
+    assert associated == {'10.0.0.2'}
+    assert drs.get_snapshots(['db-1', 'cluster-1'], rc.cached_catalog(ACCOUNT, 'us-east-1'), logger) == \
+        (['db-1'], [], ['cluster-1'])
@@ -0,0 +1,85 @@
+import pytest
+import modules.id_router as rt
+
+RESOURCES = {'1': 'Old EC2 Image', '3': 'EC2 Old Snapshots', '4': 'Unattached Elastic IPs',
+             '5': 'Unattached EBS Volumes', '6': 'RDS Old Snapshots'}
+
+
+@pytest.mark.parametrize('line, expected', [
+    ('ami-0123abcd', ('image', 'ami-0123abcd')),
+    ('snap-0123456789abcdef0', ('snapshot', 'snap-0123456789abcdef0')),
+    ('  "VOL-0123ABCD"\t\r', ('volume', 'vol-0123abcd')),
+    ('10.0.255.1', ('ip', '10.0.255.1')),
+    ('My-Snapshot-1', ('rds', 'my-snapshot-1')),
+    ('arn:aws:rds:us-east-1:123456789012:snapshot:my-snapshot', ('rds', 'my-snapshot')),
+    ('arn:aws-us-gov:rds:us-gov-west-1:123456789012:cluster-snapshot:aurora-1', ('rds', 'aurora-1')),
+    ('rds:mydb-2024-01-01-00-00', ('automated', 'rds:mydb-2024-01-01-00-00')),
+    ('arn:aws:rds:us-east-1:123456789012:snapshot:rds:mydb-2024-01-01-00-00',
+     ('automated', 'arn:aws:rds:us-east-1:123456789012:snapshot:rds:mydb-2024-01-01-00-00')),
+    ('ami-0123', (None, 'ami-0123')),
+    ('256.0.0.1', (None, '256.0.0.1')),
+    ('snapshot--1', (None, 'snapshot--1')),
+    ('1snapshot', (None, '1snapshot')),
+    ('a' * 256, (None, 'a' * 256)),
+])
+def test_classify(line, expected):
+    assert list(rt.classify(line)) == [expected]
+
+
+def test_classify_skips_blank_lines():
+    assert list(rt.classify('ami-0123abcd\n\n  \n"snap-0123abcd"\n')) == [('image', 'ami-0123abcd'),
+                                                                         ('snapshot', 'snap-0123abcd')]
+
+
+def test_ids_are_moved_to_the_box_of_their_type():
+    router = rt.IdRouter(['1', '3', '4'])
+    assert list(router.route('1', 'ami-0123abcd\nsnap-0123abcd\n10.0.0.1')) == \
+        [('1', 'ami-0123abcd'), ('3', 'snap-0123abcd'), ('4', '10.0.0.1')]
+    assert router.counts['1'][rt.ACCEPTED] == 1
+    assert router.counts['1'][rt.MOVED] == 2
+
+
+def test_duplicates_are_skipped_across_boxes():
+    router = rt.IdRouter(['1', '3'])
+    assert list(router.route('1', 'snap-0123abcd\nami-0123abcd\nAMI-0123ABCD')) == \
+        [('3', 'snap-0123abcd'), ('1', 'ami-0123abcd')]
+    assert list(router.route('3', 'snap-0123abcd\nsnap-0123abcd')) == []
+    assert router.counts['1'][rt.DUPLICATE] == 1
+    assert router.counts['3'][rt.DUPLICATE] == 2
+
+
+def test_rds_names_are_only_accepted_for_rds():
+    router = rt.IdRouter(['3', '6'])
+    assert list(router.route('3', 'my-snapshot')) == []
+    assert list(router.route('6', 'my-snapshot\nsnap-0123abcd')) == [('6', 'my-snapshot'), ('3', 'snap-0123abcd')]
+    assert router.rejected == [('3', 'my-snapshot', rt.INVALID)]
+
+
+def test_ids_of_unselected_types_are_rejected():
+    router = rt.IdRouter(['3'])
+    assert list(router.route('3', 'vol-0123abcd')) == []
+    assert router.counts['3'][rt.NOT_SELECTED] == 1
+    assert router.rejected == [('3', 'vol-0123abcd', 'volume not selected')]
+
+
+def test_automated_snapshots_are_rejected_as_such():
+    router = rt.IdRouter(['6'])
+    assert list(router.route('6', 'rds:mydb-2024-01-01-00-00\nbad_name\nmanual-1')) == [('6', 'manual-1')]
+    assert router.counts['6'][rt.AUTOMATED] == 1
+    assert router.counts['6'][rt.INVALID] == 1
+    assert router.rejected == [('6', 'rds:mydb-2024-01-01-00-00', rt.AUTOMATED), ('6', 'bad_name', rt.INVALID)]
+
+
+def test_write_ids_and_rejected(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_directory = tmp_path / 'Client_20240101_000000'
+    run_directory.mkdir()
+    router = rt.IdRouter(['1', '3'])
+    routed_ids = (routed for key, text in (('1', 'ami-0123abcd\nsnap-0123abcd\nbad'), ('3', 'snap-0123abcd'))
+                  for routed in router.route(key, text))
+    assert rt.write_ids(routed_ids, 'Client', RESOURCES, '20240101_000000') == {'1': 1, '3': 1}
+    assert (run_directory / 'Client Old EC2 Image.txt').read_text() == 'ami-0123abcd\n'
+    assert (run_directory / 'Client EC2 Old Snapshots.txt').read_text() == 'snap-0123abcd\n'
+
+    router.write_rejected(run_directory / 'Client rejected IDs.txt', RESOURCES)
+    assert (run_directory / 'Client rejected IDs.txt').read_text() == 'bad\tOld EC2 Image\tinvalid\n'
@@ -0,0 +1,107 @@
+import os
+import pytest
+import modules.inventory as inv
+import modules.inventory_cache as ivc
+import modules.ip_catalog as ic
+import modules.rds_catalog as rc
+
+SCOPE = ('111111111111', 'us-east-1')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clock = Clock()
+    monkeypatch.setattr(ivc.time, 'time', clock)
+    monkeypatch.setattr(ivc, 'TTL', 3600)
+    monkeypatch.setattr(ic, '_catalogs', {})
+    monkeypatch.setattr(rc, '_catalogs', {})
+    return clock
+
+
+class Session:
+    def client(self, service):
+        return None
+
+
+@pytest.fixture
+def listings(monkeypatch):
+    # The inventory types listed from the region, in order
+    listings = []
+
+    def lister(inventory_type, inventory):
+        def list_inventory(ec2, rds):
+            listings.append(inventory_type)
+            return inventory
+        return list_inventory
+
+    monkeypatch.setattr(inv, 'INVENTORY_LISTERS', {
+        'snapshots': lister('snapshots', {'snap-00000001', 'snap-00000002'}),
+        'addresses': lister('addresses', ic.catalog_addresses([{'PublicIp': '10.0.0.1', 'AllocationId': 'a-1'}])),
+        'rds_snapshots': lister('rds_snapshots', {'db-1': rc.INSTANCE, 'cluster-1': rc.CLUSTER})
+    })
+    return listings
+
+
+def test_inventories_expire_after_the_ttl(clock):
+    ivc.store_inventory(*SCOPE, 'snapshots', {'snap-00000002', 'snap-00000001'})
+    clock.now += 3600
+    assert ivc.cached_inventory(*SCOPE, 'snapshots') == ({'snap-00000001', 'snap-00000002'}, 3600)
+    assert ivc.cached_inventory(SCOPE[0], 'us-west-2', 'snapshots') is None
+    clock.now += 1
+    assert ivc.cached_inventory(*SCOPE, 'snapshots') is None
+
+
+def test_region_inventory_is_listed_once_within_the_ttl(clock, listings, logger):
+    keys = ['3', '4', '6']
+    first = inv.get_region_inventory(Session(), keys, SCOPE[1], logger, SCOPE[0])
+    clock.now += 60
+    second = inv.get_region_inventory(Session(), keys, SCOPE[1], logger, SCOPE[0])
+    assert sorted(listings) == ['addresses', 'rds_snapshots', 'snapshots']
+    assert second == {'snapshots': first['snapshots'], 'addresses': {'10.0.0.1'},
+                      'rds_snapshots': first['rds_snapshots']}
+    # The cached RDS catalog is reused for the run; the IP catalog is only the one listed in this run
+    assert rc.cached_catalog(*SCOPE) == first['rds_snapshots']
+
+    clock.now += 3600
+    inv.get_region_inventory(Session(), keys, SCOPE[1], logger, SCOPE[0])
+    assert len(listings) == 6
+
+
+def test_ttl_zero_turns_the_cache_off(clock, listings, logger, monkeypatch):
+    monkeypatch.setattr(ivc, 'TTL', 0)
+    inv.get_region_inventory(Session(), ['3'], SCOPE[1], logger, SCOPE[0])
+    inv.get_region_inventory(Session(), ['3'], SCOPE[1], logger, SCOPE[0])
+    assert listings == ['snapshots', 'snapshots']
+    assert not os.path.exists(ivc.CACHE_PATH)
+
+
+def test_forget_deleted(clock):
+    ivc.store_inventory(*SCOPE, 'snapshots', {'snap-00000001', 'snap-00000002'})
+    ivc.store_inventory(*SCOPE, 'volumes', {'vol-00000001', 'vol-00000002'})
+    ivc.store_inventory(*SCOPE, 'rds_snapshots', {'db-1': rc.INSTANCE, 'cluster-1': rc.CLUSTER})
+    clock.now += 60
+
+    inv.forget_deleted(*SCOPE, {'5': ['vol-00000001'], '6': ['cluster-1'], '3': []})
+    # Forgetting keeps each entry's fetch time
+    assert ivc.cached_inventory(*SCOPE, 'volumes') == ({'vol-00000002'}, 60)
+    assert ivc.cached_inventory(*SCOPE, 'rds_snapshots') == ({'db-1': rc.INSTANCE}, 60)
+    assert ivc.cached_inventory(*SCOPE, 'snapshots') == ({'snap-00000001', 'snap-00000002'}, 60)
+
+    # The snapshots of deleted images are not known by ID, so the snapshot inventory is listed again
+    inv.forget_deleted(*SCOPE, {'1': ['ami-00000001']}, image_snapshots_deleted=2)
+    assert ivc.cached_inventory(*SCOPE, 'snapshots') is None
+    assert ivc.cached_inventory(*SCOPE, 'volumes') is not None
+
+
+def test_forget_without_a_cache_creates_none(clock):
+    inv.forget_deleted(*SCOPE, {'5': ['vol-00000001']}, image_snapshots_deleted=1)
+    assert not os.path.exists(ivc.CACHE_DIRECTORY)
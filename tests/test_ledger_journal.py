@@ -0,0 +1,121 @@
+import os
+import pytest
+import modules.journal as jn
+import modules.ledger as lg
+
+CLIENT = 'Client'
+RESOURCE = 'EC2 Old Snapshots'
+RUN = '20240101_000000'
+SCOPE = ('111111111111', 'us-east-1')
+IDS = [f'snap-{number:08x}' for number in range(10)]
+
+
+@pytest.fixture
+def working_file(tmp_path, monkeypatch):
+    # Ledgers keep their files in the client's run directory under the current directory
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(f'{CLIENT}_{RUN}')
+    path = f'{CLIENT}_{RUN}/{CLIENT} {RESOURCE}.txt'
+    with open(path, 'w') as file:
+        file.write('\n'.join(IDS) + '\n')
+    return path
+
+
+def open_ledger(logger, window_size=None):
+    journal = jn.Journal(RUN)
+    return lg.IdLedger(CLIENT, RESOURCE, RUN, logger, journal=journal, window_size=window_size), journal
+
+
+def read_lines(path):
+    with open(path) as file:
+        return file.read().splitlines()
+
+
+def test_resume_replays_id_outcomes_and_finished_scopes(working_file, logger):
+    ledger, journal = open_ledger(logger)
+    scope = ledger.for_scope(*SCOPE)
+    scope.mark_deleted(IDS[:2])
+    scope.mark_errors(IDS[2:3])
+    scope.mark_not_found(IDS[3:5])
+    scope.flush()
+    ledger.mark_deleted(IDS[5:6], scope=('111111111111', 'us-west-2'))
+    # Interrupted before us-west-2 was flushed
+    journal.close()
+
+    ledger, journal = open_ledger(logger)
+    assert ledger.scope_done(SCOPE)
+    assert not ledger.scope_done(('111111111111', 'us-west-2'))
+    # The flush of us-east-1 already removed its deleted IDs from the working file
+    assert [ledger.state(resource_id) for resource_id in IDS[:6]] == \
+        [None, None, lg.ERROR, lg.NOT_FOUND, lg.NOT_FOUND, lg.DELETED]
+    assert ledger.pending() == IDS[3:5] + IDS[6:]
+
+    assert ledger.flush() == 7
+    assert read_lines(working_file) == IDS[2:5] + IDS[6:]
+    journal.close()
+
+
+def test_torn_last_record_is_skipped(working_file, logger):
+    ledger, journal = open_ledger(logger)
+    ledger.mark_deleted(IDS[:1], scope=SCOPE)
+    journal.close()
+    with open(journal.path, 'a') as file:
+        file.write('{"event": "id", "client": "Cli')
+
+    ledger, journal = open_ledger(logger)
+    assert ledger.state(IDS[0]) == lg.DELETED
+    assert ledger.pending() == IDS[1:]
+    journal.close()
+
+
+def test_windowed_resume_continues_after_the_last_checkpoint(working_file, logger):
+    ledger, journal = open_ledger(logger, window_size=4)
+    assert ledger.load_window()
+    ledger.mark_deleted(IDS[:2], scope=SCOPE)
+    ledger.commit_window()
+    assert ledger.load_window()
+    ledger.mark_deleted(IDS[4:5], scope=SCOPE)
+    ledger.finish_scope(SCOPE)
+    # A side file write that was cut short when the run stopped
+    with open(ledger.remaining_ids_path, 'a') as file:
+        file.write('snap-0000')
+    journal.close()
+
+    ledger, journal = open_ledger(logger, window_size=4)
+    # The first window is not loaded again; the second resumes with its journaled outcomes
+    assert ledger.load_window()
+    assert ledger.state(IDS[0]) is None
+    assert ledger.state(IDS[4]) == lg.DELETED
+    assert ledger.scope_done(SCOPE)
+    assert ledger.pending() == IDS[5:8]
+    assert read_lines(ledger.remaining_ids_path) == IDS[2:4]
+
+    ledger.commit_window()
+    assert ledger.load_window()
+    assert ledger.pending() == IDS[8:]
+    assert not ledger.scope_done(SCOPE)
+    ledger.mark_deleted(IDS[9:], scope=SCOPE)
+    ledger.commit_window()
+    assert not ledger.load_window()
+
+    assert ledger.summary() == {lg.PENDING: 6, lg.NOT_FOUND: 0, lg.DELETED: 4, lg.ERROR: 0}
+    ledger.finish()
+    assert read_lines(working_file) == IDS[2:4] + IDS[5:9]
+    assert not os.path.exists(ledger.remaining_ids_path)
+    journal.close()
+
+
+def test_finished_ledger_is_not_resumed_from_its_checkpoint(working_file, logger):
+    ledger, journal = open_ledger(logger, window_size=4)
+    while ledger.load_window():
+        ledger.mark_deleted(IDS[:1], scope=SCOPE)
+        ledger.commit_window()
+    ledger.finish()
+    journal.close()
+    assert read_lines(working_file) == IDS[1:]
+
+    # The rewritten working file is read from its start
+    ledger, journal = open_ledger(logger, window_size=4)
+    assert ledger.load_window()
+    assert ledger.pending() == IDS[1:5]
+    journal.close()
@@ -0,0 +1,94 @@
+import json
+import botocore.session
+import botocore.stub
+import pytest
+import modules.metrics as mt
+
+ACCOUNT = '111111111111'
+
+
+@pytest.fixture(autouse=True)
+def stats(monkeypatch):
+    monkeypatch.setattr(mt, '_stats', {})
+    monkeypatch.setattr(mt, '_resource_ids', {})
+
+
+@pytest.fixture
+def ec2():
+    client = botocore.session.get_session().create_client('ec2', region_name='us-east-1', aws_access_key_id='id',
+                                                          aws_secret_access_key='secret')
+    mt.instrument(client, ACCOUNT)
+    with botocore.stub.Stubber(client) as stubber:
+        yield client, stubber
+
+
+def test_calls_are_counted_by_resource_type(ec2):
+    client, stubber = ec2
+    stubber.add_response('delete_snapshot', {}, {'SnapshotId': 'snap-00000001'})
+    stubber.add_client_error('delete_snapshot', 'InvalidSnapshot.InUse')
+    stubber.add_response('delete_volume', {}, {'VolumeId': 'vol-00000001'})
+    with mt.resource_label('EC2 Old Snapshots'):
+        client.delete_snapshot(SnapshotId='snap-00000001')
+        with pytest.raises(botocore.exceptions.ClientError):
+            client.delete_snapshot(SnapshotId='snap-00000002')
+    client.delete_volume(VolumeId='vol-00000001')
+
+    calls = {(call['operation'], call['resource']): call for call in mt.summary()['calls']}
+    assert set(calls) == {('DeleteSnapshot', 'EC2 Old Snapshots'), ('DeleteVolume', mt.OTHER)}
+    snapshots = calls[('DeleteSnapshot', 'EC2 Old Snapshots')]
+    assert (snapshots['service'], snapshots['account'], snapshots['region']) == ('ec2', ACCOUNT, 'us-east-1')
+    assert (snapshots['calls'], snapshots['errors']) == (2, {'InvalidSnapshot.InUse': 1})
+    assert sum(snapshots['latency_buckets'].values()) == 2
+
+
+def test_check_budget():
+    mt._stats.update({('ec2', 'DeleteSnapshot', ACCOUNT, 'us-east-1', 'EC2 Old Snapshots'): {'calls': 25},
+                      ('ec2', 'DescribeSnapshots', ACCOUNT, 'us-east-1', 'EC2 Old Snapshots'): {'calls': 6},
+                      ('ec2', 'DeleteVolume', ACCOUNT, 'us-east-1', 'Unattached EBS Volumes'): {'calls': 20},
+                      ('rds', 'DeleteDBSnapshot', ACCOUNT, 'us-east-1', 'RDS Old Snapshots'): {'calls': 3},
+                      ('sts', 'GetCallerIdentity', ACCOUNT, 'us-east-1', mt.OTHER): {'calls': 100}})
+    mt.record_resource_ids('EC2 Old Snapshots', 10)
+    mt.record_resource_ids('Unattached EBS Volumes', 5)
+    mt.record_resource_ids('Unattached EBS Volumes', 5)
+    # A resource type that found no IDs still gets a budget of one ID
+    mt.record_resource_ids('RDS Old Snapshots', 0)
+
+    assert mt.resource_calls() == {'EC2 Old Snapshots': (31, 10), 'Unattached EBS Volumes': (20, 10),
+                                   'RDS Old Snapshots': (3, 0)}
+    assert mt.check_budget(3) == [('EC2 Old Snapshots', 31, 10)]
+    assert mt.check_budget(2) == [('EC2 Old Snapshots', 31, 10), ('RDS Old Snapshots', 3, 0)]
+    assert mt.check_budget(4) == []
+
+
+def test_write_reports(ec2, tmp_path):
+    client, stubber = ec2
+    stubber.add_response('delete_snapshot', {})
+    stubber.add_client_error('delete_snapshot', 'Invalid"Code')
+    with mt.resource_label('EC2 Old Snapshots'):
+        client.delete_snapshot(SnapshotId='snap-00000001')
+        with pytest.raises(botocore.exceptions.ClientError):
+            client.delete_snapshot(SnapshotId='snap-00000002')
+    mt.record_resource_ids('EC2 Old Snapshots', 2)
+
+    json_path, prometheus_path = mt.write_reports('20240101_000000', str(tmp_path / 'metrics'))
+    assert json_path == str(tmp_path / 'metrics' / 'run_20240101_000000.json')
+    with open(json_path) as file:
+        summary = json.load(file)
+    assert summary['resources'] == {'EC2 Old Snapshots': {'calls': 2, 'ids': 2, 'calls_per_id': 1.0}}
+    assert sorted(path.name for path in (tmp_path / 'metrics').iterdir()) == ['run_20240101_000000.json',
+                                                                              'run_20240101_000000.prom']
+
+    with open(prometheus_path) as file:
+        lines = file.read().splitlines()
+    labels = f'service="ec2",operation="DeleteSnapshot",account="{ACCOUNT}",region="us-east-1",' \
+             f'resource="EC2 Old Snapshots"'
+    assert '# TYPE wchclean_api_calls_total counter' in lines
+    assert f'wchclean_api_calls_total{{{labels}}} 2' in lines
+    assert f'wchclean_api_errors_total{{{labels},code="Invalid\\"Code"}} 1' in lines
+    assert '# TYPE wchclean_api_latency_seconds histogram' in lines
+    assert f'wchclean_api_latency_seconds_bucket{{{labels},le="+Inf"}} 2' in lines
+    assert f'wchclean_api_latency_seconds_count{{{labels}}} 2' in lines
+    assert 'wchclean_resource_ids_total{resource="EC2 Old Snapshots"} 2' in lines
+    # Buckets are cumulative
+    buckets = [int(line.rsplit(' ', 1)[1]) for line in lines if line.startswith('wchclean_api_latency_seconds_bucket')]
+    assert buckets == sorted(buckets) and len(buckets) == len(mt.LATENCY_BUCKETS) + 1
@@ -0,0 +1,58 @@
+import botocore.exceptions
+import pytest
+import modules.permission_probe as pp
+
+SCOPE = ('111111111111', 'us-east-1')
+IDS = [f'vol-{number:08x}' for number in range(5)]
+
+
+@pytest.fixture(autouse=True)
+def probes(monkeypatch):
+    monkeypatch.setattr(pp, '_probes', {})
+
+
+def client_error(code):
+    return botocore.exceptions.ClientError({'Error': {'Code': code}}, 'DeleteVolume')
+
+
+def dry_run_call(errors):
+    # A DryRun call that fails with the next of errors for each resource it is made for
+    probed = []
+
+    def call(resource_id):
+        probed.append(resource_id)
+        raise client_error(errors[len(probed) - 1])
+
+    return call, probed
+
+
+def test_probe_falls_through_failures_of_the_resource(logger):
+    call, probed = dry_run_call(['VolumeInUse', 'IncorrectState', 'DryRunOperation'])
+    assert pp.probe(*SCOPE, 'delete_volume', call, IDS, logger) == \
+        ((pp.ALLOWED, 'DryRunOperation'), {IDS[0]: 'VolumeInUse', IDS[1]: 'IncorrectState'})
+    assert probed == IDS[:3]
+
+    # The verdict is kept for the region and action
+    assert pp.probe(*SCOPE, 'delete_volume', call, IDS, logger) == ((pp.ALLOWED, 'DryRunOperation'), {})
+    assert probed == IDS[:3]
+
+
+def test_probe_gives_up_after_max_probes(logger):
+    call, probed = dry_run_call(['VolumeInUse'] * len(IDS))
+    verdict, failures = pp.probe(*SCOPE, 'delete_volume', call, IDS, logger)
+    assert verdict == pp.NO_VERDICT
+    assert list(failures) == IDS[:pp.MAX_PROBES]
+    assert probed == IDS[:pp.MAX_PROBES]
+    assert pp.cached_probe(*SCOPE, 'delete_volume') is None
+
+    outcomes = pp.plan(IDS, verdict, failures)
+    assert outcomes[IDS[0]] == (pp.WOULD_FAIL, 'VolumeInUse')
+    assert outcomes[IDS[-1]] == (pp.WOULD_DELETE, 'permission not checked: no resource could be probed')
+
+
+def test_denied_probe_fails_every_resource(logger):
+    call, probed = dry_run_call(['UnauthorizedOperation'])
+    verdict, failures = pp.probe(*SCOPE, 'delete_volume', call, IDS, logger)
+    assert verdict == (pp.DENIED, 'UnauthorizedOperation')
+    assert probed == IDS[:1]
+    assert set(pp.plan(IDS, verdict, failures).values()) == {(pp.WOULD_FAIL, 'UnauthorizedOperation')}
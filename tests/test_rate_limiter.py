@@ -0,0 +1,120 @@
+import contextvars
+import threading
+import botocore.exceptions
+import pytest
+import modules.rate_limiter as rl
+
+label = contextvars.ContextVar('label', default=None)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rl.time, 'monotonic', clock)
+    # Backoff sleeps are recorded instead of slept
+    clock.sleeps = []
+    monkeypatch.setattr(rl.time, 'sleep', clock.sleeps.append)
+    return clock
+
+
+def throttling(throttles):
+    # A delete that is throttled the first throttles times it is called
+    calls = []
+
+    def delete_snapshot(**kwargs):
+        calls.append(kwargs)
+        if len(calls) <= throttles:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'RequestLimitExceeded'}}, 'DeleteSnapshot')
+        return {}
+
+    return delete_snapshot, calls
+
+
+def test_throttle_halves_the_rate_and_in_flight_limit(clock):
+    limiter = rl.RateLimiter(rate=8.0, concurrency=4)
+    limiter.acquire()
+    limiter.release(True)
+    assert (limiter.rate, limiter.concurrency, limiter.throttles) == (4.0, 2, 1)
+
+    for throttle in range(10):
+        clock.now += 10
+        limiter.acquire()
+        limiter.release(True)
+    assert (limiter.rate, limiter.concurrency) == (limiter.min_rate, 1)
+
+
+def test_successes_raise_the_rate_up_to_max_rate(clock):
+    limiter = rl.RateLimiter(rate=1.0, max_rate=2.0, burst=1, concurrency=1, max_concurrency=2)
+    for success in range(40):
+        limiter.acquire()
+        limiter.release(False)
+        # One token's time, so acquire never has to wait on the fake clock
+        clock.now += 1
+    assert limiter.rate == 2.0
+    # Ten successes per slot add a slot, up to max_concurrency
+    assert limiter.concurrency == 2
+
+
+def test_tokens_refill_at_the_rate(clock):
+    limiter = rl.RateLimiter(rate=4.0, burst=2, concurrency=4)
+    limiter.acquire()
+    limiter.acquire()
+    assert limiter._tokens == 0
+    clock.now += 0.5
+    limiter._refill()
+    assert limiter._tokens == 2.0
+    clock.now += 10
+    limiter._refill()
+    assert limiter._tokens == limiter.burst
+
+
+def test_call_retries_throttled_calls(clock):
+    limiter = rl.RateLimiter(rate=8.0, concurrency=4)
+    delete_snapshot, calls = throttling(2)
+    assert rl.call(limiter, delete_snapshot, SnapshotId='snap-0123abcd') == {}
+    assert len(calls) == 3
+    assert limiter.throttles == 2
+    assert limiter.rate == 2.1
+    assert limiter._in_flight == 0
+    # Full-jitter backoff, below the exponential bound of each attempt
+    assert len(clock.sleeps) == 2
+    assert all(0 <= sleep <= rl.BACKOFF_BASE * 2 ** attempt for attempt, sleep in enumerate(clock.sleeps))
+
+
+def test_call_gives_up_after_max_attempts(clock):
+    limiter = rl.RateLimiter()
+    delete_snapshot, calls = throttling(rl.MAX_ATTEMPTS)
+    with pytest.raises(botocore.exceptions.ClientError):
+        rl.call(limiter, delete_snapshot, SnapshotId='snap-0123abcd')
+    assert len(calls) == rl.MAX_ATTEMPTS
+    assert len(clock.sleeps) == rl.MAX_ATTEMPTS - 1
+
+
+def test_map_calls_keeps_order():
+    limiter = rl.RateLimiter(concurrency=4, max_concurrency=4)
+    started = threading.Barrier(4)
+
+    def delete(item):
+        # The first calls wait for each other, so they finish out of order
+        if item < 4:
+            started.wait(timeout=5)
+        return item * 10
+
+    items = list(range(10))
+    assert rl.map_calls(limiter, delete, items) == [(item, item * 10) for item in items]
+    assert rl.map_calls(None, delete, [4, 5]) == [(4, 40), (5, 50)]
+
+
+def test_map_calls_carries_context_variables():
+    label.set('EC2 Old Snapshots')
+    results = rl.map_calls(rl.RateLimiter(), lambda item: (label.get(), threading.get_ident()), list(range(8)))
+    assert {result[0] for item, result in results} == {'EC2 Old Snapshots'}
+    assert threading.get_ident() not in {result[1] for item, result in results}
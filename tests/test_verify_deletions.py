@@ -0,0 +1,93 @@
+import botocore.exceptions
+import pytest
+import modules.verify_deletions as vf
+
+RESOURCES = {'1': 'Old EC2 Image', '3': 'EC2 Old Snapshots', '4': 'Unattached Elastic IPs',
+             '5': 'Unattached EBS Volumes', '6': 'RDS Old Snapshots'}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(vf.time, 'monotonic', clock)
+    monkeypatch.setattr(vf.time, 'sleep', clock.sleep)
+    return clock
+
+
+class Paginator:
+    def __init__(self, paginate):
+        self.paginate = paginate
+
+
+class Ec2:
+    # The deleted volumes are described twice more before they are gone. One snapshot never finishes deleting; a
+    # deregistered image is still described, in a state that counts as gone.
+    def __init__(self):
+        self.polls = {}
+
+    def get_paginator(self, operation):
+        self.polls[operation] = self.polls.get(operation, 0) + 1
+
+        def paginate(Filters, **kwargs):
+            values = Filters[0]['Values']
+            if operation == 'describe_volumes':
+                volumes = [{'VolumeId': volume_id, 'State': 'deleting'} for volume_id in values]
+                return [{'Volumes': volumes if self.polls[operation] <= 2 else []}]
+            if operation == 'describe_snapshots':
+                return [{'Snapshots': [{'SnapshotId': 'snap-00000001', 'State': 'pending'}]}]
+            return [{'Images': [{'ImageId': image_id, 'State': 'deregistered'} for image_id in values]}]
+
+        return Paginator(paginate)
+
+    def describe_addresses(self):
+        return {'Addresses': [{'PublicIp': '10.0.0.1', 'AssociationId': 'eipassoc-1'}, {'PublicIp': '10.0.0.9'}]}
+
+
+class Rds:
+    def get_paginator(self, operation):
+        raise botocore.exceptions.ClientError({'Error': {'Code': 'AccessDenied'}}, 'DescribeDBSnapshots')
+
+
+def test_backoff_delay():
+    assert [vf.backoff_delay(attempt) for attempt in range(6)] == [2, 4, 8, 16, 30, 30]
+
+
+def test_polls_until_gone(clock, logger):
+    deleted = {'5': ['vol-00000001', 'vol-00000002'], '1': ['ami-00000001'], '3': []}
+    assert vf.verify_deletions(Ec2(), Rds(), deleted, RESOURCES, logger) == {'1': {}, '5': {}}
+    # Polled three times: present, present, gone
+    assert clock.sleeps == [2, 4]
+
+
+def test_stragglers_and_unverified(clock, logger):
+    ec2 = Ec2()
+    deleted = {'3': ['snap-00000001', 'snap-00000002'], '4': ['10.0.0.1', '10.0.0.2'], '6': ['my-snapshot']}
+    stragglers = vf.verify_deletions(ec2, Rds(), deleted, RESOURCES, logger, timeout=59)
+    assert stragglers == {'3': {'snap-00000001': 'pending'}, '4': {'10.0.0.1': 'associated'},
+                          '6': {'my-snapshot': vf.UNVERIFIED}}
+    # The next delay, 30 seconds, would pass the timeout
+    assert clock.sleeps == [2, 4, 8, 16]
+    assert ec2.polls == {'describe_snapshots': 5}
+
+
+def test_report_stragglers(tmp_path, logger):
+    class Ledger:
+        resource_ids_path = str(tmp_path / 'Client EC2 Old Snapshots.txt')
+
+    vf.report_stragglers(Ledger(), '111111111111', 'us-east-1', RESOURCES['3'], ['snap-00000002', 'snap-00000001'],
+                         {'snap-00000002': 'pending', 'snap-00000001': vf.UNVERIFIED}, logger)
+    assert (tmp_path / 'Client EC2 Old Snapshots stragglers.txt').read_text().splitlines() == \
+        ['snap-00000001\tunverified\t111111111111\tus-east-1', 'snap-00000002\tpending\t111111111111\tus-east-1']
@@ -0,0 +1,103 @@
+import pytest
+import modules.work_queue as wq
+
+UNITS = [('1', '111111111111', 'us-east-1', '3'), ('1', '111111111111', 'us-west-2', '3')]
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = wq.WorkQueue(wq.queue_path('20240101_000000', str(tmp_path / 'farm')))
+    queue.add_units(UNITS)
+    yield queue
+    queue.close()
+
+
+def state(queue, unit_id):
+    return queue._connection.execute('SELECT state FROM units WHERE id = ?', (unit_id,)).fetchone()[0]
+
+
+def test_claim_hands_out_each_unit_once(queue):
+    assert queue.claim('a') == (1,) + UNITS[0]
+    assert queue.claim('b') == (2,) + UNITS[1]
+    assert queue.claim('c') is None
+    assert queue.counts() == {wq.PENDING: 0, wq.LEASED: 2, wq.DONE: 0, wq.FAILED: 0}
+    assert queue.active_leases() == 2
+    assert not queue.finished()
+
+
+def test_adding_units_again_keeps_their_state(queue):
+    unit_id = queue.claim('a')[0]
+    assert queue.complete(unit_id, 'a', {'counts': [0, 0, 1, 0, 0]})
+    queue.add_units(UNITS)
+    assert state(queue, unit_id) == wq.DONE
+    assert queue.counts()[wq.PENDING] == 1
+
+
+def test_expired_lease_is_claimed_by_the_next_worker(queue):
+    unit_id = queue.claim('a', lease_seconds=-1)[0]
+    assert queue.active_leases() == 0
+    assert queue.claim('b')[0] == unit_id
+
+
+def test_lost_lease_cannot_be_renewed_or_completed(queue):
+    unit_id = queue.claim('a', lease_seconds=-1)[0]
+    assert queue.claim('b')[0] == unit_id
+
+    assert not queue.renew(unit_id, 'a')
+    assert not queue.complete(unit_id, 'a', {'file': 'a.txt'})
+    assert state(queue, unit_id) == wq.LEASED
+
+    assert queue.renew(unit_id, 'b')
+    assert queue.complete(unit_id, 'b', {'file': 'b.txt'})
+    assert queue.results('1', '3') == [{'file': 'b.txt'}]
+
+
+def test_unit_fails_once_its_attempts_expire(queue):
+    for attempt in range(wq.MAX_ATTEMPTS):
+        assert queue.claim(f'worker {attempt}', lease_seconds=-1)[0] == 1
+    # The next claim fails the unit instead of leasing it a fourth time
+    assert queue.claim('last')[0] == 2
+    assert state(queue, 1) == wq.FAILED
+    assert queue.failures() == [UNITS[0] + ('lease expired',)]
+
+
+def test_fail_retries_until_out_of_attempts(queue):
+    for attempt in range(wq.MAX_ATTEMPTS - 1):
+        unit_id = queue.claim('a')[0]
+        queue.fail(unit_id, 'a', 'throttled')
+        assert state(queue, unit_id) == wq.PENDING
+    unit_id = queue.claim('a')[0]
+    queue.fail(unit_id, 'a', 'throttled')
+    assert state(queue, unit_id) == wq.FAILED
+
+
+def test_fail_without_retry_and_resume(queue):
+    unit_id = queue.claim('a')[0]
+    queue.fail(unit_id, 'a', 'not logged in', retry=False)
+    assert state(queue, unit_id) == wq.FAILED
+
+    queue.retry_failed()
+    assert state(queue, unit_id) == wq.PENDING
+    assert queue.claim('b')[0] == unit_id
+
+
+def test_fail_after_lost_lease_changes_nothing(queue):
+    unit_id = queue.claim('a', lease_seconds=-1)[0]
+    assert queue.claim('b')[0] == unit_id
+    queue.fail(unit_id, 'a', 'timed out', retry=False)
+    assert state(queue, unit_id) == wq.LEASED
+    assert queue.complete(unit_id, 'b', {})
+
+
+def test_finished_once_nothing_is_pending_or_leased(queue):
+    first = queue.claim('a')[0]
+    second = queue.claim('a')[0]
+    queue.complete(first, 'a', {})
+    assert not queue.finished()
+    queue.fail(second, 'a', 'denied', retry=False)
+    assert queue.finished()
+
+
+def test_settings_round_trip(queue):
+    queue.save_settings({'dry_run': True, 'plan': None, 'inventory_ttl': 900})
+    assert queue.settings() == {'dry_run': True, 'plan': None, 'inventory_ttl': 900}
@@ -0,0 +1,113 @@
+import os
+import pytest
+
+pytest.importorskip('aws_sso_lib')
+import modules.ledger as lg
+import modules.work_queue as wq
+import modules.worker_farm as wf
+
+CLIENT = 'Client'
+RESOURCE = 'EC2 Old Snapshots'
+RUN = '20240101_000000'
+IDS = [f'snap-{number:08x}' for number in range(6)]
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(wf.client_directory(CLIENT, RUN))
+    queue = wq.WorkQueue(wq.queue_path(RUN))
+    yield queue
+    queue.close()
+
+
+def write_lines(path, lines):
+    with open(path, 'w') as file:
+        file.write(''.join(f'{line}\n' for line in lines))
+
+
+def read_lines(path):
+    with open(path) as file:
+        return file.read().splitlines()
+
+
+def run_units(queue, *ledgers):
+    # Queue, claim and complete a unit per ledger, with the ledger's outcomes as its result file
+    queue.add_units([('1', '111111111111', f'region-{number}', '3') for number in range(len(ledgers))])
+    for ledger in ledgers:
+        unit_id = queue.claim('worker')[0]
+        result_path = f'{wf.client_directory(CLIENT, RUN)}/{unit_id}.txt'
+        write_lines(result_path, ledger.outcome_lines())
+        assert queue.complete(unit_id, 'worker', {'file': result_path, 'counts': [0, 0, 0, 0, 0]})
+
+
+def test_unit_ledger_outcome_lines():
+    ledger = wf.UnitLedger('working.txt', IDS[:5])
+    ledger.mark_deleted(IDS[:1])
+    ledger.mark_deleted(IDS[1:2], record=False)
+    ledger.mark_errors(IDS[2:3])
+    ledger.mark_not_found(IDS[2:4])
+    assert ledger.pending() == IDS[3:5]
+    assert ledger.flush() == 3
+    assert list(ledger.outcome_lines()) == [f'{IDS[0]}\tdeleted', f'{IDS[1]}\tunrecorded', f'{IDS[2]}\terror',
+                                            f'{IDS[3]}\tnot found']
+
+
+@pytest.mark.parametrize('window_size', [2, lg.WINDOW_SIZE])
+def test_merge_results(queue, logger, monkeypatch, window_size):
+    monkeypatch.setattr(lg, 'WINDOW_SIZE', window_size)
+    path = wf.resource_ids_path(CLIENT, RESOURCE, RUN)
+    write_lines(path, IDS)
+
+    first = wf.UnitLedger(path, IDS)
+    first.mark_deleted(IDS[:1])
+    first.mark_errors(IDS[1:2])
+    first.mark_not_found(IDS[2:3])
+    first.mark_deleted(IDS[3:4], record=False)
+    second = wf.UnitLedger(path, IDS)
+    # Deleted in the second region after the first could not delete it
+    second.mark_deleted(IDS[1:2])
+    second.mark_not_found(IDS[2:3])
+    second.mark_errors(IDS[4:5])
+    run_units(queue, first, second)
+
+    summary = wf.merge_results(queue, '1', CLIENT, '3', RESOURCE, RUN, logger)
+    assert summary == {lg.PENDING: 1, lg.NOT_FOUND: 1, lg.DELETED: 3, lg.ERROR: 1}
+    assert read_lines(path) == [IDS[2], IDS[4], IDS[5]]
+    directory = wf.client_directory(CLIENT, RUN)
+    assert read_lines(f'{directory}/{CLIENT} {RESOURCE} deleted.txt') == IDS[:2]
+    assert read_lines(f'{directory}/{CLIENT} {RESOURCE} errors.txt') == [IDS[4]]
+
+
+def test_merge_removes_an_emptied_working_file(queue, logger):
+    path = wf.resource_ids_path(CLIENT, RESOURCE, RUN)
+    write_lines(path, IDS)
+    ledger = wf.UnitLedger(path, IDS)
+    ledger.mark_deleted(IDS)
+    run_units(queue, ledger)
+
+    assert wf.merge_results(queue, '1', CLIENT, '3', RESOURCE, RUN, logger)[lg.DELETED] == len(IDS)
+    assert not os.path.exists(path)
+    assert not os.path.exists(f'{path}.tmp')
+
+
+def test_worker_records_failed_units(queue, logger, monkeypatch):
+    queue.save_settings({'run_date_time': RUN})
+    queue.add_units([('1', '111111111111', region, '3') for region in ('us-east-1', 'us-east-2', 'us-west-1')])
+    results = {'us-east-1': None, 'us-east-2': RuntimeError('describe failed'), 'us-west-1': {'counts': [0] * 5}}
+
+    def run_unit(unit, clients_dict, resources_dict, settings, logger):
+        result = results[unit[3]]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(wf, 'run_unit', run_unit)
+    assert wf.run_worker(queue.path, {'1': {'name': CLIENT}}, {'3': RESOURCE}, logger) == 1
+
+    # A unit without valid credentials is not retried; one that raised is, up to its last attempt
+    assert queue.failures() == [('1', '111111111111', 'us-east-1', '3', 'not logged in'),
+                                ('1', '111111111111', 'us-east-2', '3', "RuntimeError('describe failed')")]
+    assert queue._connection.execute('SELECT attempts FROM units ORDER BY id').fetchall() == \
+        [(1,), (wq.MAX_ATTEMPTS,), (1,)]
+    assert queue.finished()